@@ -0,0 +1,225 @@
+"""Extracts the perturbations of many session parquet files in parallel and
+collects one row per perturbation in a combined table.
+
+Usage::
+
+    python src/batch.py "sessions/*.parquet" --output perturbations
+
+Each session is written to its own part file as soon as it is processed and
+recorded in a manifest, so an interrupted run can be restarted and sessions
+that are already processed and unchanged are skipped. A session that fails is
+recorded with its error in the manifest and the others continue, it is retried
+by the next run.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from features import perturbation_features
+from generate_time_series_imgs import (
+    DURATION_AFTER,
+    DURATION_BEFORE,
+    load_perturbations,
+)
+
+MANIFEST = "manifest.json"
+PARTS_DIR = "parts"
+COMBINED = "perturbations.parquet"
+# the modules that compute the part files, a change to them reprocesses all
+# sessions
+CODE_PATHS = [
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), name)
+    for name in ["batch.py", "features.py", "generate_time_series_imgs.py"]
+]
+
+
+def code_hash(paths=CODE_PATHS):
+    """Returns a hex digest of the contents of the modules that compute the
+    part files."""
+    hasher = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            hasher.update(hashlib.sha256(f.read()).digest())
+    return hasher.hexdigest()
+
+
+def find_sessions(pattern):
+    """Returns the sorted session files matching a directory or glob pattern."""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.parquet")
+    return sorted(glob.glob(pattern))
+
+
+def fingerprint(path, duration_before, duration_after, code=None):
+    """Returns what identifies a processed session, i.e. the file's size and
+    modification time, the extraction settings and the ``code_hash()`` of the code
+    that computes and lays out the part file."""
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "duration_before": duration_before,
+        "duration_after": duration_after,
+        "code": code_hash() if code is None else code,
+    }
+
+
+def process_session(path, part_path, duration_before, duration_after):
+    """Extracts the perturbations of one session and writes their features to
+    ``part_path``. Returns the number of perturbations."""
+    perturbations = load_perturbations(path, duration_before, duration_after)
+    table = perturbation_features(perturbations)
+    table.insert(0, "session", os.path.splitext(os.path.basename(path))[0])
+    tmp_path = part_path + ".tmp"
+    table.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, part_path)
+    return len(table)
+
+
+def _write_json(path, obj):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def combine_parts(part_paths, combined_path):
+    """Streams the part files into one parquet file, one part in memory at a time."""
+    writer = None
+    tmp_path = combined_path + ".tmp"
+    try:
+        for part_path in part_paths:
+            table = pq.read_table(part_path)
+            if table.num_rows == 0:
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            else:
+                table = table.select(writer.schema.names).cast(writer.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    if writer is None:
+        pq.write_table(pa.table({}), tmp_path)
+    os.replace(tmp_path, combined_path)
+
+
+def run_batch(
+    sessions,
+    output_dir,
+    processes=None,
+    duration_before=DURATION_BEFORE,
+    duration_after=DURATION_AFTER,
+):
+    """Processes the sessions in a process pool and writes the combined table.
+
+    Parameters
+    ----------
+    sessions : List[str]
+        Paths to the session parquet files.
+    output_dir : str
+        Directory for the part files, the manifest and the combined table.
+    processes : int, optional
+        Number of worker processes, defaults to the number of CPUs.
+    duration_before : float
+        Duration in seconds before the perturbation is applied that should be included.
+    duration_after : float
+        Duration in seconds after the perurbation has ended that should be included.
+
+    Returns
+    -------
+    str
+        Path to the combined parquet file, which holds the sessions that did not
+        fail.
+    """
+    parts_dir = os.path.join(output_dir, PARTS_DIR)
+    os.makedirs(parts_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    code = code_hash()
+    part_paths = {}
+    todo = []
+    for path in sessions:
+        key = os.path.abspath(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        # the path hash keeps sessions with the same file name apart
+        path_hash = hashlib.sha1(key.encode()).hexdigest()[:8]
+        part_paths[key] = os.path.join(parts_dir, f"{name}-{path_hash}.parquet")
+        session_print = fingerprint(path, duration_before, duration_after, code)
+        entry = manifest.get(key)
+        if (
+            entry is not None
+            and "error" not in entry
+            and entry["fingerprint"] == session_print
+            and os.path.exists(part_paths[key])
+        ):
+            print(f"Skipping unchanged session {path}")
+        else:
+            todo.append((key, session_print))
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {
+            executor.submit(
+                process_session, key, part_paths[key], duration_before, duration_after
+            ): (key, session_print)
+            for key, session_print in todo
+        }
+        for future in as_completed(futures):
+            key, session_print = futures[future]
+            try:
+                num = future.result()
+            except Exception as error:
+                # one corrupt session must not stop the others, it is retried by
+                # the next run
+                manifest[key] = {
+                    "fingerprint": session_print,
+                    "error": "".join(
+                        traceback.format_exception_only(type(error), error)
+                    ).strip(),
+                }
+                if os.path.exists(part_paths[key]):
+                    os.remove(part_paths[key])  # of an older version of the file
+                print(f"Failed {key}: {manifest[key]['error']}")
+            else:
+                manifest[key] = {"fingerprint": session_print, "perturbations": num}
+                print(f"Processed {key}: {num} perturbations")
+            # record each session as soon as it is done so a restart resumes here
+            _write_json(manifest_path, manifest)
+
+    keys = [os.path.abspath(path) for path in sessions]
+    failed = [key for key in keys if "error" in manifest.get(key, {})]
+    if failed:
+        print(f"{len(failed)} of {len(keys)} sessions failed, see {manifest_path}")
+    combined_path = os.path.join(output_dir, COMBINED)
+    combine_parts(
+        [part_paths[key] for key in keys if key not in failed], combined_path
+    )
+    print(f"Saved combined table with name {combined_path}")
+    return combined_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("sessions", help="Directory or glob of session parquet files.")
+    parser.add_argument("-o", "--output", default="perturbations",
+                        help="Output directory.")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="Number of worker processes.")
+    args = parser.parse_args()
+    run_batch(find_sessions(args.sessions), args.output, processes=args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""Timing and peak memory benchmarks of the hot paths of the figures and the
+statistics.
+
+Usage::
+
+    python src/benchmark.py                            # all, up to 10^7
+    python src/benchmark.py calc_eigen simulation      # only these
+    python src/benchmark.py -o benchmarks.json         # save the results
+    python src/benchmark.py --baseline benchmarks.json # flag regressions
+    python src/benchmark.py --max-size 100000000       # 10^8 row sessions
+
+Each benchmark is run at each of its sizes, e.g. the number of speeds of a
+sweep or the number of rows of a session. The time is the best of several
+runs and the peak memory is measured in one more run with ``tracemalloc``,
+which sees the allocations of Python and NumPy but not those of LAPACK or
+Arrow. The results are written as JSON, and a run with ``--baseline`` exits
+with status 1 if a benchmark is slower or uses more memory than in the
+baseline by more than the tolerance.
+"""
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# sizes above this are skipped unless --max-size is given, a session of 10^8
+# rows takes about 10 GB of memory
+MAX_SIZE = 10**7
+# runs of one size stop after this many seconds, even if fewer than the
+# requested number of repeats were made
+MAX_SECONDS = 10.0
+SWEEP_SIZES = [10**3, 10**4, 10**5, 10**6]
+SESSION_SIZES = [10**5, 10**6, 10**7, 10**8]
+SAMPLE_RATE = 1000.0  # Hz of the Teensy log
+
+
+class Benchmark:
+    """A function that is timed at several problem sizes.
+
+    Parameters
+    ==========
+    name : string
+    setup : function
+        Takes a size and returns a function without arguments that does the
+        work to be timed. Setup work, e.g. building the inputs, is not timed.
+    sizes : list of integers
+    description : string, optional
+    """
+
+    def __init__(self, name, setup, sizes, description=''):
+        self.name = name
+        self.setup = setup
+        self.sizes = list(sizes)
+        self.description = description
+
+
+def _model():
+    # a model without a cache, so every call does the work
+    from model import SteerControlModel
+    from control import load_models
+    return SteerControlModel(load_models()[False][0])
+
+
+def _sweep(size):
+    from control import GAIN_MAP, generate_gains, speeds
+    v = np.linspace(0.0, 10.0, num=size)
+    kphidot = np.interp(v, speeds, generate_gains(GAIN_MAP[10]))
+    return {'v': v, 'kphidot': kphidot}
+
+
+def synthetic_session(num_rows, period=5.0, seed=0):
+    """Returns a session of the desired forces with a Bump'em pulse on
+    alternating channels every ``period`` seconds, and two noisy
+    direction dependent channels.
+
+    Parameters
+    ==========
+    num_rows : integer
+        Number of samples at ``SAMPLE_RATE``.
+    period : float, optional
+        Seconds between the starts of the pulses.
+    seed : integer, optional
+
+    Returns
+    =======
+    pandas.DataFrame
+
+    """
+    import pandas as pd
+    from generate_time_series_imgs import PULSE_DURATION, TRACKING_FORCE
+
+    forces = np.full((2, num_rows), float(TRACKING_FORCE))
+    width = int(PULSE_DURATION*SAMPLE_RATE)
+    starts = np.arange(int(SAMPLE_RATE), num_rows - width,
+                       int(period*SAMPLE_RATE))
+    for i, start in enumerate(starts):
+        forces[i % 2, start:start + width] = 50.0
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'seconds_since_start': np.arange(num_rows)/SAMPLE_RATE,
+        'desforce13': forces[0],
+        'desforce24': forces[1],
+        'roll_angle': rng.normal(scale=0.01, size=num_rows),
+        'steer_rate': rng.normal(scale=0.1, size=num_rows),
+    })
+
+
+def setup_state_space(size):
+    model, overrides = _model(), _sweep(size)
+    return lambda: model.form_state_space_matrices(**overrides)
+
+
+def setup_calc_eigen(size):
+    model, overrides = _model(), _sweep(size)
+    return lambda: model.calc_eigen(**overrides)
+
+
+def setup_plot_eig(size):
+    import matplotlib.pyplot as plt
+    from control import plot_eig
+    model = _model()
+
+    def run():
+        fig, ax = plt.subplots()
+        plot_eig(ax, model, 'both')
+        fig.canvas.draw()
+        plt.close(fig)
+    return run
+
+
+def setup_simulation(size):
+    from control import simulation_inputs
+    model = _model()
+    _, x0, kwargs = simulation_inputs()
+    times = np.linspace(0.0, 10.0, num=size)
+    return lambda: model.simulate_saturated(times, x0, **kwargs)
+
+
+def setup_perturbation_indices(size):
+    from generate_time_series_imgs import (DESIRED_FORCES,
+                                           get_perturbation_indices)
+    data = synthetic_session(size)
+    return lambda: get_perturbation_indices(data, DESIRED_FORCES)
+
+
+def setup_perturbations(size):
+    from generate_time_series_imgs import (DESIRED_FORCES, DURATION_AFTER,
+                                           DURATION_BEFORE, get_perturbations)
+    data = synthetic_session(size)
+    return lambda: get_perturbations(data, DESIRED_FORCES, DURATION_BEFORE,
+                                     DURATION_AFTER)
+
+
+def _tables():
+    import pandas as pd
+    from regression import DATA_PATHS
+    return {speed: pd.read_csv(path) for speed, path in DATA_PATHS.items()}
+
+
+def setup_fall_models(size):
+    from regression import fit_fall_models
+    tables = _tables()
+    return lambda: fit_fall_models(tables)
+
+
+def setup_fall_glmm(size):
+    from glmm import fit_fall_glmm
+    tables = _tables()
+    return lambda: [fit_fall_glmm(table) for table in tables.values()]
+
+
+BENCHMARKS = [
+    Benchmark('form_state_space_matrices', setup_state_space, SWEEP_SIZES,
+              'state and input matrices of a speed sweep'),
+    Benchmark('calc_eigen', setup_calc_eigen, SWEEP_SIZES,
+              'eigenvalues and eigenvectors of a speed sweep'),
+    Benchmark('plot_eig', setup_plot_eig, [None],
+              'one panel of balance-assist-eig-vs-speeds.png'),
+    Benchmark('simulation', setup_simulation, [10**3, 10**4, 10**5],
+              'saturated controller simulation, size is the output times'),
+    Benchmark('get_perturbation_indices', setup_perturbation_indices,
+              SESSION_SIZES, 'pulse detection, size is the session rows'),
+    Benchmark('get_perturbations', setup_perturbations, SESSION_SIZES,
+              'pulse detection and windows, size is the session rows'),
+    Benchmark('fall_models', setup_fall_models, [None],
+              'logistic regressions of the 6 and 10 km/h data'),
+    Benchmark('fall_glmm', setup_fall_glmm, [None],
+              'random intercept models of the 6 and 10 km/h data'),
+]
+
+
+def measure(func, repeat=5):
+    """Returns the timings and peak traced memory of a function.
+
+    Parameters
+    ==========
+    func : function
+        Takes no arguments.
+    repeat : integer, optional
+        Number of timed runs, fewer if they take longer than
+        ``MAX_SECONDS`` together.
+
+    Returns
+    =======
+    dictionary
+        ``min_seconds``, ``median_seconds``, ``repeats`` and ``peak_bytes``,
+        the largest memory allocated at once during one run.
+
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+        if sum(timings) > MAX_SECONDS:
+            break
+    # NOTE : tracemalloc slows down allocations, so memory is measured in a
+    # separate run.
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'min_seconds': min(timings),
+        'median_seconds': statistics.median(timings),
+        'repeats': len(timings),
+        'peak_bytes': peak,
+    }
+
+
+def run(names=None, max_size=MAX_SIZE, repeat=5, verbose=True):
+    """Runs benchmarks.
+
+    Parameters
+    ==========
+    names : list of strings, optional
+        Names of the benchmarks to run, defaults to all.
+    max_size : integer, optional
+        Sizes above this are skipped.
+    repeat : integer, optional
+        See ``measure()``.
+    verbose : boolean, optional
+        If True, each result is printed when it is done.
+
+    Returns
+    =======
+    dictionary
+        ``environment`` describes the machine and the versions, ``results``
+        is a list with a dictionary per benchmark and size, see
+        ``measure()``.
+
+    """
+    unknown = set(names or []) - {b.name for b in BENCHMARKS}
+    if unknown:
+        raise ValueError('Unknown benchmarks {}.'.format(sorted(unknown)))
+    import matplotlib
+    import pandas
+    import scipy
+    matplotlib.use('Agg')
+
+    results = []
+    for benchmark in BENCHMARKS:
+        if names and benchmark.name not in names:
+            continue
+        for size in benchmark.sizes:
+            if size is not None and size > max_size:
+                continue
+            func = benchmark.setup(size)
+            result = {'name': benchmark.name, 'size': size}
+            result.update(measure(func, repeat=repeat))
+            del func
+            results.append(result)
+            if verbose:
+                print(format_result(result))
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'pandas': pandas.__version__,
+            'matplotlib': matplotlib.__version__,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+
+
+def _label(result):
+    if result['size'] is None:
+        return result['name']
+    return '{}[{}]'.format(result['name'], result['size'])
+
+
+def format_result(result):
+    return '{:<36} {:>10.4f} s {:>10.1f} MiB  ({} runs)'.format(
+        _label(result), result['min_seconds'],
+        result['peak_bytes']/2**20, result['repeats'])
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Returns the benchmarks that regressed with respect to a baseline.
+
+    Parameters
+    ==========
+    results : dictionary
+        Output of ``run()``.
+    baseline : dictionary
+        Output of ``run()`` of an earlier version, e.g. loaded from the JSON
+        file written by ``--output``.
+    tolerance : float, optional
+        Relative increase of the best time or the peak memory that is
+        allowed.
+
+    Returns
+    =======
+    list of tuples
+        ``(label, quantity, ratio)`` of each regression, where ``quantity``
+        is ``'time'`` or ``'memory'`` and ``ratio`` is the new value divided
+        by the baseline value. Benchmarks that are not in both are ignored.
+
+    """
+    old = {_label(r): r for r in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        label = _label(result)
+        if label not in old:
+            continue
+        for quantity, key in [('time', 'min_seconds'),
+                              ('memory', 'peak_bytes')]:
+            if old[label][key] > 0:
+                ratio = result[key]/old[label][key]
+                if ratio > 1.0 + tolerance:
+                    regressions.append((label, quantity, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*',
+                        help='Benchmarks to run, defaults to all: {}.'.format(
+                            ', '.join(b.name for b in BENCHMARKS)))
+    parser.add_argument('-o', '--output',
+                        help='Write the results to this JSON file.')
+    parser.add_argument('-b', '--baseline',
+                        help='Compare the results to this JSON file.')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25,
+                        help='Allowed relative increase over the baseline, '
+                        'defaults to 0.25.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of timed runs of each size.')
+    parser.add_argument('--max-size', type=float, default=MAX_SIZE,
+                        help='Skip larger sizes, defaults to {:.0e}.'.format(
+                            MAX_SIZE))
+    args = parser.parse_args()
+
+    results = run(args.names, max_size=args.max_size, repeat=args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for label, quantity, ratio in regressions:
+            print('Regression: {} {} is {:.2f} times the baseline.'.format(
+                label, quantity, ratio))
+        if regressions:
+            sys.exit(1)
+        print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()
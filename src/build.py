@@ -0,0 +1,284 @@
+"""Rebuilds the figures whose inputs changed since they were last built.
+
+Usage::
+
+    python src/build.py                  # rebuild the stale figures
+    python src/build.py gains-vs-speed   # only this figure, if stale
+    python src/build.py --dry-run        # list the stale figures
+    python src/build.py --force          # rebuild everything
+
+Each figure is a task with declared inputs: source code, parameter
+dictionaries, data files and installed packages. A task's fingerprint is a
+hash of the content of its inputs, so editing comments, docstrings or the
+formatting of the code, or touching a file without changing it, does not
+trigger a rebuild. The fingerprints of the last successful builds are stored
+in ``.build-state.json``.
+"""
+import argparse
+import ast
+import glob
+import hashlib
+import importlib.metadata
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.realpath(os.path.join(SRC_DIR, '..'))
+STATE_PATH = os.path.join(ROOT_DIR, '.build-state.json')
+
+
+class Task:
+    """A build step that creates output files from declared inputs.
+
+    Parameters
+    ==========
+    name : string
+    outputs : list of strings
+        Files the command creates, relative to the repository root.
+    command : list of strings
+        Command that is run from the repository root. Tasks with the same
+        command are built by one run of it.
+    sources : list of tuples, optional
+        ``(path, name)`` pairs of Python source that the outputs depend on,
+        where ``name`` is a top level function, class or variable of the
+        module at ``path``, or None for the whole module.
+    params : list of tuples, optional
+        ``(path, name)`` pairs of dictionaries assigned at the top level of
+        the module at ``path``, e.g. ``('src/data.py', 'bike_with_rider')``.
+    files : list of strings, optional
+        Data files or glob patterns that the outputs depend on.
+    packages : list of strings, optional
+        Installed distributions whose versions the outputs depend on.
+    """
+
+    def __init__(self, name, outputs, command, sources=(), params=(),
+                 files=(), packages=()):
+        self.name = name
+        self.outputs = list(outputs)
+        self.command = list(command)
+        self.sources = list(sources)
+        self.params = list(params)
+        self.files = list(files)
+        self.packages = list(packages)
+
+    def fingerprint(self):
+        """Returns a hex digest of the content of all inputs."""
+        hasher = hashlib.sha256()
+
+        def update(label, value):
+            hasher.update(label.encode())
+            hasher.update(hashlib.sha256(value).digest())
+
+        update('command', json.dumps(self.command[1:]).encode())
+        for path, name in self.sources:
+            update('source:{}:{}'.format(path, name),
+                   source_fingerprint(path, name).encode())
+        for path, name in self.params:
+            update('params:{}:{}'.format(path, name),
+                   param_fingerprint(path, name).encode())
+        for pattern in self.files:
+            paths = sorted(glob.glob(os.path.join(ROOT_DIR, pattern)))
+            if not paths:
+                update('missing:' + pattern, b'')
+            for path in paths:
+                with open(path, 'rb') as f:
+                    update('file:' + os.path.relpath(path, ROOT_DIR),
+                           f.read())
+        for package in self.packages:
+            try:
+                version = importlib.metadata.version(package)
+            except importlib.metadata.PackageNotFoundError:
+                version = ''
+            update('package:' + package, version.encode())
+        return hasher.hexdigest()
+
+    def outputs_exist(self):
+        return all(os.path.exists(os.path.join(ROOT_DIR, path))
+                   for path in self.outputs)
+
+
+def _strip_docstrings(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef,
+                             ast.AsyncFunctionDef)):
+            body = node.body
+            if (body and isinstance(body[0], ast.Expr) and
+                    isinstance(body[0].value, ast.Constant) and
+                    isinstance(body[0].value.value, str)):
+                node.body = body[1:] or [ast.Pass()]
+    return tree
+
+
+def _top_level_node(tree, path, name):
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.ClassDef)) and node.name == name:
+            return node
+        if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == name
+                for target in node.targets):
+            return node
+    raise ValueError('{} is not defined at the top level of {}.'.format(
+        name, path))
+
+
+def _parse(path):
+    with open(os.path.join(ROOT_DIR, path)) as f:
+        return ast.parse(f.read(), filename=path)
+
+
+def source_fingerprint(path, name=None):
+    """Returns a hash of the syntax tree of a module or of one of its top
+    level definitions, without docstrings, comments and formatting."""
+    tree = _strip_docstrings(_parse(path))
+    node = tree if name is None else _top_level_node(tree, path, name)
+    return hashlib.sha256(ast.dump(node).encode()).hexdigest()
+
+
+def param_fingerprint(path, name):
+    """Returns a hash of the literal dictionary assigned to ``name`` at the
+    top level of a module, independent of the order of its keys."""
+    node = _top_level_node(_parse(path), path, name)
+    params = ast.literal_eval(node.value)
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+CONTROL = [sys.executable, os.path.join('src', 'control.py')]
+TIME_SERIES = [sys.executable,
+               os.path.join('src', 'generate_time_series_imgs.py')]
+BIKE_PARAMS = [('src/data.py', 'bike_with_rider'),
+               ('src/data.py', 'bike_without_rider')]
+# modules that control.py imports, any change to them can change what it draws
+CONTROL_IMPORTS = [('src/eigen_cache.py', None), ('src/instrument.py', None)]
+# NOTE : control.CACHE_SALT hashes these modules too, so a rebuild after a
+# change to them computes new results instead of reading the eigenvalue
+# cache.
+MODEL_SOURCES = [('src/control.py', None), ('src/model.py', None)]
+MODEL_PACKAGES = ['bicycleparameters', 'numpy', 'scipy', 'matplotlib']
+
+TASKS = [
+    Task('bicycle-with-geometry-mass',
+         ['figures/bicycle-with-geometry-mass.png'], CONTROL + ['geometry'],
+         sources=[('src/control.py', None)] + CONTROL_IMPORTS,
+         params=BIKE_PARAMS,
+         packages=MODEL_PACKAGES),
+    Task('gains-vs-speed',
+         ['figures/gains-vs-speed.png'], CONTROL + ['gains'],
+         sources=[('src/control.py', name) for name in
+                  ['GAIN_MAP', 'speeds', 'generate_gains',
+                   'plot_gains_vs_speed', '_figure_path']] +
+         CONTROL_IMPORTS,
+         packages=['numpy', 'matplotlib']),
+    Task('balance-assist-eig-vs-speeds',
+         ['figures/balance-assist-eig-vs-speeds.png'], CONTROL + ['eig'],
+         sources=MODEL_SOURCES + CONTROL_IMPORTS, params=BIKE_PARAMS,
+         files=['data/weave_eigenvalues_from_experiment_gain_*.csv'],
+         packages=MODEL_PACKAGES),
+    Task('pd-simulation',
+         ['figures/pd-simulation.png'], CONTROL + ['simulation'],
+         sources=MODEL_SOURCES + CONTROL_IMPORTS, params=BIKE_PARAMS,
+         packages=MODEL_PACKAGES),
+    Task('torque_angle_perturbation',
+         ['figures/torque_angle_perturbation_10.png',
+          'figures/perturbation_0.png',
+          'figures/roll_steer_overlay.png'], TIME_SERIES,
+         sources=[('src/generate_time_series_imgs.py', None),
+                  ('src/instrument.py', None)],
+         files=['data/example_data_balance_assist_*.parquet'],
+         packages=['numpy', 'pandas', 'pyarrow', 'matplotlib']),
+]
+
+
+def load_state():
+    if os.path.exists(STATE_PATH):
+        with open(STATE_PATH) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state):
+    tmp_path = STATE_PATH + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, STATE_PATH)
+
+
+def stale_tasks(tasks, state, force=False):
+    """Returns the tasks whose outputs are missing or whose fingerprint
+    differs from the last build, with their new fingerprints."""
+    stale = []
+    for task in tasks:
+        fingerprint = task.fingerprint()
+        if (force or not task.outputs_exist() or
+                state.get(task.name) != fingerprint):
+            stale.append((task, fingerprint))
+    return stale
+
+
+def build(names=None, force=False, dry_run=False):
+    """Rebuilds the stale tasks.
+
+    Parameters
+    ==========
+    names : list of strings, optional
+        Names of the tasks to consider, defaults to all.
+    force : boolean, optional
+        If True, all considered tasks are rebuilt.
+    dry_run : boolean, optional
+        If True, the stale tasks are only printed.
+
+    Returns
+    =======
+    list of strings
+        Names of the stale tasks.
+    """
+    tasks = TASKS if not names else [task for task in TASKS
+                                     if task.name in names]
+    unknown = set(names or []) - {task.name for task in TASKS}
+    if unknown:
+        raise ValueError('Unknown tasks {}.'.format(sorted(unknown)))
+
+    state = load_state()
+    stale = stale_tasks(tasks, state, force=force)
+
+    # tasks that share a command are built by one run of it
+    commands = {}
+    for task, fingerprint in stale:
+        commands.setdefault(tuple(task.command), []).append(
+            (task, fingerprint))
+
+    for command, group in commands.items():
+        print('Stale: {}'.format(', '.join(task.name for task, _ in group)))
+        if dry_run:
+            continue
+        print('Running: {}'.format(' '.join(command)))
+        subprocess.run(command, cwd=ROOT_DIR, check=True)
+        for task, fingerprint in group:
+            state[task.name] = fingerprint
+        # record each command as soon as it succeeds so a failure later on
+        # does not redo it
+        save_state(state)
+
+    if not stale:
+        print('All figures are up to date.')
+    return [task.name for task, _ in stale]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*',
+                        help='Tasks to build, defaults to all: {}.'.format(
+                            ', '.join(task.name for task in TASKS)))
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Rebuild even if the inputs did not change.')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='Only list the stale tasks.')
+    args = parser.parse_args()
+    build(args.names, force=args.force, dry_run=args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,122 @@
+"""Balance assist control law, stability of the closed loop and the figures of
+the bicycle models.
+
+Usage::
+
+    python src/control.py              # all figures and numbers
+    python src/control.py geometry     # bicycle-with-geometry-mass.png
+    python src/control.py gains        # gains-vs-speed.png
+    python src/control.py eig          # balance-assist-eig-vs-speeds.png
+    python src/control.py simulation   # pd-simulation.png
+    python src/control.py numbers      # weave and capsize speeds only
+    python src/control.py --profile profile.json eig   # with timings
+
+Importing this module runs nothing. The models are built on first use and
+matplotlib and bicycleparameters, which imports matplotlib, are only imported
+by the functions that need them.
+"""
+import argparse
+import functools
+import importlib.metadata
 import os
 
 import numpy as np
-from scipy.constants import golden_ratio
-import matplotlib.pyplot as plt
-from bicycleparameters.parameter_sets import Meijaard2007ParameterSet
-from bicycleparameters.bicycle import sort_eigenmodes
 
 from data import bike_with_rider, bike_without_rider
-from model import SteerControlModel
+from eigen_cache import EigenCache, source_hash
+import instrument
 
 SCRIPT_PATH = os.path.realpath(__file__)
 SRC_DIR = os.path.dirname(SCRIPT_PATH)
 ROOT_DIR = os.path.realpath(os.path.join(SRC_DIR, '..'))
 DAT_DIR = os.path.join(ROOT_DIR, 'data')
 FIG_DIR = os.path.join(ROOT_DIR, 'figures')
+CACHE_DIR = os.path.join(ROOT_DIR, '.eigen-cache')
+# NOTE : The cached results depend on the code of these modules and of
+# bicycleparameters, so any change to them starts a new set of cache keys.
+CACHE_SALT = source_hash(
+    [os.path.join(SRC_DIR, name) for name in
+     ['model.py', 'control.py', 'eigen_cache.py']],
+    # NOTE : The version is read from the metadata because importing
+    # bicycleparameters imports matplotlib.
+    versions=[importlib.metadata.version('bicycleparameters')])
 KPH2MPS = 1000.0/3600.0
 MPS2KPH = 1.0/KPH2MPS
 # NOTE : The theorectical gains (values) are manually chosen for a eye-balled
 # best fit of the weave mode for the Teensy set gain (keys).
 GAIN_MAP = {8: 3.9, 10: 5.2}
+# rows and columns of the six panel figure: (row, column, with rigid rider,
+# Teensy gain or None if the balance assist is off, heading)
+PANELS = [
+    (0, 0, False, None, 'Without rigid rider and balance assist off:'),
+    (1, 0, False, 8, '\nWithout rigid rider and balance assist on:'),
+    (2, 0, False, 10, '\nWithout rigid rider and balance assist on:'),
+    (0, 1, True, None, '\nWith rigid rider and balance assist off:'),
+    (1, 1, True, 8, '\nWith rigid rider and balance assist on:'),
+    (2, 1, True, 10, '\nWith rigid rider and balance assist on:'),
+]
+
+speeds = np.linspace(0.0, 10.0, num=2001)
+
+
+_eigen_cache = None
 
-if not os.path.exists(FIG_DIR):
-    os.mkdir(FIG_DIR)
 
-par_set_without = Meijaard2007ParameterSet(bike_without_rider, False)
-model_without = SteerControlModel(par_set_without)
+def get_eigen_cache():
+    """Returns the cache shared by both models."""
+    # NOTE : Both models share one cache so repeated eigenvalue sweeps, within
+    # a run and across runs, skip the linear algebra.
+    global _eigen_cache
+    if _eigen_cache is None:
+        _eigen_cache = EigenCache(CACHE_DIR, salt=CACHE_SALT)
+    return _eigen_cache
+
+
+def set_eigen_cache(cache):
+    """Makes the models use ``cache``, e.g. one that holds precomputed
+    results, instead of the default cache in ``CACHE_DIR``."""
+    global _eigen_cache
+    _eigen_cache = cache
+    load_models.cache_clear()
+
+
+@functools.lru_cache()
+@instrument.instrumented('control.load_models')
+def load_models():
+    """Returns the parameter sets and models without and with the rigid rider.
+
+    Returns a dictionary that maps False (without rider) and True (with rider)
+    to a ``(Meijaard2007ParameterSet, SteerControlModel)`` tuple.
+    """
+    from bicycleparameters.parameter_sets import Meijaard2007ParameterSet
+    from model import SteerControlModel
+
+    models = {}
+    for rider, parameters in [(False, bike_without_rider),
+                              (True, bike_with_rider)]:
+        par_set = Meijaard2007ParameterSet(parameters, rider)
+        models[rider] = (par_set, SteerControlModel(
+            par_set, eigen_cache=get_eigen_cache()))
+    return models
+
+
+def _figure_path(fname):
+    if not os.path.exists(FIG_DIR):
+        os.mkdir(FIG_DIR)
+    return os.path.join(FIG_DIR, fname)
 
-par_set_with = Meijaard2007ParameterSet(bike_with_rider, True)
-model_with = SteerControlModel(par_set_with)
 
 # FIGURE : Geometry and mass distribution
-fig, axes = plt.subplots(1, 2, sharey=True, layout='constrained')
-fig.set_size_inches((160/25.4, 160/25.4/golden_ratio))
-par_set_without.plot_all(ax=axes[0])
-par_set_with.plot_all(ax=axes[1])
-fig.savefig(os.path.join(FIG_DIR, 'bicycle-with-geometry-mass.png'), dpi=300)
+def plot_geometry_mass():
+    import matplotlib.pyplot as plt
+    from scipy.constants import golden_ratio
 
-speeds = np.linspace(0.0, 10.0, num=2001)
+    fig, axes = plt.subplots(1, 2, sharey=True, layout='constrained')
+    fig.set_size_inches((160/25.4, 160/25.4/golden_ratio))
+    load_models()[False][0].plot_all(ax=axes[0])
+    load_models()[True][0].plot_all(ax=axes[1])
+    with instrument.span('savefig'):
+        fig.savefig(_figure_path('bicycle-with-geometry-mass.png'), dpi=300)
 
 
 # control law
@@ -55,6 +135,9 @@ def generate_gains(static_gain):
 
 # FIGURE : Plot the roll rate gains versus speed.
 def plot_gains_vs_speed():
+    import matplotlib.pyplot as plt
+    from scipy.constants import golden_ratio
+
     fig, ax = plt.subplots(layout='constrained')
     fig.set_size_inches((80/25.4, 80/25.4/golden_ratio))
     ax.plot(speeds, generate_gains(GAIN_MAP[8]),
@@ -63,31 +146,134 @@ def plot_gains_vs_speed():
             label=f"Gain {GAIN_MAP[10]}")
     ax.set_ylabel(r'$k_\dot{\phi}$')
     ax.legend()
-    fig.savefig(os.path.join(FIG_DIR, 'gains-vs-speed.png'), dpi=300)
-
-
-plot_gains_vs_speed()
+    with instrument.span('savefig'):
+        fig.savefig(_figure_path('gains-vs-speed.png'), dpi=300)
 
 
 # FIGURE : Compare eigenvalues vs speed for uncontrolled.
 def stable_ranges(evals):
-    # TODO : This should return the indice after a rise and before a fall. It
-    # now always returns the indices after a rise or fall.
+    """Returns the first and last index of each run of stable eigenvalues.
+
+    evals : ndarray, shape(n, 4)
+        Eigenvalues at each of the n speeds.
+    """
     where_stable = np.all(evals.real < 0.0, axis=1)
     padded = np.hstack(([False], where_stable, [False]))
-    start_stop_idxs = np.flatnonzero(np.diff(padded))
-    return start_stop_idxs.reshape(-1, 2)
+    start_stop_idxs = np.flatnonzero(np.diff(padded)).reshape(-1, 2)
+    # the falling edge is found one past the last stable index
+    start_stop_idxs[:, 1] -= 1
+    return start_stop_idxs
 
 
-def plot_eig(ax, model, teensy_gain, kphidots=0.0, legend=False):
-    evals_, evecs_ = sort_eigenmodes(*model.calc_eigen(v=speeds,
-                                                       kphidot=kphidots))
-    weave_idx, capsize_idx = stable_ranges(evals_)[0]
-    weave_speed, capsize_speed = speeds[weave_idx], speeds[capsize_idx]
+def max_real_part(model, v, kphidots=0.0):
+    """Returns the largest real part of the closed loop eigenvalues.
+
+    model : SteerControlModel
+    v : float or ndarray, shape(n,)
+        Speed(s) to evaluate at.
+    kphidots : float or ndarray, shape(len(speeds),)
+        Constant roll rate gain or a gain schedule from ``generate_gains()``,
+        which is linearly interpolated between the values of ``speeds``.
+    """
+    if not np.isscalar(kphidots):
+        kphidots = np.interp(v, speeds, kphidots)
+    evals, _ = model.calc_eigen(v=v, kphidot=kphidots)
+    return np.max(evals.real, axis=-1)
+
+
+@instrument.instrumented('control.stability_boundaries')
+def stability_boundaries(model, kphidots=0.0, vmin=0.0, vmax=10.0, num=101,
+                         tol=1e-8):
+    """Returns the speeds bounding each stable speed interval, e.g. the weave
+    and capsize speeds.
+
+    model : SteerControlModel
+    kphidots : float or ndarray, shape(len(speeds),)
+        Constant roll rate gain or a gain schedule from ``generate_gains()``.
+    vmin, vmax : float
+        Speed range to search.
+    num : integer
+        Number of speeds in the bracketing grid, which must be fine enough
+        to not step over a whole stable or unstable interval.
+    tol : float
+        Absolute tolerance in m/s of the returned speeds.
+
+    Returns a shape(m, 2) array with the start and stop speed of each of the
+    m stable intervals. Intervals that reach ``vmin`` or ``vmax`` are bounded
+    by those speeds.
+    """
+    from scipy.optimize import brentq
+
+    grid = np.linspace(vmin, vmax, num=num)
+    # one batched eigenvalue solve to bracket each sign change
+    stable = max_real_part(model, grid, kphidots) < 0.0
+    padded = np.hstack(([False], stable, [False]))
+    start_stop_idxs = np.flatnonzero(np.diff(padded)).reshape(-1, 2)
+
+    def refine(idx):
+        if idx == 0 or idx == num:  # stable at the end of the range
+            return grid[min(idx, num - 1)]
+        return brentq(lambda v: max_real_part(model, v, kphidots),
+                      grid[idx - 1], grid[idx], xtol=tol)
+
+    return np.array([[refine(start), refine(stop)]
+                     for start, stop in start_stop_idxs]).reshape(-1, 2)
+
+
+def weave_capsize_speeds(rider, teensy_gain=None, use_cache=True):
+    """Returns the weave and capsize speeds in m/s, i.e. the bounds of the
+    first stable speed interval.
+
+    rider : boolean
+        True for the model with the rigid rider.
+    teensy_gain : integer, optional
+        Key of ``GAIN_MAP`` for the balance assist on, None for off.
+    use_cache : boolean
+        If True, the speeds are looked up in the eigenvalue cache by the
+        bicycle parameters and the gain schedule before the model is built.
+        Speeds computed by other versions of the code are not reused, see
+        ``CACHE_SALT``.
+    """
+    parameters = bike_with_rider if rider else bike_without_rider
+    kphidots = 0.0 if teensy_gain is None else generate_gains(
+        GAIN_MAP[teensy_gain])
+    cache = get_eigen_cache()
+    key = cache.make_key(parameters, 'weave_capsize_speeds',
+                         kphidots=kphidots, speeds=speeds)
+    cached = cache.get(key) if use_cache else None
+    if cached is None:
+        model = load_models()[rider][1]
+        boundaries = stability_boundaries(model, kphidots)[0]
+        cache.put(key, (boundaries,))
+    else:
+        boundaries = cached[0]
+    return boundaries[0], boundaries[1]
+
+
+def print_speeds(rider, teensy_gain=None, heading=None, use_cache=True):
+    """Prints the weave and capsize speeds of one panel of the six panel
+    figure."""
+    if heading is not None:
+        print(heading)
+        print("-"*len(heading))
+    if teensy_gain is not None:
+        print('Model gain: {}'.format(GAIN_MAP[teensy_gain]))
+    weave_speed, capsize_speed = weave_capsize_speeds(rider, teensy_gain,
+                                                      use_cache=use_cache)
     msg = 'Weave speed: {:1.2f} [m/s], {:1.1f} [km/h]'
     print(msg.format(weave_speed, weave_speed*MPS2KPH))
     msg = 'Capsize speed: {:1.2f} [m/s], {:1.1f} [km/h]'
     print(msg.format(capsize_speed, capsize_speed*MPS2KPH))
+
+
+def print_numbers(use_cache=True):
+    """Prints the weave and capsize speeds of all panels of the six panel
+    figure."""
+    for _, _, rider, teensy_gain, heading in PANELS:
+        print_speeds(rider, teensy_gain, heading=heading, use_cache=use_cache)
+
+
+def plot_eig(ax, model, teensy_gain, kphidots=0.0, legend=False):
     if teensy_gain == 10 or teensy_gain == 'both':
         ymin, ymax = -6.0, 12.0
         ax.axvline(6.0*KPH2MPS, ymin=ymin, ymax=ymax, color='black',
@@ -104,6 +290,7 @@ def plot_eig(ax, model, teensy_gain, kphidots=0.0, legend=False):
                                 hide_zeros=True, colors=['k']*4)
     ax.set_ylim((ymin, ymax))
     if legend:
+        from scipy.constants import golden_ratio
         # NOTE : Fake points to make legend work.
         ax.plot([40.0, 41.0], [40.0, 41.], color='black', marker='*',
                 linestyle='')
@@ -111,17 +298,18 @@ def plot_eig(ax, model, teensy_gain, kphidots=0.0, legend=False):
                    '_none', '_none', 'Real', '_none', '_none', '_none',
                    'Identified'],
                   fontsize=8,
-                  bbox_to_anchor=(1.6, 0.25),
-                  bbox_transform=fig.transFigure,
+                  bbox_to_anchor=(1.6/3, 0.25*4/(9*golden_ratio)),
+                  bbox_transform=ax.figure.transFigure,
                   loc='upper center',
                   ncol=6, labelspacing=0.0)
     return ax
 
 
 def create_six_panel():
+    import matplotlib.pyplot as plt
 
-    data8_fname = 'weave_eigenvalues_from_experiment_gain_8.csv'
-    data10_fname = 'weave_eigenvalues_from_experiment_gain_10.csv'
+    data_fnames = {8: 'weave_eigenvalues_from_experiment_gain_8.csv',
+                   10: 'weave_eigenvalues_from_experiment_gain_10.csv'}
     plot_fname = 'balance-assist-eig-vs-speeds.png'
 
     fig_six, axes = plt.subplots(3, 2, sharex=True, sharey=True)
@@ -129,107 +317,120 @@ def create_six_panel():
                             hspace=0.1)
     fig_six.set_size_inches((160/25.4, 160/25.4*3/4))
 
-    msg = 'Without rigid rider and balance assist off:'
-    print(msg)
-    print("-"*len(msg))
-    ax = plot_eig(axes[0, 0], model_without, 'both')
-    sax = ax.secondary_xaxis('top', functions=(lambda x: x*MPS2KPH,
-                                               lambda x: x*KPH2MPS))
-    sax.set_xlabel('Speed [km/h]')
-    ax.set_title('Without Rigid Rider', fontsize=10)
-    ax.set_ylabel('Assist Off\nEig. Comp. [1/s]', fontsize=8)
-    ax.set_xlabel('')
-
-    msg = '\nWithout rigid rider and balance assist on:'
-    print(msg)
-    print("-"*len(msg))
-    print('Model gain: {}'.format(GAIN_MAP[8]))
-    kphidots = generate_gains(GAIN_MAP[8])
-    ax = plot_eig(axes[1, 0], model_without, 8, kphidots=kphidots, legend=True)
-    weave_eig = np.loadtxt(os.path.join(DAT_DIR, data8_fname), delimiter=',',
-                           skiprows=1)
-    ax.plot(weave_eig[:, 0], weave_eig[:, 1], color='black', marker='*',
-            linestyle='')
-    ax.plot(weave_eig[:, 0], weave_eig[:, 2], color='black', marker='*',
-            linestyle='')
-    ax.set_ylabel(f'Assist On, $\kappa={GAIN_MAP[8]}$\nEig. Comp. [1/s]',
-                  fontsize=8)
-    ax.set_xlabel('')
-
-    msg = '\nWithout rigid rider and balance assist on:'
-    print(msg)
-    print("-"*len(msg))
-    print('Model gain: {}'.format(GAIN_MAP[10]))
-    kphidots = generate_gains(GAIN_MAP[10])
-    ax = plot_eig(axes[2, 0], model_without, 10, kphidots=kphidots)
-    weave_eig = np.loadtxt(os.path.join(DAT_DIR, data10_fname), delimiter=',',
-                           skiprows=1)
-    ax.plot(weave_eig[:, 0], weave_eig[:, 1], color='black', marker='*',
-            linestyle='')
-    ax.plot(weave_eig[:, 0], weave_eig[:, 2], color='black', marker='*',
-            linestyle='')
-    ax.set_ylabel(f'Assist On, $\kappa={GAIN_MAP[10]}$\nEig. Comp. [1/s]',
-                  fontsize=8)
-    ax.set_xlabel('Speed [m/s]')
-
-    msg = '\nWith rigid rider and balance assist off:'
-    print(msg)
-    print("-"*len(msg))
-    ax = plot_eig(axes[0, 1], model_with, 'both')
-    sax = ax.secondary_xaxis('top', functions=(lambda x: x*MPS2KPH,
-                                               lambda x: x*KPH2MPS))
-    sax.set_xlabel('Speed [km/h]')
-    ax.set_title('With Rigid Rider', fontsize=10)
-    ax.set_ylabel('')
-    ax.set_xlabel('')
-
-    msg = '\nWith rigid rider and balance assist on:'
-    print(msg)
-    print("-"*len(msg))
-    print('Model gain: {}'.format(GAIN_MAP[8]))
-    kphidots = generate_gains(GAIN_MAP[8])
-    ax = plot_eig(axes[1, 1], model_with, 8, kphidots=kphidots)
-    ax.set_ylabel('')
-    ax.set_xlabel('')
-
-    msg = '\nWith rigid rider and balance assist on:'
-    print(msg)
-    print("-"*len(msg))
-    print('Model gain: {}'.format(GAIN_MAP[10]))
-    kphidots = generate_gains(GAIN_MAP[10])
-    ax = plot_eig(axes[2, 1], model_with, 10, kphidots=kphidots)
-    ax.set_ylabel('')
-    ax.set_xlabel('Speed [m/s]')
-
-    fig_six.savefig(os.path.join(FIG_DIR, plot_fname), dpi=300)
-
-
-create_six_panel()
+    for row, col, rider, teensy_gain, heading in PANELS:
+        print_speeds(rider, teensy_gain, heading=heading)
+        model = load_models()[rider][1]
+        if teensy_gain is None:
+            ax = plot_eig(axes[row, col], model, 'both')
+            sax = ax.secondary_xaxis('top', functions=(lambda x: x*MPS2KPH,
+                                                       lambda x: x*KPH2MPS))
+            sax.set_xlabel('Speed [km/h]')
+            ax.set_title('With Rigid Rider' if rider else
+                         'Without Rigid Rider', fontsize=10)
+        else:
+            kphidots = generate_gains(GAIN_MAP[teensy_gain])
+            ax = plot_eig(axes[row, col], model, teensy_gain,
+                          kphidots=kphidots,
+                          legend=(row, col) == (1, 0))
+        if not rider and teensy_gain is not None:
+            weave_eig = np.loadtxt(os.path.join(DAT_DIR,
+                                                data_fnames[teensy_gain]),
+                                   delimiter=',', skiprows=1)
+            ax.plot(weave_eig[:, 0], weave_eig[:, 1], color='black',
+                    marker='*', linestyle='')
+            ax.plot(weave_eig[:, 0], weave_eig[:, 2], color='black',
+                    marker='*', linestyle='')
+        if rider:
+            ax.set_ylabel('')
+        elif teensy_gain is None:
+            ax.set_ylabel('Assist Off\nEig. Comp. [1/s]', fontsize=8)
+        else:
+            ax.set_ylabel('Assist On, $\\kappa={}$\nEig. Comp. [1/s]'.format(
+                GAIN_MAP[teensy_gain]), fontsize=8)
+        ax.set_xlabel('Speed [m/s]' if row == 2 else '')
+
+    with instrument.span('savefig'):
+        fig_six.savefig(_figure_path(plot_fname), dpi=300)
+
+
+def simulation_inputs():
+    """Returns the times, initial conditions and keyword arguments of the
+    saturated simulation at 6 km/h."""
+    idx = np.argmin(np.abs(speeds - 6.0*KPH2MPS))  # 6 km/h
+    kphidots = generate_gains(10)
+    # NOTE : The roll rate controller saturates at a steer torque of 7 Nm.
+    times = np.linspace(0.0, 10.0, num=1001)
+    x0 = np.deg2rad([10.0, -10.0, 0.0, 0.0])
+    return times, x0, dict(max_torque=7.0, v=speeds[idx],
+                           kphidot=kphidots[idx])
+
 
 # FIGURE : Simulate an initial value problem at a low speed under control.
-idx = np.argmin(np.abs(speeds - 6.0*KPH2MPS))  # 6 km/h
-kphidots = generate_gains(10)
-print('kphidot @ 6 km/h:', kphidots[idx])
-
-
-def controller(t, x):
-    K = np.array([[0.0, 0.0, 0.0, 0.0],
-                  [0.0, 0.0, kphidots[idx], 0.0]])
-    torques = -K@x
-    if np.abs(torques[1]) >= 7.0:
-        torques[1] = np.sign(torques[1])*7.0
-    return torques
-
-
-times = np.linspace(0.0, 10.0, num=1001)
-x0 = np.deg2rad([10.0, -10.0, 0.0, 0.0])
-axes = model_without.plot_simulation(times, x0, input_func=controller,
-                                     v=speeds[idx])
-axes[0].set_title(r'$v$ = {:1.2f} [m/s]'.format(speeds[idx]))
-axes[0].set_ylabel('Torque\n[Nm]')
-axes[1].set_ylabel('Angle\n[deg]')
-axes[2].set_ylabel('Angular Rate\n[deg/s]')
-fig = axes[0].figure
-fig.set_size_inches((6.0, 6.0/golden_ratio))
-fig.tight_layout()
-fig.savefig(os.path.join(FIG_DIR, 'pd-simulation.png'), dpi=300)
+def plot_pd_simulation():
+    from scipy.constants import golden_ratio
+
+    times, x0, kwargs = simulation_inputs()
+    print('kphidot @ 6 km/h:', kwargs['kphidot'])
+
+    model_without = load_models()[False][1]
+    axes = model_without.plot_saturated_simulation(times, x0, **kwargs)
+    axes[0].set_title(r'$v$ = {:1.2f} [m/s]'.format(kwargs['v']))
+    axes[0].set_ylabel('Torque\n[Nm]')
+    axes[1].set_ylabel('Angle\n[deg]')
+    axes[2].set_ylabel('Angular Rate\n[deg/s]')
+    fig = axes[0].figure
+    fig.set_size_inches((6.0, 6.0/golden_ratio))
+    fig.tight_layout()
+    with instrument.span('savefig'):
+        fig.savefig(_figure_path('pd-simulation.png'), dpi=300)
+
+
+def precompute():
+    """Computes the eigenvalue sweeps, stability boundaries and simulation
+    of the figures into the eigenvalue cache, so that the figures only have
+    to be drawn, e.g. by several processes that share the results."""
+    for _, _, rider, teensy_gain, _ in PANELS:
+        weave_capsize_speeds(rider, teensy_gain)
+        kphidots = 0.0 if teensy_gain is None else generate_gains(
+            GAIN_MAP[teensy_gain])
+        load_models()[rider][1].calc_eigen_sweep(v=speeds, kphidot=kphidots)
+    times, x0, kwargs = simulation_inputs()
+    load_models()[False][1].simulate_saturated(times, x0, **kwargs)
+
+
+FIGURES = {
+    'geometry': plot_geometry_mass,
+    'gains': plot_gains_vs_speed,
+    'eig': create_six_panel,
+    'simulation': plot_pd_simulation,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Write the timings of the stages to this JSON '
+                        'file, see instrument.py.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('all', help='All figures, the default.')
+    for name in FIGURES:
+        subparsers.add_parser(name, help='Only the {} figure.'.format(name))
+    numbers = subparsers.add_parser(
+        'numbers', help='Print the weave and capsize speeds without plotting.')
+    numbers.add_argument('--no-cache', action='store_true',
+                         help='Recompute the speeds with the models.')
+    args = parser.parse_args(argv)
+    if args.profile:
+        instrument.enable(args.profile)
+
+    if args.command == 'numbers':
+        print_numbers(use_cache=not args.no_cache)
+    else:
+        names = [args.command] if args.command in FIGURES else FIGURES
+        for name in names:
+            with instrument.span('figure.' + name):
+                FIGURES[name]()
+
+
+if __name__ == '__main__':
+    main()
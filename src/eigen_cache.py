@@ -0,0 +1,175 @@
+"""Content addressed cache for the eigenvalue sweeps and simulations of
+SteerControlModel."""
+import collections
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+def source_hash(paths, versions=()):
+    """Returns a hex digest of the contents of source files and of version
+    strings, e.g. of the dependencies, for the ``salt`` of an EigenCache."""
+    hasher = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            hasher.update(hashlib.sha256(f.read()).digest())
+    for version in versions:
+        hasher.update(version.encode())
+    return hasher.hexdigest()
+
+
+class EigenCache(object):
+    """Least recently used cache of eigenvalue results held in memory and,
+    optionally, as ``.npz`` files on disk.
+
+    Parameters
+    ==========
+    directory : string, optional
+        Directory to store the ``.npz`` files in. If None, results are only
+        kept in memory.
+    maxsize : integer, optional
+        Maximum number of results kept in memory.
+    max_disk_bytes : integer, optional
+        Maximum total size of the ``.npz`` files. The least recently used
+        files are deleted when this is exceeded.
+    salt : string, optional
+        Added to every key. It should identify the code that computes the
+        results, e.g. ``source_hash()`` of its modules, so that results of
+        other versions of the code stored in the same directory are not
+        returned.
+
+    Notes
+    =====
+    Keys are SHA-256 hashes of the salt, the model's parameter values, the
+    name of the computation, and the overridden parameter values (see
+    ``make_key()``), so a changed parameter set, sweep or code never returns a
+    stale result.
+
+    """
+
+    def __init__(self, directory=None, maxsize=32,
+                 max_disk_bytes=256*1024*1024, salt=''):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.max_disk_bytes = max_disk_bytes
+        self.salt = salt
+        self._memory = collections.OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def make_key(self, parameters, name, **overrides):
+        """Returns a hex digest that identifies a computation.
+
+        Parameters
+        ==========
+        parameters : dictionary
+            Model parameters, e.g. ``model.parameter_set.parameters``.
+        name : string
+            Name of the computation, e.g. ``'calc_eigen'``.
+        **overrides : dictionary
+            Keys that map to floats or array_like of floats.
+
+        """
+        hasher = hashlib.sha256(self.salt.encode())
+        hasher.update(name.encode())
+        for label, items in (('parameters', parameters),
+                             ('overrides', overrides)):
+            hasher.update(label.encode())
+            for key in sorted(items):
+                val = np.ascontiguousarray(items[key], dtype=float)
+                hasher.update(key.encode())
+                hasher.update(str(val.shape).encode())
+                hasher.update(val.tobytes())
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """Returns a tuple of copies of the cached arrays or None if the key
+        is not cached."""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return tuple(a.copy() for a in self._memory[key])
+        if self.directory is not None and os.path.exists(self._path(key)):
+            path = self._path(key)
+            with np.load(path) as data:
+                arrays = tuple(data['arr_{}'.format(i)]
+                               for i in range(len(data.files)))
+            os.utime(path)  # mark as recently used
+            self._remember(key, arrays)
+            return tuple(a.copy() for a in arrays)
+        return None
+
+    def put(self, key, arrays):
+        """Stores a sequence of arrays under the key."""
+        arrays = tuple(np.array(a) for a in arrays)
+        self._remember(key, arrays)
+        if self.directory is not None:
+            # write to a temporary file first so that concurrent readers
+            # never see a partial file
+            fd, tmp_path = tempfile.mkstemp(suffix='.part',
+                                            dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, *arrays)
+            os.replace(tmp_path, self._path(key))
+            self._evict_disk()
+
+    def dump(self, directory):
+        """Writes the results held in memory to ``.npy`` files in a
+        directory, see ``load()``."""
+        os.makedirs(directory, exist_ok=True)
+        for key, arrays in self._memory.items():
+            for i, a in enumerate(arrays):
+                np.save(os.path.join(directory, '{}_{}.npy'.format(key, i)), a)
+
+    def load(self, directory, mmap_mode='r'):
+        """Adds the results written by ``dump()`` to the memory of this
+        cache.
+
+        Parameters
+        ==========
+        directory : string
+        mmap_mode : string, optional
+            Passed to ``numpy.load()``. With the default, the arrays are
+            memory mapped, so processes that load the same directory share
+            the pages of the files instead of each holding a copy.
+
+        """
+        arrays = collections.defaultdict(dict)
+        for fname in os.listdir(directory):
+            if fname.endswith('.npy'):
+                key, i = fname[:-len('.npy')].rsplit('_', 1)
+                arrays[key][int(i)] = np.load(os.path.join(directory, fname),
+                                              mmap_mode=mmap_mode)
+        for key, items in arrays.items():
+            self._remember(key, tuple(items[i] for i in sorted(items)))
+
+    def clear(self):
+        """Removes all cached results from memory and disk."""
+        self._memory.clear()
+        if self.directory is not None:
+            for fname in os.listdir(self.directory):
+                if fname.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, fname))
+
+    def _remember(self, key, arrays):
+        self._memory[key] = arrays
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self):
+        entries = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, fname))
+                entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(os.path.join(self.directory, fname))
+            total -= size
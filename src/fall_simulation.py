@@ -0,0 +1,263 @@
+"""Monte Carlo simulation of handlebar perturbations applied to a
+SteerControlModel to predict fall probabilities that can be compared with the
+``fall`` column of ``data/all_perturbations_*.csv``."""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from generate_time_series_imgs import (HANLDEBAR_LENGTH, PULSE_DURATION,
+                                       TRACKING_FORCE)
+
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def sample_trials(table, num_trials, rng, impulse_spread, angle_scales):
+    """Returns randomly sampled perturbation torques and initial conditions
+    that follow the rows of a table of recorded perturbations.
+
+    Parameters
+    ==========
+    table : pandas.DataFrame
+        Rows of one of the ``all_perturbations_*.csv`` tables, e.g. those of
+        one balance assist state.
+    num_trials : integer
+        Number of trials to sample.
+    rng : numpy.random.Generator
+    impulse_spread : float
+        Relative standard deviation of the delivered pulse with respect to
+        the commanded pulse. The commanded torque of each trial is scaled by
+        ``1 + impulse_spread*angular_impulse`` of the same recorded row.
+    angle_scales : tuple of floats
+        Roll and steer angle [deg] of one unit of the centered and scaled
+        ``roll_angle`` and ``steer_angle`` columns.
+
+    Returns
+    =======
+    torques : ndarray, shape(num_trials,)
+        Steer torque of the pulse [Nm].
+    initial_conditions : ndarray, shape(num_trials, 4)
+        Initial roll angle, steer angle, roll rate and steer rate [rad,
+        rad/s].
+
+    Notes
+    =====
+    Rows are drawn with replacement, so the force magnitudes, their sense,
+    the angular impulse and the initial angles keep their joint distribution.
+    The ``angular_impulse``, ``roll_angle`` and ``steer_angle`` columns are
+    centered and scaled per participant, so only the relative spread is
+    available and ``impulse_spread`` and ``angle_scales`` set the physical
+    scale. The tables do not hold these scales, they are the standard
+    deviations per participant that ``features.feature_table()`` divides by:
+    of ``angular_impulse`` relative to its mean and of ``roll_angle`` and
+    ``steer_angle`` in degrees, computed from the session time series with
+    ``features.perturbation_features()``.
+
+    """
+    rows = table.iloc[rng.integers(len(table), size=num_trials)]
+    desforce13 = rows['desforce13'].to_numpy(dtype=float)
+    desforce24 = rows['desforce24'].to_numpy(dtype=float)
+
+    # same geometry as calculate_torque_on_handlebars()
+    torques = (desforce24 - desforce13)*2*(HANLDEBAR_LENGTH/2)
+    torques *= 1.0 + impulse_spread*rows['angular_impulse'].to_numpy()
+
+    # the recorded angles are normalized to the perturbation direction, see
+    # get_perturbations()
+    sense = np.where(desforce24 > TRACKING_FORCE, -1.0, 1.0)
+    initial_conditions = np.zeros((num_trials, 4))
+    initial_conditions[:, 0] = np.deg2rad(
+        angle_scales[0]*sense*rows['roll_angle'].to_numpy())
+    initial_conditions[:, 1] = np.deg2rad(
+        angle_scales[1]*sense*rows['steer_angle'].to_numpy())
+
+    return torques, initial_conditions
+
+
+def simulate_trials(model, v, kphidot, torques, initial_conditions,
+                    duration=2.3, time_step=0.005, max_torque=7.0,
+                    fall_angle=np.deg2rad(15.0)):
+    """Returns whether each trial falls.
+
+    Parameters
+    ==========
+    model : SteerControlModel
+    v : ndarray, shape(n,)
+        Speed of each trial [m/s].
+    kphidot : ndarray, shape(n,)
+        Roll rate gain of the balance assist controller of each trial, zero
+        when the assist is off.
+    torques : ndarray, shape(n,)
+        Steer torque of the rectangular pulse [Nm], which is applied for
+        ``PULSE_DURATION`` seconds.
+    initial_conditions : ndarray, shape(n, 4)
+    duration : float, optional
+        Simulated time [s].
+    time_step : float, optional
+        Fixed Runge-Kutta step [s], which should divide ``PULSE_DURATION``.
+    max_torque : float, optional
+        Saturation of the balance assist steer torque [Nm].
+    fall_angle : float, optional
+        A trial falls when the magnitude of the roll angle exceeds this [rad].
+
+    Returns
+    =======
+    fell : ndarray, shape(n,)
+        Boolean array.
+    max_roll : ndarray, shape(n,)
+        Largest magnitude of the roll angle [rad].
+
+    Notes
+    =====
+    All n trials are integrated at once as a stacked state array with the
+    classic fourth order Runge-Kutta method.
+
+    """
+    zeros = np.zeros_like(v)
+    A, B = model.form_state_space_matrices(v=v, kphi=zeros, kdelta=zeros,
+                                           kphidot=zeros, kdeltadot=zeros)
+    # NOTE : The trial axis is last so each operation is over contiguous
+    # rows of n values.
+    A = np.ascontiguousarray(np.moveaxis(A, 0, -1))
+    b = np.ascontiguousarray(B[:, :, 1].T)
+
+    def rhs(x, pulse):
+        assist = np.clip(-kphidot*x[2], -max_torque, max_torque)
+        return np.einsum('ijn,jn->in', A, x) + b*(assist + pulse)
+
+    num_steps = int(round(duration/time_step))
+    num_pulse_steps = int(round(PULSE_DURATION/time_step))
+
+    x = np.array(initial_conditions, dtype=float).T
+    max_roll = np.abs(x[0])
+    for i in range(num_steps):
+        pulse = torques if i < num_pulse_steps else zeros
+        k1 = rhs(x, pulse)
+        k2 = rhs(x + time_step/2*k1, pulse)
+        k3 = rhs(x + time_step/2*k2, pulse)
+        k4 = rhs(x + time_step*k3, pulse)
+        x = x + time_step/6*(k1 + 2*k2 + 2*k3 + k4)
+        np.maximum(max_roll, np.abs(x[0]), out=max_roll)
+
+    return max_roll > fall_angle, max_roll
+
+
+def _simulate_chunk(args, model=None):
+    if model is None:
+        model = _worker_model
+    v, kphidot, torques, initial_conditions, kwargs = args
+    return simulate_trials(model, v, kphidot, torques, initial_conditions,
+                           **kwargs)[0]
+
+
+def fall_probability(model, tables, kphidots, impulse_spread, angle_scales,
+                     num_trials=10000, seed=None, chunk_size=2000,
+                     processes=None, **kwargs):
+    """Returns the model predicted fall probability for each speed with the
+    balance assist off and on.
+
+    Parameters
+    ==========
+    model : SteerControlModel
+    tables : dictionary
+        Maps speed [m/s] to the ``all_perturbations_*.csv`` table recorded
+        at that speed.
+    kphidots : dictionary
+        Maps speed [m/s] to the roll rate gain with the balance assist on.
+    impulse_spread, angle_scales
+        See ``sample_trials()``.
+    num_trials : integer, optional
+        Number of trials per speed and assist state.
+    seed : integer, optional
+        Seed of the random number generator. All trials are sampled before
+        they are distributed, so the result does not depend on the number of
+        processes.
+    chunk_size : integer, optional
+        Number of trials integrated at once.
+    processes : integer, optional
+        Number of worker processes, defaults to the number of CPUs. If 1,
+        the chunks are simulated in this process.
+    **kwargs
+        Passed to ``simulate_trials()``.
+
+    Returns
+    =======
+    pandas.DataFrame
+        With the columns ``speed``, ``balance_assist``, ``trials``, ``falls``
+        and ``fall_probability``. The trials of each balance assist state are
+        sampled from the recorded perturbations with that state.
+
+    """
+    rng = np.random.default_rng(seed)
+
+    conditions, v, kphidot, torques, initial_conditions = [], [], [], [], []
+    for speed, table in tables.items():
+        for balance_assist in (0, 1):
+            recorded = table[table['balance_assist'].astype(int) ==
+                             balance_assist]
+            if recorded.empty:
+                raise ValueError('No perturbations with balance_assist = {} '
+                                 'at {} m/s.'.format(balance_assist, speed))
+            torques_i, initial_conditions_i = sample_trials(
+                recorded, num_trials, rng, impulse_spread, angle_scales)
+            conditions.append((speed, balance_assist))
+            v.append(np.full(num_trials, speed))
+            kphidot.append(np.full(num_trials,
+                                   kphidots[speed] if balance_assist else 0.0))
+            torques.append(torques_i)
+            initial_conditions.append(initial_conditions_i)
+    v, kphidot = np.hstack(v), np.hstack(kphidot)
+    torques, initial_conditions = np.hstack(torques), np.vstack(
+        initial_conditions)
+
+    chunks = [(v[s], kphidot[s], torques[s], initial_conditions[s], kwargs)
+              for s in (slice(start, start + chunk_size)
+                        for start in range(0, len(v), chunk_size))]
+
+    if processes is None:
+        processes = os.cpu_count()
+
+    if processes == 1 or len(chunks) == 1:
+        results = [_simulate_chunk(chunk, model=model) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_worker,
+                                 initargs=(model,)) as executor:
+            results = list(executor.map(_simulate_chunk, chunks))
+    fell = np.hstack(results).reshape(len(conditions), num_trials)
+
+    return pd.DataFrame({
+        'speed': [speed for speed, _ in conditions],
+        'balance_assist': [assist for _, assist in conditions],
+        'trials': num_trials,
+        'falls': fell.sum(axis=1),
+        'fall_probability': fell.mean(axis=1),
+    })
+
+
+def observed_fall_probability(tables):
+    """Returns the recorded fall probability for each speed with the balance
+    assist off and on in the same form as ``fall_probability()``.
+
+    Parameters
+    ==========
+    tables : dictionary
+        Maps speed [m/s] to the ``all_perturbations_*.csv`` table recorded
+        at that speed.
+
+    """
+    rows = []
+    for speed, table in tables.items():
+        for balance_assist, group in table.groupby('balance_assist'):
+            rows.append({'speed': speed,
+                         'balance_assist': int(balance_assist),
+                         'trials': len(group),
+                         'falls': int(group['fall'].sum()),
+                         'fall_probability': group['fall'].mean()})
+    return pd.DataFrame(rows)
@@ -0,0 +1,284 @@
+"""Builds the per-perturbation feature table of ``data/all_perturbations_*.csv``
+from session time series with segmented reductions over the window offsets."""
+import csv
+
+import numpy as np
+import pandas as pd
+
+from generate_time_series_imgs import DESIRED_FORCES, ImpulseEngine
+
+FORCES = ["force1", "force2", "force3", "force4"]
+FORCE_STATS = ["mean", "max", "min", "median"]
+STATES = ["roll_angle", "roll_rate", "roll_acc", "steer_angle", "steer_rate"]
+# columns that are centered and scaled per participant
+SCALED = ["X", "roll_angle", "roll_rate", "steer_angle", "steer_rate",
+          "angular_impulse"]
+# columns written as quoted factors
+FACTORS = ["balance_assist", "direction", "start_with_on"]
+# columns computed from the time series
+SIGNAL_COLUMNS = (
+    ["seconds_since_start"]
+    + STATES
+    + DESIRED_FORCES
+    + [f"{force}_{stat}" for force in FORCES for stat in FORCE_STATS]
+    + ["angular_impulse", "angular_impulse_controller", "direction"]
+)
+FEATURE_COLUMNS = (
+    ["X", "seconds_since_start", "balance_assist"]
+    + SIGNAL_COLUMNS[1:]
+    + ["fall", "participant_id", "start_with_on"]
+)
+
+
+def segment_indices(starts, stops):
+    """Returns the positions of all samples in the segments [start, stop) and the
+    segment number and offset of each.
+
+    Parameters
+    ----------
+    starts : numpy.ndarray of int
+        First position of each segment.
+    stops : numpy.ndarray of int
+        Position after the last sample of each segment.
+
+    Returns
+    -------
+    positions : numpy.ndarray of int
+        Positions of the samples of all segments, concatenated.
+    segment_ids : numpy.ndarray of int
+        Segment number of each position.
+    offsets : numpy.ndarray of int
+        Index in `positions` at which each segment begins.
+    """
+    lengths = stops - starts
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    segment_ids = np.repeat(np.arange(len(starts)), lengths)
+    positions = np.arange(lengths.sum()) - offsets[segment_ids] + starts[segment_ids]
+    return positions, segment_ids, offsets
+
+
+def segment_stats(values, segment_ids, offsets):
+    """Returns the mean, max, min and median of each segment of each row.
+
+    Parameters
+    ----------
+    values : numpy.ndarray, shape(n_channels, n)
+        Concatenated samples of the segments.
+    segment_ids : numpy.ndarray of int, shape(n,)
+    offsets : numpy.ndarray of int, shape(n_segments,)
+
+    Returns
+    -------
+    dict
+        Maps the statistic name to an array of shape(n_channels, n_segments), NaN
+        for the empty segments.
+    """
+    lengths = np.diff(np.append(offsets, values.shape[1]))
+    stats = {
+        name: np.full((values.shape[0], len(offsets)), np.nan)
+        for name in ["mean", "max", "min", "median"]
+    }
+    # reduceat() returns the next sample for an empty segment, so only the
+    # non-empty segments are reduced
+    filled = lengths > 0
+    if not filled.any():
+        return stats
+    starts = offsets[filled]
+    stats["mean"][:, filled] = np.add.reduceat(values, starts, axis=1) / lengths[filled]
+    stats["max"][:, filled] = np.maximum.reduceat(values, starts, axis=1)
+    stats["min"][:, filled] = np.minimum.reduceat(values, starts, axis=1)
+    # sorting by segment and then value puts the middle of each segment at a fixed
+    # offset
+    lower = starts + (lengths[filled] - 1) // 2
+    upper = starts + lengths[filled] // 2
+    for k, row in enumerate(values):
+        ordered = row[np.lexsort((row, segment_ids))]
+        stats["median"][k, filled] = 0.5 * (ordered[lower] + ordered[upper])
+    return stats
+
+
+def perturbation_features(perturbations):
+    """Returns the features of each perturbation that can be computed from the time
+    series.
+
+    The peak desired forces, the force statistics and the angular impulses are taken
+    over the detected block of each perturbation, from its start until the sample at
+    which the desired force is back at the tracking force (exclusive).
+
+    Parameters
+    ----------
+    perturbations : PerturbationSet
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per perturbation with ``seconds_since_start``, the direction
+        normalized states at the start, the peak desired forces, the force statistics,
+        ``angular_impulse``, ``angular_impulse_controller`` and ``direction``. The
+        angular impulses are positive in the sense of the perturbation and
+        ``angular_impulse_controller`` is NaN for sessions without ``motor_current``.
+        The columns are those of ``all_perturbations_*.csv``, but the published
+        ``angular_impulse_controller`` is not the impulse of the motor torque over the
+        block computed here, it is nonzero with the balance assist off.
+    """
+    table = pd.DataFrame(
+        np.nan, index=range(len(perturbations)), columns=SIGNAL_COLUMNS
+    )
+    table["seconds_since_start"] = perturbations.start_times
+    # 1 for the perturbations applied with desforce13, whose sign is 1
+    table["direction"] = (perturbations.signs > 0).astype(int)
+
+    for columns, values, windows in perturbations.sessions():
+        if len(windows) == 0:
+            continue
+        channel = {name: values[k] for k, name in enumerate(columns)}
+        times = channel["seconds_since_start"]
+        start_times = perturbations.start_times[windows]
+        signs = perturbations.signs[windows]
+
+        starts = np.searchsorted(times, start_times)
+        stops = np.searchsorted(times, perturbations.stop_times[windows])
+        positions, segment_ids, offsets = segment_indices(starts, stops)
+
+        for name in STATES:
+            if name in channel:
+                table.loc[windows, name] = signs * channel[name][starts]
+            elif name == "roll_acc" and "roll_rate" in channel:
+                rates = channel["roll_rate"]
+                later = np.minimum(starts + 1, len(times) - 1)
+                table.loc[windows, name] = signs * (
+                    (rates[later] - rates[starts]) / (times[later] - times[starts])
+                )
+
+        peaks = segment_stats(
+            np.vstack([channel[name][positions] for name in DESIRED_FORCES]),
+            segment_ids,
+            offsets,
+        )["max"]
+        for k, name in enumerate(DESIRED_FORCES):
+            table.loc[windows, name] = peaks[k]
+
+        forces = np.vstack([channel[name][positions] for name in FORCES])
+        stats = segment_stats(forces, segment_ids, offsets)
+        for k, name in enumerate(FORCES):
+            for stat in FORCE_STATS:
+                table.loc[windows, f"{name}_{stat}"] = stats[stat][k]
+
+        engine = ImpulseEngine(channel)
+        table.loc[windows, "angular_impulse"] = -signs * engine.between_indices(
+            starts, stops
+        )
+        if "controller" in engine.torques:
+            table.loc[windows, "angular_impulse_controller"] = (
+                -signs * engine.between_indices(starts, stops, torque="controller")
+            )
+
+    check_direction(table)
+    return table
+
+
+def check_direction(table):
+    """Raises a ValueError if ``direction`` does not follow the encoding of
+    ``all_perturbations_*.csv``: 1 for the perturbations applied with ``desforce13``
+    and 0 for those applied with ``desforce24``, i.e. the desired force with the
+    larger peak."""
+    peaks = table[DESIRED_FORCES]
+    applied = peaks.notna().all(axis=1) & (peaks.iloc[:, 0] != peaks.iloc[:, 1])
+    expected = (table[DESIRED_FORCES[0]] > table[DESIRED_FORCES[1]]).astype(int)
+    wrong = applied & (table["direction"].astype(int) != expected)
+    if wrong.any():
+        raise ValueError(
+            "The direction of rows {} does not match their desired forces.".format(
+                list(table.index[wrong][:5])
+            )
+        )
+
+
+def check_columns(table, path):
+    """Raises a ValueError if a feature table does not have the columns of a
+    published table, in the same order, or uses other factor levels or another
+    ``direction`` encoding, see ``check_direction()``.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        Output of ``feature_table()``.
+    path : str
+        Path to one of the ``all_perturbations_*.csv`` tables.
+    """
+    published = pd.read_csv(path, index_col=0)
+    if list(table.columns) != list(published.columns):
+        raise ValueError(
+            "The columns {} do not match those of {}: {}.".format(
+                list(table.columns), path, list(published.columns)
+            )
+        )
+    for name in FACTORS:
+        levels = set(published[name].astype(int))
+        if not set(table[name].astype(int)) <= levels:
+            raise ValueError(
+                "The levels of {} are not among {} of {}.".format(name, levels, path)
+            )
+    check_direction(published)
+    check_direction(table)
+
+
+def feature_table(sessions):
+    """Returns the feature table with the columns of ``all_perturbations_*.csv``.
+
+    Parameters
+    ----------
+    sessions : List[dict]
+        One dictionary per session with the keys ``perturbations``
+        (PerturbationSet), ``participant_id``, ``balance_assist`` (0 or 1),
+        ``start_with_on`` (0 or 1) and ``fall`` (array_like with one 0 or 1 per
+        perturbation, NaN if unknown).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The perturbation order ``X`` counts the perturbations of each participant in
+        the order they were applied, the on session comes first if the participant
+        started with the balance assist on. ``X`` and the columns in ``SCALED`` are
+        centered and scaled per participant.
+    """
+    tables = []
+    for session in sessions:
+        table = perturbation_features(session["perturbations"])
+        table["participant_id"] = session["participant_id"]
+        table["balance_assist"] = session["balance_assist"]
+        table["start_with_on"] = session["start_with_on"]
+        table["fall"] = session.get("fall", np.nan)
+        # sessions applied first sort first within a participant
+        table["_first"] = int(session["balance_assist"] == session["start_with_on"])
+        tables.append(table)
+    table = pd.concat(tables, ignore_index=True)
+
+    table = table.sort_values(
+        ["participant_id", "_first", "seconds_since_start"],
+        ascending=[True, False, True],
+        kind="stable",
+    )
+    groups = table.groupby("participant_id")
+    table["X"] = groups.cumcount().astype(float)
+    for name in SCALED:
+        column = groups[name]
+        table[name] = (table[name] - column.transform("mean")) / column.transform("std")
+
+    return table[FEATURE_COLUMNS].reset_index(drop=True)
+
+
+def write_feature_table(table, path):
+    """Writes the table in the layout R's ``write.csv()`` used for
+    ``all_perturbations_*.csv``: a quoted row name column starting at 1 and quoted
+    factor columns."""
+    table = table.copy()
+    for name in FACTORS:
+        table[name] = table[name].astype(int).astype(str)
+    for name in ["fall", "participant_id"]:
+        if table[name].notna().all():
+            table[name] = table[name].astype(int)
+    table.index = np.arange(1, len(table) + 1).astype(str)
+    table.to_csv(
+        path, quoting=csv.QUOTE_NONNUMERIC, index_label="", float_format="%.15g"
+    )
@@ -1,9 +1,14 @@
+import argparse
+import functools
+import operator
 import os
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.fs
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
-from bisect import bisect_left
+import instrument
 
 EXAMPLE_DATA_OFF = os.path.join("data", "example_data_balance_assist_off.parquet")
 EXAMPLE_DATA_ON = os.path.join("data", "example_data_balance_assist_on.parquet")
@@ -12,6 +17,7 @@ DESIRED_FORCES = ["desforce13", "desforce24"]
 ALL_FORCES = ["force1", "force2", "force3", "force4"] + DESIRED_FORCES
 DURATION_BEFORE = 0.3
 DURATION_AFTER = 2.0
+PULSE_DURATION = 0.3  # duration of the commanded Bump'Em force pulse
 DIRECTORY = "figures"
 HANLDEBAR_LENGTH = 0.82
 BALANCE_ASSIST_MOTOR_CONSTANT = 5
@@ -19,30 +25,290 @@ KPH2MPS = 1000.0/3600.0
 MPS2KPH = 1.0/KPH2MPS
 
 
-def main():
+def main(argv=None):
     """Load example time series data from ./data and generate figures."""
-    data_on = pd.read_parquet(EXAMPLE_DATA_ON)
-    perturbation_dfs_on = get_perturbations(
-        data_on, DESIRED_FORCES, DURATION_BEFORE, DURATION_AFTER
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        help="Write the timings of the stages to this JSON file, see instrument.py.",
     )
-    data_off = pd.read_parquet(EXAMPLE_DATA_OFF)
-    perturbation_dfs_off = get_perturbations(
-        data_off, DESIRED_FORCES, DURATION_BEFORE, DURATION_AFTER
+    args = parser.parse_args(argv)
+    if args.profile:
+        instrument.enable(args.profile)
+
+    perturbation_dfs_on = load_perturbations(
+        EXAMPLE_DATA_ON, DURATION_BEFORE, DURATION_AFTER
+    )
+    perturbation_dfs_off = load_perturbations(
+        EXAMPLE_DATA_OFF, DURATION_BEFORE, DURATION_AFTER
     )
+    # NOTE : Joining the sets does not copy data, the dataframes of each window are
+    # created when a plot needs them.
     perturbation_dfs = perturbation_dfs_on + perturbation_dfs_off
     generate_torque_angle_plots(perturbation_dfs, DIRECTORY)
     generate_force_torque_plots(perturbation_dfs[:1], DIRECTORY, ALL_FORCES)
     generate_roll_steer_plots(perturbation_dfs, DIRECTORY)
 
 
+@instrument.instrumented("parquet.read")
+def read_session(path, columns=None, time_ranges=None, memory_map=False):
+    """Reads the requested columns and time ranges of a session parquet file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the parquet file.
+    columns : List[str], optional
+        Columns to read, all columns if None.
+    time_ranges : List[Tuple[float, float]], optional
+        Inclusive ranges of ``seconds_since_start`` to read, all rows if None. Row
+        groups whose ``seconds_since_start`` statistics fall outside of every range are
+        not read.
+    memory_map : bool, optional
+        If true, the file is memory-mapped instead of read into buffers.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The selected rows in file order with a new default index.
+    """
+    filesystem = pyarrow.fs.LocalFileSystem(use_mmap=memory_map)
+    dataset = ds.dataset(os.path.abspath(path), format="parquet", filesystem=filesystem)
+
+    row_filter = None
+    if time_ranges is not None:
+        time = ds.field("seconds_since_start")
+        row_filter = functools.reduce(
+            operator.or_,
+            [(time >= start) & (time <= stop) for start, stop in merge_ranges(time_ranges)],
+            ds.scalar(False),
+        )
+
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+
+def merge_ranges(ranges):
+    """Returns the sorted union of inclusive (start, stop) ranges."""
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return [tuple(r) for r in merged]
+
+
+@instrument.instrumented("perturbations.load")
+def load_perturbations(
+    path,
+    duration_before,
+    duration_after,
+    columns=None,
+    memory_map=False,
+):
+    """Returns the perturbations of a session parquet file while only reading the rows
+    inside the perturbation windows.
+
+    The first pass reads only ``seconds_since_start`` and the desired forces to find
+    the windows, the second pass reads just the time ranges of those windows. Peak
+    memory therefore scales with the number of perturbations instead of the length of
+    the session.
+
+    Parameters
+    ----------
+    path : str
+        Path to the parquet file.
+    duration_before : float
+        Duration in seconds before the perturbation is applied that should be included.
+    duration_after : float
+        Duration in seconds after the perurbation has ended that should be included.
+    columns : List[str], optional
+        Columns to include besides ``seconds_since_start`` and the desired forces, all
+        columns if None.
+    memory_map : bool, optional
+        If true, the file is memory-mapped.
+
+    Returns
+    -------
+    PerturbationSet
+        See ``get_perturbations()``.
+    """
+    index_columns = ["seconds_since_start"] + DESIRED_FORCES
+    forces = read_session(path, columns=index_columns, memory_map=memory_map)
+    start_indices, stop_indices = get_perturbation_indices(forces, DESIRED_FORCES)
+    context_starts, context_stops = get_context_around_perturbation(
+        forces, start_indices, stop_indices, duration_before, duration_after
+    )
+    times = forces["seconds_since_start"].to_numpy()
+    time_ranges = list(zip(times[context_starts], times[context_stops]))
+    del forces
+
+    if columns is not None:
+        columns = index_columns + [c for c in columns if c not in index_columns]
+    data = read_session(
+        path, columns=columns, time_ranges=time_ranges, memory_map=memory_map
+    )
+    return get_perturbations(data, DESIRED_FORCES, duration_before, duration_after)
+
+
+class PerturbationSet:
+    """Perturbation windows stored as views into one channel-major array per session.
+
+    The direction normalization of the steer, roll and gyro channels is stored as one
+    sign per window and is only applied when a channel or dataframe is requested. Sets
+    from different sessions can be joined with ``+`` without copying their arrays.
+    Indexing with an integer or iterating returns a new dataframe per window, indexing
+    with a slice returns a set that shares the arrays.
+
+    Parameters
+    ----------
+    columns : List[str]
+        Names of the channels, i.e. the rows of `values`.
+    values : numpy.ndarray, shape(n_channels, n_samples)
+        Time series of the session.
+    context_starts : array_like of int
+        Row position at which each window starts.
+    context_stops : array_like of int
+        Row position at which each window stops, exclusive.
+    start_times : array_like of float
+        Time at which each perturbation starts.
+    stop_times : array_like of float
+        Time of the first sample after each perturbation, at which the desired force
+        is back at the tracking force.
+    signs : array_like of float
+        -1 for windows whose steer, roll and gyro channels should be flipped, else 1.
+    """
+
+    def __init__(
+        self,
+        columns,
+        values,
+        context_starts,
+        context_stops,
+        start_times,
+        stop_times,
+        signs,
+    ):
+        self._sessions = [(list(columns), values)]
+        self._session_idxs = np.zeros(len(context_starts), dtype=int)
+        self.context_starts = np.asarray(context_starts, dtype=int)
+        self.context_stops = np.asarray(context_stops, dtype=int)
+        self.start_times = np.asarray(start_times, dtype=float)
+        self.stop_times = np.asarray(stop_times, dtype=float)
+        self.signs = np.asarray(signs, dtype=float)
+
+    def _subset(self, sessions, session_idxs, selection):
+        subset = PerturbationSet.__new__(PerturbationSet)
+        subset._sessions = sessions
+        subset._session_idxs = session_idxs[selection]
+        subset.context_starts = self.context_starts[selection]
+        subset.context_stops = self.context_stops[selection]
+        subset.start_times = self.start_times[selection]
+        subset.stop_times = self.stop_times[selection]
+        subset.signs = self.signs[selection]
+        return subset
+
+    def __len__(self):
+        return len(self.context_starts)
+
+    def __add__(self, other):
+        joined = self._subset(
+            self._sessions + other._sessions,
+            self._session_idxs,
+            slice(None),
+        )
+        joined._session_idxs = np.hstack(
+            (self._session_idxs, other._session_idxs + len(self._sessions))
+        )
+        for attr in [
+            "context_starts",
+            "context_stops",
+            "start_times",
+            "stop_times",
+            "signs",
+        ]:
+            setattr(joined, attr, np.hstack((getattr(self, attr), getattr(other, attr))))
+        return joined
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self._subset(self._sessions, self._session_idxs, i)
+        return self.to_dataframe(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.to_dataframe(i)
+
+    def sessions(self):
+        """Yields the channel names, the channel-major array and the window numbers of
+        each session in the set."""
+        for k, (columns, values) in enumerate(self._sessions):
+            yield columns, values, np.flatnonzero(self._session_idxs == k)
+
+    def columns(self, i):
+        """Returns the channel names of window `i`."""
+        return self._sessions[self._session_idxs[i]][0]
+
+    def window(self, i):
+        """Returns a view of all channels of window `i`, shape(n_channels, n)."""
+        _, values = self._sessions[self._session_idxs[i]]
+        return values[:, self.context_starts[i]:self.context_stops[i]]
+
+    def channel(self, i, name, normalize=True):
+        """Returns one channel of window `i`.
+
+        Parameters
+        ----------
+        i : int
+            Window number.
+        name : str
+            Channel name. ``seconds_since_start`` is returned relative to the start of
+            the perturbation.
+        normalize : bool
+            If true, the steer, roll and gyro channels are flipped to the normalized
+            direction.
+
+        Returns
+        -------
+        numpy.ndarray
+            A view into the session array if no arithmetic is needed.
+        """
+        values = self.window(i)[self.columns(i).index(name)]
+        if name == "seconds_since_start":
+            return values - self.start_times[i]
+        if normalize and is_direction_dependent(name) and self.signs[i] < 0:
+            return -values
+        return values
+
+    @instrument.instrumented("perturbations.to_dataframe")
+    def to_dataframe(self, i):
+        """Returns window `i` as a dataframe with the direction normalized columns and
+        the ``_original`` steer, roll and gyro columns."""
+        i = range(len(self))[i]
+        pert_data = {}
+        for var in self.columns(i):
+            if is_direction_dependent(var):
+                pert_data[var + "_original"] = self.channel(i, var, normalize=False)
+            pert_data[var] = self.channel(i, var)
+        index = pd.RangeIndex(self.context_starts[i], self.context_stops[i])
+        return pd.DataFrame(pert_data, index=index)
+
+
+def is_direction_dependent(var):
+    """Returns true if the sign of the channel depends on the perturbation direction."""
+    return "steer" in var or "roll" in var or "gyro" in var
+
+
+@instrument.instrumented("perturbations.windows")
 def get_perturbations(
     data,
     DESIRED_FORCES,
     duration_before,
     duration_after,
 ):
-    """Returns each perturbation in a new dataframe. Flips the direction of the
-    roll angle and steer rate such that there is no difference between clockwise
+    """Returns each perturbation as a window of a PerturbationSet. Flips the direction
+    of the roll angle and steer rate such that there is no difference between clockwise
     and counterclockwise.
 
     Parameters
@@ -58,60 +324,54 @@ def get_perturbations(
 
     Returns
     -------
-    df_list : List[pd.DataFrame]
-        List of dataframes where the direction is normalized for the perturbations.
+    PerturbationSet
+        Windows where the direction is normalized for the perturbations, each window
+        gives a dataframe when indexed. Only the numeric columns are kept.
     """
     start_indices, stop_indices = get_perturbation_indices(data, DESIRED_FORCES)
     context_start_indices, context_stop_indices = get_context_around_perturbation(
         data, start_indices, stop_indices, duration_before, duration_after
     )
 
-    perturbation_dfs = []
-    for i, _ in enumerate(start_indices):
-        start = start_indices[i]
-        context_start = context_start_indices[i]
-        context_stop = context_stop_indices[i]
-
-        pert_data = pd.DataFrame()
-        start_time = data.loc[start, "seconds_since_start"]
-        pert_data["seconds_since_start"] = (
-            data["seconds_since_start"][context_start:context_stop] - start_time
-        )
-
-        for var in data.columns.values:
-            if var == "seconds_since_start":
-                continue
-
-            if "steer" in var or "roll" in var or "gyro" in var:
-                pert_data[var + "_original"] = data[var][context_start:context_stop]
-                if data["desforce24"][start] > TRACKING_FORCE:
-                    pert_data[var] = -data[var][context_start:context_stop]
-                else:
-                    pert_data[var] = data[var][context_start:context_stop]
-            else:
-                pert_data[var] = data[var][context_start:context_stop]
-
-        perturbation_dfs.append(pert_data)
-
-    return perturbation_dfs
+    # one copy of the session, every window is a view into it
+    numeric = data.select_dtypes("number")
+    values = np.ascontiguousarray(numeric.to_numpy(dtype=float).T)
+
+    starts = data.index.get_indexer(start_indices)
+    times = data["seconds_since_start"].to_numpy()
+    start_times = times[starts]
+    stop_times = times[data.index.get_indexer(stop_indices)]
+    signs = np.where(data["desforce24"].to_numpy()[starts] > TRACKING_FORCE, -1.0, 1.0)
+
+    return PerturbationSet(
+        numeric.columns,
+        values,
+        context_start_indices,
+        context_stop_indices,
+        start_times,
+        stop_times,
+        signs,
+    )
 
 
+@instrument.instrumented("plot.torque_angle")
 def generate_torque_angle_plots(perturbations_dfs, directory):
     """Generates a plot showing the torque on the handlebars and the roll angle and rate,
     steer angle and desired torque of the balance-assist controller.
 
     Parameters
     ----------
-    perturbation_dfs : List[pandas.DataFrame]
-        A list of dataframes that contain the data to be plotted.
+    perturbation_dfs : PerturbationSet or List[pandas.DataFrame]
+        The dataframes that contain the data to be plotted.
     directory : str
         Name of the directory in which to store the generated images.
     """
     if not os.path.isdir(directory):
         os.mkdir(directory)
 
-    for i, df in enumerate(perturbations_dfs):
+    for i in range(len(perturbations_dfs)):
         if i == 10:  # only plot the figure we will use
+            df = perturbations_dfs[i]
             # print(df.columns.values)
             if "motor_current" in df.columns.values:
                 fig, axs = plt.subplots(5, 1, sharex=True,
@@ -228,19 +488,21 @@ def generate_torque_angle_plots(perturbations_dfs, directory):
 
             filename = os.path.join(directory,
                                     "torque_angle_perturbation_" + str(i))
-            fig.savefig(fname=filename, dpi=300) #, bbox_inches="tight")
+            with instrument.span("savefig"):
+                fig.savefig(fname=filename, dpi=300) #, bbox_inches="tight")
             print(f"Saved plot with name {filename}")
             plt.close()
 
 
+@instrument.instrumented("plot.force_torque")
 def generate_force_torque_plots(perturbation_dfs, directory, force_column_names):
     """Generates a plot showing the four forces on the handlebars and the torque
     applied by these four forces as a function of time.
 
     Parameters
     ----------
-    perturbation_dfs : List[pandas.DataFrame]
-        A list of dataframes that contain the data to be plotted.
+    perturbation_dfs : PerturbationSet or List[pandas.DataFrame]
+        The dataframes that contain the data to be plotted.
     directory : str
         Name of the directory in which to store the generated images.
     force_column_names : List[str]
@@ -286,18 +548,20 @@ def generate_force_torque_plots(perturbation_dfs, directory, force_column_names)
         axs[1].grid()
 
         filename = os.path.join(directory, "perturbation_" + str(i))
-        fig.savefig(fname=filename, dpi=300, bbox_inches="tight")
+        with instrument.span("savefig"):
+            fig.savefig(fname=filename, dpi=300, bbox_inches="tight")
         print(f"Saved plot with name {filename}")
         plt.close()
 
 
+@instrument.instrumented("plot.roll_steer")
 def generate_roll_steer_plots(perturbation_dfs, directory):
     """Plots all the perturbations in one plot.
 
     Parameters
     ----------
-    data : List[pd.DataFrame]
-        List of dataframes that should be plotted.
+    data : PerturbationSet or List[pd.DataFrame]
+        The dataframes that should be plotted.
     directory : str
         Name of the directory in which to store the generated images.
     """
@@ -349,7 +613,8 @@ def generate_roll_steer_plots(perturbation_dfs, directory):
     )
 
     filename = os.path.join(directory, "roll_steer_overlay")
-    fig.savefig(fname=filename, dpi=300, bbox_inches="tight")
+    with instrument.span("savefig"):
+        fig.savefig(fname=filename, dpi=300, bbox_inches="tight")
     print(f"Saved plot with name {filename}")
     plt.close()
 
@@ -381,6 +646,83 @@ def calculate_torque_on_handlebars(data):
     return actual_torque, desired_torque
 
 
+def cumulative_trapezoid(times, values):
+    """Returns the running trapezoidal integral of `values`, starting at zero."""
+    areas = np.diff(times) * (values[1:] + values[:-1]) / 2
+    return np.concatenate(([0.0], np.cumsum(areas)))
+
+
+class ImpulseEngine:
+    """Angular impulses of the handlebar torques over any window of one session.
+
+    The torques are computed once for the whole session with
+    ``calculate_torque_on_handlebars`` and integrated once with the trapezoidal rule,
+    so the impulse over a window is the difference of the running integral at its
+    first and last sample.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame or dict
+        Session time series with ``seconds_since_start`` and the force columns, and
+        optionally ``motor_current``.
+    """
+
+    def __init__(self, data):
+        self.times = np.asarray(data["seconds_since_start"], dtype=float)
+        actual_torque, desired_torque = calculate_torque_on_handlebars(data)
+        self._integrals = {
+            "actual": cumulative_trapezoid(
+                self.times, np.asarray(actual_torque, dtype=float)
+            ),
+            "desired": cumulative_trapezoid(
+                self.times, np.asarray(desired_torque, dtype=float)
+            ),
+        }
+        if "motor_current" in data:
+            motor_torque = (
+                np.asarray(data["motor_current"], dtype=float)
+                / BALANCE_ASSIST_MOTOR_CONSTANT
+            )
+            self._integrals["controller"] = cumulative_trapezoid(
+                self.times, motor_torque
+            )
+
+    @property
+    def torques(self):
+        """Names of the torques that can be integrated."""
+        return list(self._integrals)
+
+    def between_indices(self, starts, stops, torque="actual"):
+        """Returns the impulse over the samples [start, stop) of each window.
+
+        Parameters
+        ----------
+        starts : array_like of int
+            Position of the first sample of each window.
+        stops : array_like of int
+            Position after the last sample of each window.
+        torque : str
+            ``actual``, ``desired`` or, if the session has ``motor_current``,
+            ``controller``.
+
+        Returns
+        -------
+        numpy.ndarray of float
+            Windows with less than two samples have zero impulse.
+        """
+        integral = self._integrals[torque]
+        starts = np.asarray(starts, dtype=int)
+        lasts = np.maximum(np.asarray(stops, dtype=int) - 1, starts)
+        return integral[lasts] - integral[starts]
+
+    def between_times(self, start_times, stop_times, torque="actual"):
+        """Returns the impulse over the samples with start_time <= t <= stop_time of
+        each window, see ``between_indices``."""
+        starts = np.searchsorted(self.times, start_times)
+        stops = np.searchsorted(self.times, stop_times, side="right")
+        return self.between_indices(starts, stops, torque=torque)
+
+
 def get_figure_title(data):
     """Generate a title based on the direction and magnitude of the perturbation.
 
@@ -406,57 +748,60 @@ def get_figure_title(data):
     return direction + " perturbation of " + str(max) + " N"
 
 
+@instrument.instrumented("perturbations.detect")
 def get_perturbation_indices(data, column_names):
     """Returns the beginning and end indices of blocks of data that are above the tracking
     force.
 
+    A block starts at the first sample above the tracking force and stops at the next
+    sample equal to the tracking force. Blocks of 30 samples or less are logging errors
+    and are dropped, as are blocks that do not stop before the end of the data.
+
     Parameters
     ----------
     data : pandas.DataFrame
         Dataframe containing the data in which to find the start and stop indices.
-    column_name : str
-        Column of the dataframe that should be analysed.
+    column_names : List[str]
+        Columns of the dataframe that should be analysed.
 
     Returns
     -------
     start_indices : List[int]
-        List containing start indices.
+        List containing start indices, sorted in time.
     stop_indices : List[int]
-        List containing stop indicies.
+        List containing the stop index belonging to each start index.
     """
-    start_indices = []
-    stop_indices = []
+    starts = []
+    stops = []
 
     for column_name in column_names:
-        start_index = 0
-        while True:
-            df_shortened = data[start_index:]
-            if df_shortened[df_shortened[column_name] > TRACKING_FORCE].empty:
-                break
-
-            tmp_start_index = (
-                df_shortened[df_shortened[column_name] > TRACKING_FORCE].iloc[0].name
-            )
-            df_shortened = data[tmp_start_index:]
+        values = data[column_name].to_numpy()
+        # 1 switches the block on, 0 switches it off and -1 keeps the last state
+        switches = np.where(
+            values > TRACKING_FORCE, 1, np.where(values == TRACKING_FORCE, 0, -1)
+        )
+        last_switch = np.maximum.accumulate(
+            np.where(switches >= 0, np.arange(len(switches)), -1)
+        )
+        in_block = (last_switch >= 0) & (switches[np.maximum(last_switch, 0)] == 1)
 
-            try:
-                tmp_stop_index = (
-                    df_shortened[df_shortened[column_name] == TRACKING_FORCE]
-                    .iloc[0]
-                    .name
-                )
-            except Exception as e:
-                print(e)
-                tmp_stop_index = df_shortened.tail(1).index.values[0]
-                break
+        edges = np.diff(in_block.astype(np.int8), prepend=0)
+        column_starts = np.flatnonzero(edges == 1)
+        column_stops = np.flatnonzero(edges == -1)
+        # a block that has not stopped at the end of the data is dropped
+        column_starts = column_starts[: len(column_stops)]
+
+        keep = column_stops - column_starts > 30  # filter logging errors
+        starts.append(column_starts[keep])
+        stops.append(column_stops[keep])
 
-            start_index = tmp_stop_index
-            if tmp_stop_index - tmp_start_index > 30:  # filter logging errors
-                start_indices.append(tmp_start_index)
-                stop_indices.append(tmp_stop_index)
+    starts = np.concatenate(starts)
+    stops = np.concatenate(stops)
+    # sort the pairs together so each start keeps its own stop
+    order = np.argsort(starts, kind="stable")
 
-    start_indices.sort()
-    stop_indices.sort()
+    start_indices = data.index[starts[order]].tolist()
+    stop_indices = data.index[stops[order]].tolist()
 
     return start_indices, stop_indices
 
@@ -485,62 +830,41 @@ def get_context_around_perturbation(
     Returns
     -------
     new_start_indices : List[int]
-        List containing the start indices that are `duration` before the perturbation.
+        List containing the row positions that are `duration` before the perturbation.
     new_stop_indices : List[int]
-        List containing the stop indices that are `duration` after the perturbation.
+        List containing the row positions that are `duration` after the perturbation.
     """
-    new_start_indices = []
-    new_stop_indices = []
-
-    for i, value in enumerate(start_indices):
-        pert_start_time = data["seconds_since_start"][start_indices[i]]
-        pert_stop_time = data["seconds_since_start"][stop_indices[i]]
-        context_start = find_closest_timestamp(
-            pert_start_time - duration_before, data["seconds_since_start"]
-        )
-        context_stop = find_closest_timestamp(
-            pert_stop_time + duration_after, data["seconds_since_start"]
-        )
+    times = data["seconds_since_start"].to_numpy()
+    start_times = times[data.index.get_indexer(start_indices)]
+    stop_times = times[data.index.get_indexer(stop_indices)]
 
-        new_start_indices.append(
-            data[data["seconds_since_start"] == context_start].index.values[0]
-        )
-        new_stop_indices.append(
-            data[data["seconds_since_start"] == context_stop].index.values[0]
-        )
+    new_start_indices = find_closest_indices(start_times - duration_before, times)
+    new_stop_indices = find_closest_indices(stop_times + duration_after, times)
 
-    return new_start_indices, new_stop_indices
+    return new_start_indices.tolist(), new_stop_indices.tolist()
 
 
-def find_closest_timestamp(time: float, series: pd.Series) -> float:
-    """Returns the closest time to `time` in `series`.
+def find_closest_indices(query_times, times):
+    """Returns the positions of the closest times to `query_times` in `times`.
 
     Parameters
     ----------
-    time : float
-        Time to search for.
-    series: pandas.Series
-        Series containing timestamps.
+    query_times : array_like
+        Times to search for.
+    times : numpy.ndarray
+        Monotonically increasing timestamps.
 
     Returns
     -------
-    float
-        Closest time to `time` in `series`.
+    numpy.ndarray
+        Positions in `times` of the closest time to each of `query_times`. Ties go to
+        the earlier time.
     """
-    index = bisect_left(series, time)
-    if index == 0:
-        return series.head(1).values[0]
-
-    if index == len(series):
-        return series.tail(1).values[0]
-
-    before = series[index - 1]
-    after = series[index + 1]
-
-    if after - time < time - before:
-        return after
-    else:
-        return before
+    query_times = np.asarray(query_times, dtype=float)
+    after = np.clip(np.searchsorted(times, query_times, side="left"), 0, len(times) - 1)
+    before = np.clip(after - 1, 0, len(times) - 1)
+    use_after = np.abs(times[after] - query_times) < np.abs(query_times - times[before])
+    return np.where(use_after, after, before)
 
 
 if __name__ == "__main__":
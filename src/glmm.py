@@ -0,0 +1,289 @@
+"""Random intercept logistic regression (a generalized linear mixed model) of
+the ``fall`` outcome with the participant as the grouping factor, fitted with
+the Laplace approximation like ``glmer(..., (1|participant_id))`` in
+``src/statistics.R``.
+
+Usage::
+
+    python src/glmm.py
+
+prints the fixed effects, the variance components and whether the fit is
+singular for the 6 and 10 km/h data.
+
+"""
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.special import expit
+
+from regression import DATA_PATHS, coefficient_table, design_matrix, irls
+
+# relative standard deviation of the random intercept below which the fit is
+# singular, as lme4's isSingular()
+SINGULAR_TOL = 1e-4
+
+
+def _group_sum(values, groups, num_groups):
+    return np.bincount(groups, weights=values, minlength=num_groups)
+
+
+def _log_lik(y, eta):
+    # log likelihood of each binary outcome, log(expit(eta)) or
+    # log(1 - expit(eta))
+    return -np.logaddexp(0.0, np.where(y > 0.5, -eta, eta))
+
+
+def conditional_modes(offset, y, groups, num_groups, theta, u0=None,
+                      tol=1e-10, max_iter=50):
+    """Returns the conditional modes of the spherical random effects of all
+    groups, found with simultaneous Newton steps.
+
+    Parameters
+    ==========
+    offset : ndarray, shape(n,)
+        Fixed effects linear predictor ``X @ beta``.
+    y : ndarray, shape(n,)
+        Outcomes, 0 or 1.
+    groups : ndarray of int, shape(n,)
+        Group number of each row.
+    num_groups : integer
+    theta : float
+        Standard deviation of the random intercept.
+    u0 : ndarray, shape(num_groups,), optional
+        Starting modes, defaults to zero.
+    tol : float, optional
+        Largest Newton step at convergence.
+    max_iter : integer, optional
+
+    Returns
+    =======
+    u : ndarray, shape(num_groups,)
+        Modes of ``u`` where the random intercepts are ``theta*u`` and
+        ``u`` is standard normal.
+    curvature : ndarray, shape(num_groups,)
+        ``1 + theta**2*sum(mu*(1 - mu))`` of each group at the mode.
+
+    Notes
+    =====
+    The penalized log likelihood of each group only depends on its own
+    scalar ``u``, so all groups take a Newton step at once with sums over
+    the rows of each group. Steps that do not increase a group's penalized
+    log likelihood are halved.
+
+    """
+    u = np.zeros(num_groups) if u0 is None else np.array(u0, dtype=float)
+
+    def objective(u):
+        eta = offset + theta*u[groups]
+        return _group_sum(_log_lik(y, eta), groups, num_groups) - u**2/2, eta
+
+    value, eta = objective(u)
+    for _ in range(max_iter):
+        mu = expit(eta)
+        gradient = theta*_group_sum(y - mu, groups, num_groups) - u
+        curvature = 1.0 + theta**2*_group_sum(mu*(1.0 - mu), groups,
+                                              num_groups)
+        step = gradient/curvature
+        for _ in range(10):
+            new_value, new_eta = objective(u + step)
+            worse = new_value < value - 1e-12
+            if not np.any(worse):
+                break
+            step[worse] /= 2
+        u, value, eta = u + step, new_value, new_eta
+        if np.max(np.abs(step)) < tol:
+            break
+
+    mu = expit(eta)
+    curvature = 1.0 + theta**2*_group_sum(mu*(1.0 - mu), groups, num_groups)
+    return u, curvature
+
+
+def laplace_deviance(beta, theta, X, y, groups, num_groups, u0=None):
+    """Returns the Laplace approximation of -2 times the log likelihood and
+    the conditional modes.
+
+    Parameters
+    ==========
+    beta : ndarray, shape(p,)
+        Fixed effects.
+    theta : float
+        Standard deviation of the random intercept.
+    X : ndarray, shape(n, p)
+    y : ndarray, shape(n,)
+    groups : ndarray of int, shape(n,)
+    num_groups : integer
+    u0 : ndarray, shape(num_groups,), optional
+        Starting modes, see ``conditional_modes()``.
+
+    Returns
+    =======
+    deviance : float
+        The deviance that ``glmer()`` minimizes with ``nAGQ = 1``.
+    u : ndarray, shape(num_groups,)
+
+    """
+    offset = X @ beta
+    u, curvature = conditional_modes(offset, y, groups, num_groups, theta,
+                                     u0=u0)
+    log_lik = np.sum(_log_lik(y, offset + theta*u[groups]))
+    return -2.0*log_lik + np.sum(u**2) + np.sum(np.log(curvature)), u
+
+
+def _hessian(func, x, step=1e-4):
+    # central difference Hessian
+    n = len(x)
+    hessian = np.empty((n, n))
+    steps = step*np.maximum(np.abs(x), 1.0)
+    for i in range(n):
+        for j in range(i, n):
+            ei = np.zeros(n)
+            ej = np.zeros(n)
+            ei[i] = steps[i]
+            ej[j] = steps[j]
+            hessian[i, j] = hessian[j, i] = (
+                func(x + ei + ej) - func(x + ei - ej) -
+                func(x - ei + ej) + func(x - ei - ej))/(4*steps[i]*steps[j])
+    return hessian
+
+
+def fit_glmm(X, y, groups, beta0=None, theta0=1.0, hessian=True):
+    """Returns the Laplace approximation maximum likelihood fit of a random
+    intercept logistic regression.
+
+    Parameters
+    ==========
+    X : array_like, shape(n, p)
+        Fixed effects model matrix.
+    y : array_like, shape(n,)
+        Outcomes, 0 or 1.
+    groups : array_like, shape(n,)
+        Group label of each row, e.g. the participant id.
+    beta0 : array_like, shape(p,), optional
+        Starting fixed effects, defaults to the fit without random effects.
+    theta0 : float, optional
+        Starting standard deviation of the random intercept, 1 as lme4.
+    hessian : boolean, optional
+        If False, the covariance of the fixed effects is not computed, which
+        saves most of the time of a fit inside resampling loops.
+
+    Returns
+    =======
+    dictionary
+        ``beta``
+            Fixed effects, shape(p,).
+        ``cov``
+            Covariance of the fixed effects from the finite difference
+            Hessian of the deviance, shape(p, p), or None.
+        ``theta``
+            Standard deviation of the random intercept.
+        ``variance``
+            Variance of the random intercept, ``theta**2``.
+        ``icc``
+            Intraclass correlation on the latent scale,
+            ``variance/(variance + pi**2/3)``.
+        ``ranef``
+            Conditional modes of the random intercepts, a pandas.Series
+            indexed by the group labels.
+        ``deviance``
+            Laplace approximation of -2 times the log likelihood.
+        ``singular``
+            True if ``theta`` is at the boundary zero.
+        ``converged``
+            True if the optimizer converged.
+
+    Notes
+    =====
+    The deviance is minimized over the fixed effects and the standard
+    deviation jointly with L-BFGS-B and ``theta >= 0``, as the second stage
+    of ``glmer()`` does with bobyqa.
+
+    """
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float)
+    groups, labels = pd.factorize(np.asarray(groups))
+    num_groups = len(labels)
+    if beta0 is None:
+        beta0 = irls(X, y)[0]
+
+    # the modes of the last evaluation warm start the next
+    modes = {'u': None}
+
+    def deviance(params):
+        value, modes['u'] = laplace_deviance(params[1:], params[0], X, y,
+                                             groups, num_groups, u0=modes['u'])
+        return value
+
+    x0 = np.hstack((theta0, beta0))
+    bounds = [(0.0, None)] + [(None, None)]*len(beta0)
+    result = minimize(deviance, x0, method='L-BFGS-B', bounds=bounds,
+                      options={'ftol': 1e-12, 'gtol': 1e-7, 'maxiter': 1000})
+    theta, beta = result.x[0], result.x[1:]
+    value, u = laplace_deviance(beta, theta, X, y, groups, num_groups)
+    singular = theta < SINGULAR_TOL
+
+    cov = None
+    if hessian:
+        if singular:
+            # the deviance is not smooth at the boundary, so the fixed
+            # effects are treated as if theta were known
+            H = _hessian(lambda b: deviance(np.hstack((theta, b))), beta)
+            cov = 2.0*np.linalg.inv(H)
+        else:
+            H = _hessian(deviance, result.x)
+            cov = 2.0*np.linalg.inv(H)[1:, 1:]
+
+    return {
+        'beta': beta,
+        'cov': cov,
+        'theta': theta,
+        'variance': theta**2,
+        'icc': theta**2/(theta**2 + np.pi**2/3),
+        'ranef': pd.Series(theta*u, index=labels),
+        'deviance': value,
+        'singular': bool(singular),
+        'converged': bool(result.success),
+    }
+
+
+def fit_fall_glmm(table, **kwargs):
+    """Returns the random intercept fit of the fall model with the
+    participant as the group.
+
+    Parameters
+    ==========
+    table : pandas.DataFrame
+        One of the ``all_perturbations_*.csv`` tables.
+    **kwargs
+        Passed to ``fit_glmm()``.
+
+    Returns
+    =======
+    coefficients : pandas.DataFrame
+        ``coefficient_table()`` of the fixed effects, with NaN standard errors,
+        z and p values and confidence intervals if ``hessian=False``.
+    fit : dictionary
+        See ``fit_glmm()``.
+
+    """
+    fit = fit_glmm(design_matrix(table), table['fall'].to_numpy(dtype=float),
+                   table['participant_id'].to_numpy(), **kwargs)
+    return coefficient_table(fit['beta'], fit['cov']), fit
+
+
+def main():
+    for speed, path in DATA_PATHS.items():
+        coefficients, fit = fit_fall_glmm(pd.read_csv(path))
+        print('Mixed effects model at {} km/h:'.format(speed))
+        print(coefficients.round(4).to_string())
+        print('Random intercept participant_id: variance = {:.4g}, '
+              'std. dev. = {:.4g}, ICC = {:.4f}'.format(
+                  fit['variance'], fit['theta'], fit['icc']))
+        print('Laplace deviance = {:.4f}'.format(fit['deviance']))
+        print('Mixed effects model is singular {}'.format(
+            str(fit['singular']).upper()))
+        print('=' * 79)
+
+
+if __name__ == '__main__':
+    main()
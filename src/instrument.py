@@ -0,0 +1,248 @@
+"""Named timing spans that show where the time of a figure build goes.
+
+Usage::
+
+    FIGURE_PROFILE=profile.json python src/control.py
+    python src/control.py --profile profile.json
+    FIGURE_PROFILE=profile.json FIGURE_CPROFILE=model.eigen_solve \\
+        python src/control.py
+
+When enabled, each ``span()`` and each call of an ``instrumented()``
+function records its call count, total time, self time (without the time of
+nested spans) and the peak resident memory of the process at its end. Nested
+spans are recorded under the path of their parents, e.g.
+``figure.eig;model.calc_eigen_sweep``. At exit, a JSON report is written to
+the given path, next to it the self times as folded stacks
+(``profile.folded``) that flamegraph.pl, inferno and speedscope read, and a
+cProfile ``profile.<span>.prof`` file for each span named in
+``FIGURE_CPROFILE`` (comma separated).
+
+When disabled, ``span()`` returns one shared context manager that does
+nothing and ``instrumented()`` functions only check one global before
+calling through, so the hooks can stay in the code.
+"""
+import atexit
+import contextlib
+import cProfile
+import functools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ENV_VAR = 'FIGURE_PROFILE'
+CPROFILE_ENV_VAR = 'FIGURE_CPROFILE'
+
+_NULL_SPAN = contextlib.nullcontext()
+# the recorder while instrumentation is enabled, else None
+_recorder = None
+
+
+def _max_rss():
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NOTE : ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return rss if sys.platform == 'darwin' else rss*1024
+
+
+class _Recorder:
+
+    def __init__(self, path=None, cprofile=()):
+        self.path = path
+        self.cprofile = set(cprofile)
+        # maps a tuple of span names to [count, total, self, max rss, rss
+        # growth]
+        self.stats = {}
+        self.counters = {}
+        self.profiles = {}
+        # names and child times of the open spans
+        self.stack = []
+        self.start = time.perf_counter()
+
+
+class _Span:
+
+    __slots__ = ('recorder', 'name', 'start', 'rss', 'profile')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        recorder = self.recorder
+        self.profile = None
+        if self.name in recorder.cprofile and not any(
+                name in recorder.cprofile for name, _ in recorder.stack):
+            self.profile = recorder.profiles.setdefault(self.name,
+                                                        cProfile.Profile())
+            self.profile.enable()
+        recorder.stack.append([self.name, 0.0])
+        self.rss = _max_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        recorder = self.recorder
+        if self.profile is not None:
+            self.profile.disable()
+        rss = _max_rss()
+        path = tuple(name for name, _ in recorder.stack)
+        _, child_time = recorder.stack.pop()
+        if recorder.stack:
+            recorder.stack[-1][1] += elapsed
+        stats = recorder.stats.setdefault(path, [0, 0.0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - child_time
+        stats[3] = max(stats[3], rss)
+        stats[4] += rss - self.rss
+        return False
+
+
+def enabled():
+    """Returns True if spans are recorded."""
+    return _recorder is not None
+
+
+def enable(path=None, cprofile=()):
+    """Starts recording spans.
+
+    Parameters
+    ==========
+    path : string, optional
+        If given, the report is written to this JSON file at exit, see
+        ``write_report()``. Processes started by ``multiprocessing`` write to
+        ``<path>.<pid>.json`` instead.
+    cprofile : iterable of strings, optional
+        Names of spans that are also run under cProfile.
+
+    """
+    global _recorder
+    if path is not None and multiprocessing.parent_process() is not None:
+        root, ext = os.path.splitext(path)
+        path = '{}.{}{}'.format(root, os.getpid(), ext or '.json')
+    _recorder = _Recorder(path, [name for name in cprofile if name])
+    if path is not None:
+        atexit.register(_write_at_exit, _recorder)
+
+
+def disable():
+    """Stops recording and returns the report, see ``report()``."""
+    global _recorder
+    result = report()
+    _recorder = None
+    return result
+
+
+def span(name):
+    """Returns a context manager that records the time spent in its block
+    under ``name``."""
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, name)
+
+
+def instrumented(name=None):
+    """Returns a decorator that records each call of a function as a span.
+
+    Parameters
+    ==========
+    name : string, optional
+        Name of the span, defaults to the qualified name of the function.
+
+    """
+    def decorator(func):
+        label = func.__qualname__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            with _Span(_recorder, label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """Adds ``n`` to the counter ``name``, e.g. of cache hits."""
+    if _recorder is not None:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + n
+
+
+def report():
+    """Returns the recorded spans and counters.
+
+    Returns
+    =======
+    dictionary
+        ``wall_seconds`` since instrumentation was enabled,
+        ``max_rss_bytes`` of the process, ``counters``, and ``spans``, a
+        list with the ``path``, ``name``, ``count``, ``total_seconds``,
+        ``self_seconds``, ``max_rss_bytes`` and ``rss_growth_bytes`` (how
+        much the peak resident memory grew inside the span) of each span
+        path, ordered by the path. Empty if instrumentation is disabled.
+
+    """
+    if _recorder is None:
+        return {}
+    spans = []
+    for path in sorted(_recorder.stats):
+        num, total, self_time, max_rss, growth = _recorder.stats[path]
+        spans.append({
+            'path': ';'.join(path),
+            'name': path[-1],
+            'count': num,
+            'total_seconds': total,
+            'self_seconds': self_time,
+            'max_rss_bytes': max_rss,
+            'rss_growth_bytes': growth,
+        })
+    return {
+        'wall_seconds': time.perf_counter() - _recorder.start,
+        'max_rss_bytes': _max_rss(),
+        'counters': dict(sorted(_recorder.counters.items())),
+        'spans': spans,
+    }
+
+
+def folded_stacks(result):
+    """Returns the self times of a report in microseconds as folded stack
+    lines, e.g. ``figure.eig;model.calc_eigen_sweep 81234``."""
+    return ''.join('{} {}\n'.format(s['path'],
+                                    int(round(s['self_seconds']*1e6)))
+                   for s in result['spans'])
+
+
+def write_report(path):
+    """Writes the report to a JSON file, the folded stacks to a ``.folded``
+    file and the cProfile statistics to ``.prof`` files next to it."""
+    result = report()
+    root, _ = os.path.splitext(path)
+    profiles = {}
+    for name, profile in _recorder.profiles.items():
+        profiles[name] = '{}.{}.prof'.format(root, name)
+        profile.dump_stats(profiles[name])
+    result['cprofile'] = profiles
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    with open(root + '.folded', 'w') as f:
+        f.write(folded_stacks(result))
+
+
+def _write_at_exit(recorder):
+    if _recorder is recorder:
+        write_report(recorder.path)
+
+
+if os.environ.get(ENV_VAR):
+    enable(os.environ[ENV_VAR],
+           cprofile=os.environ.get(CPROFILE_ENV_VAR, '').split(','))
@@ -1,7 +1,86 @@
+import itertools
+
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.linalg import expm
+from scipy.optimize import brentq
 from bicycleparameters.models import Meijaard2007Model
-from bicycleparameters.bicycle import ab_matrix, sort_eigenmodes
+
+from instrument import count, instrumented, span
+
+# All 24 orderings of the four eigenmodes and the table that composes them:
+# applying permutation a and then b is the same as applying
+# PERMUTATIONS[_COMPOSE[a, b]].
+PERMUTATIONS = np.array(list(itertools.permutations(range(4))))
+_COMPOSE = np.array([[np.flatnonzero((PERMUTATIONS == b[a]).all(axis=1))[0]
+                      for b in PERMUTATIONS] for a in PERMUTATIONS])
+
+
+def match_modes(evals, evecs, next_evals, next_evecs):
+    """Returns the permutation indices that best match each set of eigenmodes
+    to the following set.
+
+    Parameters
+    ==========
+    evals : ndarray, shape(n,4)
+        Eigenvalues at n points.
+    evecs : ndarray, shape(n,4,4)
+        Unit length eigenvectors (columns) at n points.
+    next_evals : ndarray, shape(n,4)
+        Eigenvalues at the n following points.
+    next_evecs : ndarray, shape(n,4,4)
+        Unit length eigenvectors (columns) at the n following points.
+
+    Returns
+    =======
+    perm_idxs : ndarray, shape(n,)
+        Indices into ``PERMUTATIONS``, where ``PERMUTATIONS[perm_idxs[i]][j]``
+        is the column of the following set that continues mode ``j``.
+
+    Notes
+    =====
+    The match maximizes the summed overlap ``|v_j^H w_k|`` of the
+    eigenvectors over all 24 permutations. Eigenvectors are nearly parallel
+    where a complex pair splits into two real eigenvalues, so the distance
+    between the eigenvalues, scaled by the largest eigenvalue magnitude, is
+    subtracted from the overlap to break those ties.
+
+    """
+    overlap = np.abs(np.conj(np.swapaxes(evecs, -1, -2))@next_evecs)
+    dist = np.abs(evals[..., :, np.newaxis] - next_evals[..., np.newaxis, :])
+    scale = np.max(np.abs(evals), axis=-1)[..., np.newaxis, np.newaxis]
+    score = overlap - dist/(scale + 1.0)
+    # score of each permutation, shape(n,24)
+    totals = score[..., np.arange(4), PERMUTATIONS].sum(axis=-1)
+    return np.argmax(totals, axis=-1)
+
+
+def accumulate_permutations(perm_idxs):
+    """Returns the running composition of a sequence of permutations.
+
+    Parameters
+    ==========
+    perm_idxs : ndarray, shape(n,)
+        Indices into ``PERMUTATIONS``.
+
+    Returns
+    =======
+    cum_idxs : ndarray, shape(n,)
+        ``cum_idxs[i]`` is the index of the permutation found by applying
+        ``perm_idxs[0]`` through ``perm_idxs[i]`` in order.
+
+    Notes
+    =====
+    This is a Hillis-Steele prefix scan over the composition table, so it
+    takes log2(n) vectorized steps instead of a Python loop over n.
+
+    """
+    cum_idxs = np.array(perm_idxs, dtype=np.intp)
+    step = 1
+    while step < len(cum_idxs):
+        cum_idxs[step:] = _COMPOSE[cum_idxs[:-step], cum_idxs[step:]]
+        step *= 2
+    return cum_idxs
 
 
 class SteerControlModel(Meijaard2007Model):
@@ -21,6 +100,42 @@ class SteerControlModel(Meijaard2007Model):
 
     """
 
+    gain_names = ['kphi', 'kdelta', 'kphidot', 'kdeltadot']
+    # saturation switches allowed between two output times of
+    # simulate_saturated()
+    max_switches = 100
+
+    def __init__(self, parameter_set, eigen_cache=None):
+        """
+        parameter_set : Meijaard2007ParameterSet
+        eigen_cache : EigenCache, optional
+            If given, eigenvalue sweeps are stored in and reused from this
+            cache. The same cache can be shared by several models.
+        """
+        super(SteerControlModel, self).__init__(parameter_set)
+        self.eigen_cache = eigen_cache
+
+    def _cached(self, name, compute, inputs=None, **parameter_overrides):
+        """Returns ``compute()`` or its cached result. Only calls with array
+        valued overrides, i.e. sweeps, or with other ``inputs`` that
+        ``compute()`` depends on, e.g. simulation times, are cached."""
+        _, array_keys, _ = self._parse_parameter_overrides(
+            **parameter_overrides)
+        if self.eigen_cache is None or not (array_keys or inputs):
+            return compute()
+        key = self.eigen_cache.make_key(self.parameter_set.parameters, name,
+                                        **dict(inputs or {},
+                                               **parameter_overrides))
+        result = self.eigen_cache.get(key)
+        if result is None:
+            count('cache.miss')
+            result = compute()
+            self.eigen_cache.put(key, result)
+        else:
+            count('cache.hit')
+        return result
+
+    @instrumented('model.form_state_space_matrices')
     def form_state_space_matrices(self, **parameter_overrides):
         """Returns the A and B matrices for the Whipple-Carvallo model
         linearized about the upright constant velocity configuration with a
@@ -53,8 +168,6 @@ class SteerControlModel(Meijaard2007Model):
             |Tdelta|   |steer torque|
 
         """
-        gain_names = ['kphi', 'kdelta', 'kphidot', 'kdeltadot']
-
         par, array_keys, array_len = self._parse_parameter_overrides(
             **parameter_overrides)
 
@@ -64,43 +177,154 @@ class SteerControlModel(Meijaard2007Model):
         M, C1, K0, K2 = self.form_reduced_canonical_matrices(
             **parameter_overrides)
 
-        # steer controller gains, 2x4, no roll control
-        if any(k in gain_names for k in array_keys):
-            # if one of the gains is an array, create a set of gain matrices
-            # where that single gain varies across the set
-            K = np.array([[0.0, 0.0, 0.0, 0.0],
-                          [par[p][0] if p in array_keys else par[p]
-                           for p in gain_names]])
-            # K is now shape(n, 2, 4)
-            K = np.tile(K, (array_len, 1, 1))
-            for k in array_keys:
-                if k in gain_names:
-                    K[:, 1, gain_names.index(k)] = par[k]
-        else:  # gains are not an array
-            K = np.array([[0.0, 0.0, 0.0, 0.0],
-                          [par[p] for p in gain_names]])
-
-        if array_keys:
-            A = np.zeros((array_len, 4, 4))
-            B = np.zeros((array_len, 4, 2))
-            for i in range(array_len):
-                Mi = M[i] if M.ndim == 3 else M
-                C1i = C1[i] if C1.ndim == 3 else C1
-                K0i = K0[i] if K0.ndim == 3 else K0
-                K2i = K2[i] if K2.ndim == 3 else K2
-                vi = par['v'] if np.isscalar(par['v']) else par['v'][i]
-                gi = par['g'] if np.isscalar(par['g']) else par['g'][i]
-                Ki = K[i] if K.ndim == 3 else K
-                Ai, Bi = ab_matrix(Mi, C1i, K0i, K2i, vi, gi)
-                A[i] = Ai - Bi@Ki
-                B[i] = Bi
-        else:  # scalar parameters
-            A, B = ab_matrix(M, C1, K0, K2, par['v'], par['g'])
-            A = A - B@K
-            B = B
+        # NOTE : Every quantity is broadcast to a common leading "batch" shape
+        # which is () if all parameters are scalars and (n,) if any parameter
+        # is an array, so that all n state space matrices are formed at once.
+        v = np.asarray(par['v'], dtype=float)
+        g = np.asarray(par['g'], dtype=float)
+        gains = [np.asarray(par[p], dtype=float) for p in self.gain_names]
+        batch = np.broadcast_shapes(M.shape[:-2], C1.shape[:-2],
+                                    K0.shape[:-2], K2.shape[:-2], v.shape,
+                                    g.shape, *[k.shape for k in gains])
+
+        v, g = v[..., np.newaxis, np.newaxis], g[..., np.newaxis, np.newaxis]
+
+        # M*[a21, a22, b2] = -[g*K0 + v**2*K2, v*C1, -I] as one stacked solve
+        rhs = np.concatenate(
+            np.broadcast_arrays(-(g*K0 + v**2*K2), -v*C1, np.eye(2)),
+            axis=-1)
+        rhs = np.broadcast_to(rhs, batch + (2, 6))
+        sol = np.linalg.solve(np.broadcast_to(M, batch + (2, 2)), rhs)
+
+        A = np.zeros(batch + (4, 4))
+        A[..., 0, 2] = 1.0
+        A[..., 1, 3] = 1.0
+        A[..., 2:, :] = sol[..., :4]
+
+        B = np.zeros(batch + (4, 2))
+        B[..., 2:, :] = sol[..., 4:]
+
+        # steer controller gains, 2x4, no roll control, shape(2,4) or
+        # shape(n,2,4)
+        K = np.zeros(batch + (2, 4))
+        K[..., 1, :] = np.stack(np.broadcast_arrays(*gains), axis=-1)
+
+        A = A - B@K
 
         return A, B
 
+    def calc_eigen(self, left=False, **parameter_overrides):
+        """Returns the right (or left) eigenvalues and eigenvectors of the
+        closed loop model.
+
+        Parameters
+        ==========
+        left : boolean, optional
+            If true, the left eigenvectors will be returned, i.e.
+            ``A.T*v=lam*v``.
+        **parameter_overrides : dictionary
+            Parameter keys that map to floats or array_like of floats
+            shape(n,). All keys that map to array_like must be of the same
+            length.
+
+        Returns
+        =======
+        evals : ndarray, shape(4,) or shape (n,4)
+            Eigenvalues.
+        evecs : ndarray, shape(4,4) or shape (n,4,4)
+            Eigenvectors, each columns are eigenvectors and are associated with
+            same index of the eigenvalues.
+
+        """
+        def compute():
+            A, _ = self.form_state_space_matrices(**parameter_overrides)
+            if left:
+                A = np.swapaxes(A, -1, -2)
+            with span('model.eigen_solve'):
+                evals, evecs = np.linalg.eig(A)
+            return evals, evecs
+
+        name = 'calc_eigen_left' if left else 'calc_eigen'
+        return self._cached(name, compute, **parameter_overrides)
+
+    def calc_eigen_sweep(self, chunk_size=10000, **parameter_overrides):
+        """Returns the eigenvalues and eigenvectors of the closed loop model
+        ordered so that each column follows one eigenmode along the sweep.
+
+        Parameters
+        ==========
+        chunk_size : integer, optional
+            Number of sweep points whose state matrices and eigenvectors are
+            held in memory at once.
+        **parameter_overrides : dictionary
+            Parameter keys that map to floats or array_like of floats
+            shape(n,). All keys that map to array_like must be of the same
+            length and at least one key must map to an array.
+
+        Returns
+        =======
+        evals : ndarray, shape(n,4)
+            Eigenvalues.
+        evecs : ndarray, shape(n,4,4)
+            Eigenvectors, each column is associated with the same column of
+            the eigenvalues.
+
+        Notes
+        =====
+        Each chunk is solved with one batched ``np.linalg.eig`` call. Modes
+        are matched between neighboring points by eigenvector overlap (see
+        ``match_modes``) and the matches are chained along the whole sweep,
+        including across chunk boundaries.
+
+        """
+        def compute():
+            return self._calc_eigen_sweep(chunk_size, **parameter_overrides)
+
+        return self._cached('calc_eigen_sweep', compute, **parameter_overrides)
+
+    @instrumented('model.calc_eigen_sweep')
+    def _calc_eigen_sweep(self, chunk_size, **parameter_overrides):
+        par, array_keys, array_len = self._parse_parameter_overrides(
+            **parameter_overrides)
+
+        if not array_keys:
+            raise ValueError('At least one parameter must be an array.')
+
+        evals = np.empty((array_len, 4), dtype='complex128')
+        evecs = np.empty((array_len, 4, 4), dtype='complex128')
+        # perm_idxs[i] matches the modes at point i to those at point i + 1
+        perm_idxs = np.zeros(array_len, dtype=np.intp)
+
+        for start in range(0, array_len, chunk_size):
+            stop = min(start + chunk_size, array_len)
+            chunk_overrides = parameter_overrides.copy()
+            for key in array_keys:
+                chunk_overrides[key] = np.asarray(par[key])[start:stop]
+            A, _ = self.form_state_space_matrices(**chunk_overrides)
+            with span('model.eigen_solve'):
+                evals[start:stop], evecs[start:stop] = np.linalg.eig(A)
+            # also match the last point of the previous chunk
+            first = max(start - 1, 0)
+            perm_idxs[first:stop - 1] = match_modes(
+                evals[first:stop - 1], evecs[first:stop - 1],
+                evals[first + 1:stop], evecs[first + 1:stop])
+
+        # PERMUTATIONS[cum_idxs[i]] lists the raw columns at point i in mode
+        # order
+        cum_idxs = np.empty(array_len, dtype=np.intp)
+        cum_idxs[0] = 0  # identity
+        cum_idxs[1:] = accumulate_permutations(perm_idxs[:-1])
+
+        for start in range(0, array_len, chunk_size):
+            stop = min(start + chunk_size, array_len)
+            order = PERMUTATIONS[cum_idxs[start:stop]]
+            evals[start:stop] = np.take_along_axis(evals[start:stop], order,
+                                                   axis=-1)
+            evecs[start:stop] = np.take_along_axis(
+                evecs[start:stop], order[:, np.newaxis, :], axis=-1)
+
+        return evals, evecs
+
     def plot_eigenvalue_parts(self, ax=None, colors=None,
                               show_stable_regions=True, hide_zeros=False,
                               **parameter_overrides):
@@ -143,11 +367,7 @@ class SteerControlModel(Meijaard2007Model):
         if ax is None:
             fig, ax = plt.subplots()
 
-        evals, evecs = self.calc_eigen(**parameter_overrides)
-        if len(evals.shape) > 1:
-            evals, evecs = sort_eigenmodes(evals, evecs)
-        else:
-            evals, evecs = np.array([evals]), np.array([evecs])
+        evals, evecs = self.calc_eigen_sweep(**parameter_overrides)
 
         tol = hide_zeros if isinstance(hide_zeros, float) else 1e-12
 
@@ -192,3 +412,266 @@ class SteerControlModel(Meijaard2007Model):
         ax.set_xlabel(array_keys[0])
 
         return ax
+
+    def simulate_saturated(self, times, initial_conditions, max_torque=7.0,
+                           **parameter_overrides):
+        """Returns the state and input trajectories at each time value of the
+        closed loop model with the steer torque ``-K*x`` clipped to
+        ``max_torque``.
+
+        Parameters
+        ==========
+        times : array_like, shape(n,)
+            Monotonic increasing time values to simulate over.
+        initial_conditions : array_like, shape(4,)
+            Initial values of the states.
+        max_torque : float, optional
+            Magnitude of the steer torque at which the controller saturates
+            [Nm].
+        **parameter_overrides : dictionary
+            Parameter keys that map to floats. The controller gains are set
+            with ``kphi``, ``kdelta``, ``kphidot``, and ``kdeltadot``.
+
+        Returns
+        =======
+        states : ndarray, shape(n, 4)
+            State trajectories over n time values.
+        inputs : ndarray, shape(n, 2)
+            Input trajectories over n time values.
+
+        Notes
+        =====
+        The closed loop is linear between saturation switches: ``x' = (A -
+        B*K)*x`` when unsaturated and ``x' = A*x + B*[0, +/-max_torque]``
+        when saturated. Each segment is propagated exactly with the matrix
+        exponential of the affine system augmented with a constant state.
+        The exponentials of the output time steps are computed once per
+        segment type and the switching times are found with Brent's method
+        on the torque, so no adaptive ODE integration is needed. The torque
+        is checked at steps no longer than the fastest time constant and for
+        a maximum between them, so saturations that start and end between
+        two output times are found. A switch onto a torque limit that the
+        torque only touches is decided by the sign of its first, or if that
+        is zero its second, time derivative. More than ``max_switches``
+        switches between two output times raise a RuntimeError.
+
+        """
+        def compute():
+            return self._simulate_saturated(times, initial_conditions,
+                                            max_torque, **parameter_overrides)
+
+        inputs = {'times': times, 'initial_conditions': initial_conditions,
+                  'max_torque': max_torque}
+        return self._cached('simulate_saturated', compute, inputs=inputs,
+                            **parameter_overrides)
+
+    @instrumented('model.simulate_saturated')
+    def _simulate_saturated(self, times, initial_conditions, max_torque,
+                            **parameter_overrides):
+        par, arr_keys, _ = self._parse_parameter_overrides(
+            **parameter_overrides)
+
+        if arr_keys:
+            raise ValueError('Can only simulate with fixed parameters.')
+
+        A, B = self.form_state_space_matrices(**parameter_overrides)
+        k = np.array([par[p] for p in self.gain_names])
+        b = B[:, 1]
+
+        # augmented state matrices for z = [x, 1] of the unsaturated (0) and
+        # the positively (1) and negatively (-1) saturated segments
+        aug = {}
+        for mode in (-1, 0, 1):
+            G = np.zeros((5, 5))
+            if mode == 0:
+                G[:4, :4] = A
+            else:
+                G[:4, :4] = A + np.outer(b, k)
+                G[:4, 4] = mode*max_torque*b
+            aug[mode] = G
+
+        # The guards are linear in z and positive when the state has left the
+        # segment: the unsaturated segment is left for 1 when -k*x >
+        # max_torque and for -1 when k*x > max_torque, a saturated segment is
+        # left for 0 when mode*(-k*x) < max_torque.
+        guards = {
+            0: (np.array([np.hstack((-k, -max_torque)),
+                          np.hstack((k, -max_torque))]), (1, -1)),
+            -1: (np.array([np.hstack((-k, max_torque))]), (0,)),
+            1: (np.array([np.hstack((k, max_torque))]), (0,)),
+        }
+        # first and second time derivatives of the guards
+        rates = {mode: (rows@aug[mode], rows@aug[mode]@aug[mode])
+                 for mode, (rows, _) in guards.items()}
+
+        # Sampling the guards at steps shorter than the fastest time constant
+        # and checking for a maximum between the samples finds the switches
+        # between the output times.
+        radius = max(np.max(np.abs(np.linalg.eigvals(G))) for G in
+                     aug.values())
+        max_step = 1.0/radius if radius > 0.0 else np.inf
+        xtol = 1e-12  # of the switching times
+
+        def tolerance(z, rate):
+            # a guard is on its surface within the rounding of the torque and
+            # the change of the guard within the tolerance of the switching
+            # time
+            return (1e-9*(max_torque + np.abs(k)@np.abs(z[:4])) +
+                    4.0*xtol*np.abs(rate))
+
+        step_exps = {}
+
+        def step_exp(mode, h):
+            if (mode, h) not in step_exps:
+                step_exps[(mode, h)] = expm(aug[mode]*h)
+            return step_exps[(mode, h)]
+
+        def propagate(mode, z, t):
+            return expm(aug[mode]*t)@z
+
+        def active(mode, z):
+            """Returns the next mode if a guard is on its surface and
+            increasing, i.e. the segment is left at once, else None."""
+            rows, targets = guards[mode]
+            first, second = rates[mode]
+            for row, d1, d2, target in zip(rows, first, second, targets):
+                g, rate = row@z, d1@z
+                tol = tolerance(z, rate)
+                # a guard that is zero to first order is tangent to the
+                # surface and the second derivative decides
+                if g > tol or (g >= -tol and (
+                        rate > tol*radius or
+                        (rate >= -tol*radius and d2@z > 0.0))):
+                    return target
+            return None
+
+        def first_switch(mode, z, duration):
+            """Returns the time and the next mode of the first guard crossing
+            within ``duration`` or None and the state at ``duration``."""
+            rows, targets = guards[mode]
+            first, _ = rates[mode]
+            num = max(int(np.ceil(duration/max_step)), 1)
+            h = duration/num
+            E = step_exp(mode, h)
+
+            lower = np.zeros(len(rows))
+            # Guards that start on their surface, e.g. just after a switch,
+            # are not active (see active()), so they become negative right
+            # after the start. Their bracket starts at a small time at which
+            # they are.
+            for i in np.flatnonzero(rows@z > -tolerance(z, first@z)):
+                eps = 1e-9*h
+                while eps < h:
+                    if rows[i]@propagate(mode, z, eps) < 0.0:
+                        lower[i] = eps
+                        break
+                    eps *= 10.0
+                else:
+                    return 0.0, targets[i], None
+
+            z_lo = z
+            for j in range(num):
+                z_hi = E@z_lo
+                g_hi = rows@z_hi
+                t_lo, t_hi = j*h, (j + 1)*h
+                best = None
+                for i in range(len(rows)):
+                    a = max(t_lo, lower[i])
+                    if g_hi[i] > 0.0:
+                        b = t_hi
+                    elif (a < t_hi and first[i]@z_hi < 0.0 and
+                          first[i]@(z_lo if a == t_lo else
+                                    propagate(mode, z, a)) > 0.0):
+                        # a maximum between the samples that may cross
+                        t_max = brentq(
+                            lambda t: first[i]@propagate(mode, z, t), a, t_hi,
+                            xtol=xtol)
+                        if rows[i]@propagate(mode, z, t_max) <= 0.0:
+                            continue
+                        b = t_max
+                    else:
+                        continue
+                    tau = brentq(lambda t: rows[i]@propagate(mode, z, t), a,
+                                 b, xtol=xtol)
+                    if best is None or tau < best[0]:
+                        best = (tau, targets[i])
+                if best is not None:
+                    return best[0], best[1], None
+                z_lo = z_hi
+            return None, None, z_lo
+
+        times = np.asarray(times, dtype=float)
+        states = np.empty((len(times), 4))
+        states[0] = initial_conditions
+        torque = -k@states[0]
+        mode = 0 if np.abs(torque) <= max_torque else int(np.sign(torque))
+
+        z = np.hstack((states[0], 1.0))
+        for i, h in enumerate(np.diff(times)):
+            remaining = h
+            num_switches = 0
+            while True:
+                next_mode = active(mode, z)
+                if next_mode is None:
+                    if remaining <= 0.0:
+                        break
+                    tau, next_mode, z_end = first_switch(mode, z, remaining)
+                    if next_mode is None:
+                        z = z_end
+                        break
+                    z = propagate(mode, z, tau)
+                    remaining = remaining - tau
+                num_switches += 1
+                if num_switches > self.max_switches:
+                    raise RuntimeError(
+                        'The controller switched saturation more than {} '
+                        'times between {} s and {} s.'.format(
+                            self.max_switches, times[i], times[i + 1]))
+                mode = next_mode
+            states[i + 1] = z[:4]
+
+        inputs = np.zeros((len(times), 2))
+        inputs[:, 1] = np.clip(-states@k, -max_torque, max_torque)
+
+        return states, inputs
+
+    def plot_saturated_simulation(self, times, initial_conditions,
+                                  max_torque=7.0, **parameter_overrides):
+        """Returns the state and input trajectories at each time value of the
+        saturated closed loop model, see ``simulate_saturated()``.
+
+        Parameters
+        ==========
+        times : array_like, shape(n,)
+            Monotonic increasing time values to simulate over.
+        initial_conditions : array_like, shape(4,)
+            Initial values of the states.
+        max_torque : float, optional
+            Magnitude of the steer torque at which the controller saturates
+            [Nm].
+        **parameter_overrides : dictionary
+            Parameter keys that map to floats.
+
+        Returns
+        =======
+        axes : ndarray, shape(3,)
+            Three subplots that plot the input trajectories, state angle
+            trajectories, and state angular rates.
+
+        """
+        res, inputs = self.simulate_saturated(times, initial_conditions,
+                                              max_torque=max_torque,
+                                              **parameter_overrides)
+
+        fig, axes = plt.subplots(3, sharex=True)
+
+        axes[0].plot(times, inputs)
+        axes[0].legend([r'$T_\phi$', r'$T_\delta$'])
+        axes[1].plot(times, np.rad2deg(res[:, :2]))
+        axes[1].legend(['$' + lab + '$' for lab in self.state_vars_latex[:2]])
+        axes[2].plot(times, np.rad2deg(res[:, 2:]))
+        axes[2].legend(['$' + lab + '$' for lab in self.state_vars_latex[2:]])
+
+        axes[2].set_xlabel('Time [s]')
+
+        return axes
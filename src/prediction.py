@@ -0,0 +1,88 @@
+"""Predicted fall probabilities of a fitted fall model with delta method
+confidence bands on grids over the model's variables."""
+import numpy as np
+from scipy.special import expit, ndtri
+
+from regression import design_matrix
+
+# variables of the fall model, see regression.COEFFICIENTS
+VARIABLES = ['X', 'angular_impulse', 'balance_assist', 'roll_angle',
+             'steer_angle']
+
+
+def covariate_grid(**axes):
+    """Returns the variables of the fall model on the grid spanned by the
+    given axes.
+
+    Parameters
+    ==========
+    **axes : dictionary
+        Maps variables in ``VARIABLES`` to array_like of shape(n_k,). The
+        remaining variables are zero, i.e. their (centered) mean, and the
+        balance assist is off.
+
+    Returns
+    =======
+    variables : dictionary
+        Maps all variables in ``VARIABLES`` to arrays of shape(N,) where N
+        is the product of the axes' lengths.
+    shape : tuple
+        Shape of the grid, one dimension per axis in the given order.
+
+    """
+    unknown = set(axes) - set(VARIABLES)
+    if unknown:
+        raise ValueError('Unknown variables {}.'.format(sorted(unknown)))
+    values = [np.asarray(v, dtype=float) for v in axes.values()]
+    shape = tuple(len(v) for v in values)
+    grids = np.meshgrid(*values, indexing='ij', sparse=True)
+    variables = {name: np.zeros(int(np.prod(shape))) for name in VARIABLES}
+    for name, grid in zip(axes, grids):
+        variables[name] = np.broadcast_to(grid, shape).ravel()
+    return variables, shape
+
+
+def predict_grid(beta, cov, level=0.95, **axes):
+    """Returns the predicted fall probability and its confidence band on a
+    grid.
+
+    Parameters
+    ==========
+    beta : ndarray, shape(10,)
+        Coefficients of the fall model in the order of
+        ``regression.COEFFICIENTS``, e.g. from ``regression.irls()`` or the
+        fixed effects of ``glmm.fit_glmm()``.
+    cov : ndarray, shape(10, 10)
+        Covariance of the coefficients.
+    level : float, optional
+        Confidence level of the band.
+    **axes : dictionary
+        See ``covariate_grid()``, e.g.
+        ``angular_impulse=np.linspace(-2.5, 2.5, 501), balance_assist=[0, 1]``.
+
+    Returns
+    =======
+    probability : ndarray, shape(n_1, ..., n_k)
+        Predicted fall probability, one dimension per axis.
+    lower : ndarray, shape(n_1, ..., n_k)
+    upper : ndarray, shape(n_1, ..., n_k)
+        Bounds of the confidence band.
+
+    Notes
+    =====
+    The variance of the log-odds of every grid point is the quadratic form
+    ``x @ cov @ x`` of its model matrix row (the delta method of a linear
+    predictor), evaluated for all points with one matrix product and a row
+    wise dot product. The band is computed on the log-odds scale and
+    transformed to probabilities like ``predict(..., se.fit = TRUE)`` in
+    ggeffects, so it stays within zero and one.
+
+    """
+    variables, shape = covariate_grid(**axes)
+    X = design_matrix(variables)
+    log_odds = X @ beta
+    se = np.sqrt(np.einsum('ij,ij->i', X @ cov, X))
+    half_width = ndtri(0.5 + level/2)*se
+    return (expit(log_odds).reshape(shape),
+            expit(log_odds - half_width).reshape(shape),
+            expit(log_odds + half_width).reshape(shape))
@@ -0,0 +1,289 @@
+"""Binomial logistic regression of the ``fall`` outcome fitted by iteratively
+reweighted least squares (IRLS) with NumPy, giving the same estimates as
+``glm(..., family = binomial)`` in ``src/statistics.R``.
+
+Usage::
+
+    python src/regression.py
+
+prints the coefficient tables for the 6 and 10 km/h data.
+
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.special import expit, ndtr
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DATA_PATHS = {
+    6: os.path.join(ROOT, 'data', 'all_perturbations_6kmh.csv'),
+    10: os.path.join(ROOT, 'data', 'all_perturbations_10kmh.csv'),
+}
+
+# NOTE : The coefficients are named and ordered as R names and orders the
+# terms of
+# fall ~ X + angular_impulse + balance_assist + roll_angle + steer_angle +
+#        balance_assist:roll_angle + balance_assist:steer_angle +
+#        balance_assist:X + balance_assist:angular_impulse
+# with balance_assist a factor with the reference level 0.
+MAIN_EFFECTS = ['X', 'angular_impulse', 'balance_assist1', 'roll_angle',
+                'steer_angle']
+# maps the interaction coefficients to the variable multiplied with the
+# balance assist state
+INTERACTIONS = {
+    'balance_assist1:roll_angle': 'roll_angle',
+    'balance_assist1:steer_angle': 'steer_angle',
+    'X:balance_assist1': 'X',
+    'angular_impulse:balance_assist1': 'angular_impulse',
+}
+COEFFICIENTS = ['(Intercept)'] + MAIN_EFFECTS + list(INTERACTIONS)
+
+
+def design_matrix(table):
+    """Returns the model matrix with the columns in ``COEFFICIENTS``.
+
+    Parameters
+    ==========
+    table : pandas.DataFrame or dictionary
+        One of the ``all_perturbations_*.csv`` tables or a dictionary that
+        maps the variables of the model to arrays of shape(n,).
+
+    Returns
+    =======
+    ndarray, shape(n, 10)
+
+    """
+    assist = (np.asarray(table['balance_assist']) == 1).astype(float)
+    columns = {'(Intercept)': np.ones(len(assist)), 'balance_assist1': assist}
+    for name in ['X', 'angular_impulse', 'roll_angle', 'steer_angle']:
+        columns[name] = np.asarray(table[name], dtype=float)
+    for name, variable in INTERACTIONS.items():
+        columns[name] = assist*columns[variable]
+    return np.column_stack([columns[name] for name in COEFFICIENTS])
+
+
+def grid_design_matrix(angular_impulse, balance_assist):
+    """Returns the model matrix of perturbations with the given angular
+    impulses and balance assist state and all other variables at zero, i.e.
+    the ``dummy_data_on`` and ``dummy_data_off`` of ``statistics.R``.
+
+    Parameters
+    ==========
+    angular_impulse : array_like, shape(n,)
+        Centered and scaled angular impulse.
+    balance_assist : integer
+        0 for off and 1 for on.
+
+    Returns
+    =======
+    ndarray, shape(n, 10)
+
+    """
+    angular_impulse = np.asarray(angular_impulse, dtype=float)
+    zeros = np.zeros_like(angular_impulse)
+    return design_matrix({
+        'X': zeros,
+        'angular_impulse': angular_impulse,
+        'balance_assist': np.full(len(angular_impulse), balance_assist),
+        'roll_angle': zeros,
+        'steer_angle': zeros,
+    })
+
+
+def irls(X, y, weights=None, beta0=None, tol=1e-8, max_iter=25):
+    """Returns the maximum likelihood estimates of one or more logistic
+    regressions that are fitted together.
+
+    Parameters
+    ==========
+    X : array_like, shape(n, p) or shape(m, n, p)
+        Model matrices.
+    y : array_like, shape(n,) or shape(m, n)
+        Outcomes, 0 or 1.
+    weights : array_like, shape(n,) or shape(m, n), optional
+        Prior weights, e.g. zero for rows that only pad a shorter data set
+        to the length of the others.
+    beta0 : array_like, shape(p,) or shape(m, p), optional
+        Starting coefficients, e.g. from a previous fit. If None, the fit
+        starts from R's ``mustart`` of ``(weights*y + 0.5)/(weights + 1)``.
+    tol : float, optional
+        Convergence tolerance on the relative change of the deviance, as
+        ``glm.control(epsilon=)``.
+    max_iter : integer, optional
+        Maximum number of iterations, as ``glm.control(maxit=)``.
+
+    Returns
+    =======
+    beta : ndarray, shape(p,) or shape(m, p)
+        Coefficients.
+    cov : ndarray, shape(p, p) or shape(m, p, p)
+        Covariance of the coefficients, the inverse of the Fisher
+        information.
+    deviance : float or ndarray, shape(m,)
+        Residual deviance.
+    converged : bool or ndarray, shape(m,)
+    num_iter : integer
+        Number of iterations until all fits converged.
+
+    Notes
+    =====
+    Each iteration forms the normal equations of all fits with batched
+    matrix products and solves them with one ``numpy.linalg.solve()``. Fits
+    that have converged are no longer updated, so each fit stops at the same
+    iterate as it would on its own.
+
+    """
+    X = np.asarray(X, dtype=float)
+    single = X.ndim == 2
+    X = X[np.newaxis] if single else X
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    if weights is None:
+        weights = np.ones_like(y)
+    weights = np.atleast_2d(np.asarray(weights, dtype=float))
+    m, _, p = X.shape
+
+    if beta0 is None:
+        mu = (weights*y + 0.5)/(weights + 1.0)
+        eta = np.log(mu/(1.0 - mu))
+    else:
+        beta0 = np.broadcast_to(np.asarray(beta0, dtype=float), (m, p))
+        eta = (X @ beta0[..., np.newaxis])[..., 0]
+        mu = expit(eta)
+    deviance = _deviance(y, mu, weights)
+
+    beta = np.zeros((m, p))
+    info = np.empty((m, p, p))
+    converged = np.zeros(m, dtype=bool)
+    num_iter = 0
+    while not np.all(converged) and num_iter < max_iter:
+        num_iter += 1
+        fit = ~converged
+        Xf, yf, mf, ef = X[fit], y[fit], mu[fit], eta[fit]
+        variance = mf*(1.0 - mf)
+        w = weights[fit]*variance
+        z = ef + (yf - mf)/variance
+        XfT = np.swapaxes(Xf, 1, 2)
+        info[fit] = XfT @ (w[..., np.newaxis]*Xf)
+        beta[fit] = np.linalg.solve(info[fit],
+                                    XfT @ (w*z)[..., np.newaxis])[..., 0]
+        eta[fit] = (Xf @ beta[fit][..., np.newaxis])[..., 0]
+        mu[fit] = expit(eta[fit])
+        old_deviance = deviance[fit]
+        deviance[fit] = _deviance(yf, mu[fit], weights[fit])
+        converged[fit] = (np.abs(deviance[fit] - old_deviance) /
+                          (np.abs(deviance[fit]) + 0.1) < tol)
+
+    # NOTE : R's summary.glm() also uses the weights of the last iteration.
+    cov = np.linalg.inv(info)
+    if single:
+        return beta[0], cov[0], deviance[0], converged[0], num_iter
+    return beta, cov, deviance, converged, num_iter
+
+
+def _deviance(y, mu, weights):
+    # y*log(y/mu) and (1 - y)*log((1 - y)/(1 - mu)) vanish for y = 0 and 1
+    mu = np.clip(mu, np.finfo(float).eps, 1.0 - np.finfo(float).eps)
+    log_lik = np.where(y > 0.5, np.log(mu), np.log1p(-mu))
+    return -2.0*np.sum(weights*log_lik, axis=-1)
+
+
+def stack_tables(tables):
+    """Returns the model matrices, outcomes and weights of several tables
+    padded with zero weight rows to the same length.
+
+    Parameters
+    ==========
+    tables : list of pandas.DataFrame
+
+    Returns
+    =======
+    X : ndarray, shape(m, n, p)
+    y : ndarray, shape(m, n)
+    weights : ndarray, shape(m, n)
+
+    """
+    n = max(len(table) for table in tables)
+    X = np.zeros((len(tables), n, len(COEFFICIENTS)))
+    y = np.zeros((len(tables), n))
+    weights = np.zeros((len(tables), n))
+    for i, table in enumerate(tables):
+        X[i, :len(table)] = design_matrix(table)
+        y[i, :len(table)] = table['fall'].to_numpy(dtype=float)
+        weights[i, :len(table)] = 1.0
+    return X, y, weights
+
+
+def coefficient_table(beta, cov):
+    """Returns R's ``summary.glm()`` coefficient table.
+
+    Parameters
+    ==========
+    beta : ndarray, shape(p,)
+    cov : ndarray, shape(p, p) or None
+        If None, e.g. of a fit without the Hessian, only the estimates and
+        odds ratios are given and the other columns are NaN.
+
+    Returns
+    =======
+    pandas.DataFrame
+        With the columns ``Estimate``, ``Std. Error``, ``z value``,
+        ``Pr(>|z|)``, the odds ratio ``exp(Est.)`` and its 95% confidence
+        interval ``2.5%`` and ``97.5%``.
+
+    """
+    if cov is None:
+        se = np.full_like(beta, np.nan, dtype=float)
+    else:
+        se = np.sqrt(np.diag(cov))
+    z = beta/se
+    half_width = 1.959963984540054*se
+    return pd.DataFrame({
+        'Estimate': beta,
+        'Std. Error': se,
+        'z value': z,
+        'Pr(>|z|)': 2.0*ndtr(-np.abs(z)),
+        'exp(Est.)': np.exp(beta),
+        '2.5%': np.exp(beta - half_width),
+        '97.5%': np.exp(beta + half_width),
+    }, index=COEFFICIENTS)
+
+
+def fit_fall_models(tables, **kwargs):
+    """Returns the coefficient tables of the fall model fitted to each table
+    in one batched fit.
+
+    Parameters
+    ==========
+    tables : dictionary
+        Maps a label, e.g. the speed in km/h, to one of the
+        ``all_perturbations_*.csv`` tables.
+    **kwargs
+        Passed to ``irls()``.
+
+    Returns
+    =======
+    dictionary
+        Maps the labels to the ``coefficient_table()`` of each fit.
+
+    """
+    labels = list(tables)
+    X, y, weights = stack_tables([tables[label] for label in labels])
+    beta, cov, _, converged, _ = irls(X, y, weights=weights, **kwargs)
+    if not np.all(converged):
+        raise ValueError('IRLS did not converge for {}.'.format(
+            [label for label, c in zip(labels, converged) if not c]))
+    return {label: coefficient_table(beta[i], cov[i])
+            for i, label in enumerate(labels)}
+
+
+def main():
+    tables = {speed: pd.read_csv(path) for speed, path in DATA_PATHS.items()}
+    for speed, coefficients in fit_fall_models(tables).items():
+        print('Logistic regression at {} km/h:'.format(speed))
+        print(coefficients.round(4).to_string())
+        print('=' * 79)
+
+
+if __name__ == '__main__':
+    main()
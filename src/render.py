@@ -0,0 +1,98 @@
+"""Renders the figures of ``control.py`` in parallel processes from results
+that are computed once.
+
+Usage::
+
+    python src/render.py                  # all figures
+    python src/render.py eig simulation   # only these figures
+    python src/render.py --processes 2
+
+The eigenvalue sweeps, stability boundaries and the simulation are computed
+(or read from the eigenvalue cache) by this process first and written to a
+temporary directory of ``.npy`` files. Each worker memory maps these files,
+so the workers share one copy of the results and only draw the figures with
+the non-interactive Agg backend. The figures and the printed numbers are the
+same as those of ``python src/control.py``.
+"""
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import control
+from eigen_cache import EigenCache
+
+# large enough to hold all results of the figures in memory
+MAXSIZE = 1024
+
+
+def _init_worker(directory):
+    import matplotlib
+    matplotlib.use('Agg')
+    cache = EigenCache(maxsize=MAXSIZE, salt=control.CACHE_SALT)
+    cache.load(directory)
+    control.set_eigen_cache(cache)
+
+
+def _render(name):
+    import matplotlib.pyplot as plt
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        control.FIGURES[name]()
+    plt.close('all')
+    return out.getvalue()
+
+
+def render(names=None, processes=None):
+    """Renders figures in parallel.
+
+    Parameters
+    ==========
+    names : list of strings, optional
+        Keys of ``control.FIGURES``, defaults to all.
+    processes : integer, optional
+        Number of worker processes, defaults to the number of figures or
+        CPUs, whichever is smaller.
+
+    Returns
+    =======
+    list of strings
+        What each figure printed, in the order of ``names``.
+
+    """
+    names = list(control.FIGURES) if not names else list(names)
+    unknown = set(names) - set(control.FIGURES)
+    if unknown:
+        raise ValueError('Unknown figures {}.'.format(sorted(unknown)))
+    if processes is None:
+        processes = min(len(names), os.cpu_count() or 1)
+
+    control.set_eigen_cache(EigenCache(control.CACHE_DIR, maxsize=MAXSIZE,
+                                       salt=control.CACHE_SALT))
+    control.precompute()
+
+    with tempfile.TemporaryDirectory() as directory:
+        control.get_eigen_cache().dump(directory)
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_worker,
+                                 initargs=(directory,)) as executor:
+            return list(executor.map(_render, names))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*',
+                        help='Figures to render, defaults to all: {}.'.format(
+                            ', '.join(control.FIGURES)))
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Number of worker processes.')
+    args = parser.parse_args()
+    # print in the order of the serial build, whichever figure finished first
+    for text in render(args.names, processes=args.processes):
+        print(text, end='')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""Participant level bootstrap confidence intervals and permutation tests for
+the fall logistic regression of ``regression.py``.
+
+Usage::
+
+    python src/resampling.py
+
+prints the bootstrap odds ratio intervals and the permutation test of the
+balance assist effect for the 6 and 10 km/h data.
+
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.special import expit
+
+from regression import (COEFFICIENTS, DATA_PATHS, INTERACTIONS, design_matrix,
+                        grid_design_matrix, irls)
+
+ASSIST_IDX = COEFFICIENTS.index('balance_assist1')
+# columns of the model matrix that are products with the balance assist state
+# and the columns of their variables
+INTERACTION_IDXS = np.array([COEFFICIENTS.index(name)
+                             for name in INTERACTIONS])
+VARIABLE_IDXS = np.array([COEFFICIENTS.index(variable)
+                          for variable in INTERACTIONS.values()])
+
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def prepare(table):
+    """Returns the arrays that the resampling chunks need.
+
+    Parameters
+    ==========
+    table : pandas.DataFrame
+        One of the ``all_perturbations_*.csv`` tables.
+
+    Returns
+    =======
+    dictionary
+        With the model matrix ``X``, the outcomes ``y``, the participant
+        number ``groups`` of each row, the number of participants
+        ``num_groups`` and the full data estimates ``beta`` and ``cov``
+        that warm start the refits.
+
+    """
+    X = design_matrix(table)
+    y = table['fall'].to_numpy(dtype=float)
+    beta, cov, _, converged, _ = irls(X, y)
+    if not converged:
+        raise ValueError('IRLS did not converge for the full data.')
+    groups, participants = pd.factorize(table['participant_id'])
+    return {'X': X, 'y': y, 'groups': groups,
+            'num_groups': len(participants), 'beta': beta, 'cov': cov}
+
+
+def _fit_chunk(X, y, weights, beta0):
+    # NOTE : One singular information matrix makes the batched solve of irls()
+    # fail for all fits, so the fits are then repeated one at a time and those
+    # that fail are returned as NaN and not converged.
+    try:
+        beta, cov, _, converged, _ = irls(X, y, weights=weights, beta0=beta0)
+        return beta, cov, converged
+    except np.linalg.LinAlgError:
+        pass
+    size, _, p = X.shape
+    beta = np.full((size, p), np.nan)
+    cov = np.full((size, p, p), np.nan)
+    converged = np.zeros(size, dtype=bool)
+    for i in range(size):
+        try:
+            beta[i], cov[i], _, converged[i], _ = irls(
+                X[i], y[i], weights=None if weights is None else weights[i],
+                beta0=beta0)
+        except np.linalg.LinAlgError:
+            pass
+    return beta, cov, converged
+
+
+def _bootstrap_chunk(args, data=None):
+    if data is None:
+        data = _worker_data
+    seed, size = args
+    rng = np.random.default_rng(seed)
+    num_groups = data['num_groups']
+    # drawing the participants with replacement is the same as weighting
+    # each participant's rows by the number of times it is drawn
+    counts = rng.multinomial(num_groups, np.full(num_groups, 1/num_groups),
+                             size=size)
+    X = np.broadcast_to(data['X'], (size,) + data['X'].shape)
+    y = np.broadcast_to(data['y'], (size, len(data['y'])))
+    beta, _, converged = _fit_chunk(X, y, counts[:, data['groups']],
+                                    data['beta'])
+    beta[~converged] = np.nan
+    return beta
+
+
+def _permutation_chunk(args, data=None):
+    if data is None:
+        data = _worker_data
+    seed, size = args
+    rng = np.random.default_rng(seed)
+    # swap the balance assist labels of all rows of a random half of the
+    # participants
+    flips = rng.integers(2, size=(size, data['num_groups']), dtype=bool)
+    X = np.repeat(data['X'][np.newaxis], size, axis=0)
+    assist = np.where(flips[:, data['groups']], 1.0 - X[..., ASSIST_IDX],
+                      X[..., ASSIST_IDX])
+    X[..., ASSIST_IDX] = assist
+    X[..., INTERACTION_IDXS] = assist[..., np.newaxis]*X[..., VARIABLE_IDXS]
+    y = np.broadcast_to(data['y'], (size, len(data['y'])))
+    beta, cov, converged = _fit_chunk(X, y, None, data['beta'])
+    z = beta[:, ASSIST_IDX]/np.sqrt(cov[:, ASSIST_IDX, ASSIST_IDX])
+    z[~converged] = np.nan
+    return z
+
+
+def _run_chunks(func, data, num, seed, chunk_size, processes):
+    # NOTE : Each chunk has its own random stream spawned from the seed and
+    # the chunks do not depend on the number of processes, so the results
+    # are reproducible for any number of processes.
+    sizes = [min(chunk_size, num - start)
+             for start in range(0, num, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    chunks = list(zip(seeds, sizes))
+
+    if processes is None:
+        processes = os.cpu_count()
+
+    if processes == 1 or len(chunks) == 1:
+        results = [func(chunk, data=data) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_worker,
+                                 initargs=(data,)) as executor:
+            results = list(executor.map(func, chunks))
+    return np.concatenate(results)
+
+
+def bootstrap_coefficients(table, num_resamples=10000, seed=None,
+                           chunk_size=500, processes=None):
+    """Returns the coefficients refitted to participant level bootstrap
+    resamples.
+
+    Parameters
+    ==========
+    table : pandas.DataFrame
+        One of the ``all_perturbations_*.csv`` tables.
+    num_resamples : integer, optional
+        Number of bootstrap resamples.
+    seed : integer, optional
+        Seed of the random number generator.
+    chunk_size : integer, optional
+        Number of resamples refitted in one batched IRLS.
+    processes : integer, optional
+        Number of worker processes, defaults to the number of CPUs. If 1,
+        the chunks are refitted in this process.
+
+    Returns
+    =======
+    ndarray, shape(num_resamples, 10)
+        Coefficients in the order of ``COEFFICIENTS``, NaN for resamples
+        whose fit does not converge, e.g. due to separation.
+
+    Notes
+    =====
+    Each resample draws as many participants as there are with replacement
+    and keeps all perturbations of the drawn participants, so the
+    dependence of the perturbations of one participant is kept.
+
+    """
+    data = prepare(table)
+    return _run_chunks(_bootstrap_chunk, data, num_resamples, seed,
+                       chunk_size, processes)
+
+
+def bootstrap_intervals(table, angular_impulse=None, level=0.95, **kwargs):
+    """Returns percentile bootstrap intervals of the odds ratios and of the
+    predicted fall probabilities.
+
+    Parameters
+    ==========
+    table : pandas.DataFrame
+        One of the ``all_perturbations_*.csv`` tables.
+    angular_impulse : array_like, shape(n,), optional
+        Centered and scaled angular impulses at which the fall probability
+        is predicted with all other variables at zero, defaults to the
+        grid of ``statistics.R``.
+    level : float, optional
+        Confidence level.
+    **kwargs
+        Passed to ``bootstrap_coefficients()``.
+
+    Returns
+    =======
+    odds_ratios : pandas.DataFrame
+        The full data odds ratio ``exp(Est.)`` and its interval bounds for
+        each coefficient.
+    predictions : pandas.DataFrame
+        With the columns ``angular_impulse``, ``balance_assist``,
+        ``prediction`` and the interval bounds.
+    num_converged : integer
+        Number of resamples the intervals are computed from.
+
+    """
+    if angular_impulse is None:
+        angular_impulse = np.linspace(-2.5, 2.5, num=501)
+    angular_impulse = np.asarray(angular_impulse, dtype=float)
+
+    beta_hat = prepare(table)['beta']
+    betas = bootstrap_coefficients(table, **kwargs)
+    betas = betas[~np.isnan(betas).any(axis=1)]
+    bounds = [50*(1 - level), 50*(1 + level)]
+    labels = ['{:g}%'.format(bound) for bound in bounds]
+
+    lower, upper = np.exp(np.percentile(betas, bounds, axis=0))
+    odds_ratios = pd.DataFrame({'exp(Est.)': np.exp(beta_hat),
+                                labels[0]: lower, labels[1]: upper},
+                               index=COEFFICIENTS)
+
+    predictions = []
+    for balance_assist in (1, 0):
+        X = grid_design_matrix(angular_impulse, balance_assist)
+        lower, upper = np.percentile(expit(betas @ X.T), bounds, axis=0)
+        predictions.append(pd.DataFrame({
+            'angular_impulse': angular_impulse,
+            'balance_assist': balance_assist,
+            'prediction': expit(X @ beta_hat),
+            labels[0]: lower,
+            labels[1]: upper,
+        }))
+
+    return odds_ratios, pd.concat(predictions, ignore_index=True), len(betas)
+
+
+def permutation_test(table, num_permutations=10000, seed=None,
+                     chunk_size=500, processes=None):
+    """Returns the permutation p-value of the balance assist effect.
+
+    Parameters
+    ==========
+    table : pandas.DataFrame
+        One of the ``all_perturbations_*.csv`` tables.
+    num_permutations : integer, optional
+        Number of random permutations.
+    seed, chunk_size, processes
+        See ``bootstrap_coefficients()``.
+
+    Returns
+    =======
+    z : float
+        Wald z value of ``balance_assist1`` of the full data.
+    p_value : float
+        Two sided p-value.
+    null_z : ndarray, shape(num_permutations,)
+        z values of the permutations, NaN if the fit does not converge.
+
+    Notes
+    =====
+    Every participant rode with the balance assist both off and on, so the
+    labels are permuted by swapping off and on for all perturbations of a
+    random half of the participants. This is exact under the null
+    hypothesis that the balance assist state, including its interactions,
+    has no effect on falling.
+
+    """
+    data = prepare(table)
+    z = data['beta'][ASSIST_IDX]/np.sqrt(data['cov'][ASSIST_IDX, ASSIST_IDX])
+    null_z = _run_chunks(_permutation_chunk, data, num_permutations, seed,
+                         chunk_size, processes)
+    valid = null_z[~np.isnan(null_z)]
+    p_value = (1 + np.sum(np.abs(valid) >= np.abs(z)))/(1 + len(valid))
+    return z, p_value, null_z
+
+
+def main():
+    for speed, path in DATA_PATHS.items():
+        table = pd.read_csv(path)
+        odds_ratios, _, num = bootstrap_intervals(table, seed=speed)
+        print('Participant bootstrap at {} km/h ({} resamples):'.format(
+            speed, num))
+        print(odds_ratios.round(2).to_string())
+        z, p_value, _ = permutation_test(table, seed=speed)
+        print('Permutation test of balance_assist1: z = {:.2f}, '
+              'p = {:.4f}'.format(z, p_value))
+        print('=' * 79)
+
+
+if __name__ == '__main__':
+    main()
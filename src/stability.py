@@ -0,0 +1,139 @@
+"""Closed loop stability maps over two parameters of a SteerControlModel,
+e.g. speed and the roll rate gain, evaluated in chunks on a process pool."""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# imaginary parts smaller than this are treated as real eigenvalues
+IMAG_TOL = 1e-10
+
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def closed_loop_eigenvalues(model, **parameter_overrides):
+    """Returns the eigenvalues of (A - B*K) without the eigenvectors.
+
+    Parameters
+    ==========
+    model : SteerControlModel
+    **parameter_overrides : dictionary
+        Parameter keys that map to floats or array_like of floats shape(n,).
+
+    Returns
+    =======
+    evals : ndarray, shape(4,) or shape(n,4)
+
+    """
+    A, _ = model.form_state_space_matrices(**parameter_overrides)
+    return np.linalg.eigvals(A)
+
+
+def max_real_and_weave_freq(evals):
+    """Returns the largest real part and the weave frequency of sets of
+    eigenvalues.
+
+    Parameters
+    ==========
+    evals : ndarray, shape(n,4)
+
+    Returns
+    =======
+    max_real : ndarray, shape(n,)
+        Largest real part [1/s].
+    weave_freq : ndarray, shape(n,)
+        Magnitude of the imaginary part [rad/s] of the oscillatory eigenvalue
+        with the largest real part, NaN if all eigenvalues are real.
+
+    """
+    max_real = np.max(evals.real, axis=-1)
+    oscillatory = np.abs(evals.imag) > IMAG_TOL
+    real_parts = np.where(oscillatory, evals.real, -np.inf)
+    idx = np.argmax(real_parts, axis=-1)[..., np.newaxis]
+    weave_freq = np.abs(np.take_along_axis(evals.imag, idx, axis=-1))[..., 0]
+    weave_freq[~np.any(oscillatory, axis=-1)] = np.nan
+    return max_real, weave_freq
+
+
+def _map_chunk(parameter_overrides, model=None):
+    if model is None:
+        model = _worker_model
+    evals = closed_loop_eigenvalues(model, **parameter_overrides)
+    return max_real_and_weave_freq(evals)
+
+
+def stability_map(model, x_name, x_values, y_name, y_values, chunk_size=65536,
+                  processes=None, **parameter_overrides):
+    """Returns the largest real part and weave frequency of the closed loop
+    eigenvalues on a grid over two parameters.
+
+    Parameters
+    ==========
+    model : SteerControlModel
+    x_name : string
+        Parameter that varies along the columns of the map, e.g. ``'v'``.
+    x_values : array_like, shape(nx,)
+        Values of ``x_name``.
+    y_name : string
+        Parameter that varies along the rows of the map, e.g. ``'kphidot'``.
+    y_values : array_like, shape(ny,)
+        Values of ``y_name``.
+    chunk_size : integer, optional
+        Number of grid points evaluated in one batch.
+    processes : integer, optional
+        Number of worker processes, defaults to the number of CPUs. If 1,
+        the chunks are evaluated in this process.
+    **parameter_overrides : dictionary
+        Scalar overrides of the remaining parameters.
+
+    Returns
+    =======
+    X : ndarray, shape(ny,nx)
+        Grid of the x values.
+    Y : ndarray, shape(ny,nx)
+        Grid of the y values.
+    max_real : ndarray, shape(ny,nx)
+        Largest real part of the eigenvalues [1/s], the stable region is
+        ``max_real < 0``.
+    weave_freq : ndarray, shape(ny,nx)
+        Weave frequency [rad/s], see ``max_real_and_weave_freq()``.
+
+    ``X``, ``Y`` and the maps can be passed directly to matplotlib's
+    ``contour()``, e.g. ``ax.contour(X, Y, max_real, levels=[0.0])`` draws
+    the stability boundary.
+
+    """
+    X, Y = np.meshgrid(np.asarray(x_values, dtype=float),
+                       np.asarray(y_values, dtype=float))
+    x_flat, y_flat = X.ravel(), Y.ravel()
+
+    max_real = np.empty(X.size)
+    weave_freq = np.empty(X.size)
+
+    slices = [slice(start, min(start + chunk_size, X.size))
+              for start in range(0, X.size, chunk_size)]
+    chunk_overrides = [dict(parameter_overrides,
+                            **{x_name: x_flat[s], y_name: y_flat[s]})
+                       for s in slices]
+
+    if processes is None:
+        processes = os.cpu_count()
+
+    if processes == 1 or len(slices) == 1:
+        results = [_map_chunk(overrides, model=model)
+                   for overrides in chunk_overrides]
+    else:
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_worker,
+                                 initargs=(model,)) as executor:
+            results = list(executor.map(_map_chunk, chunk_overrides))
+
+    for s, (max_real_i, weave_freq_i) in zip(slices, results):
+        max_real[s], weave_freq[s] = max_real_i, weave_freq_i
+
+    return X, Y, max_real.reshape(X.shape), weave_freq.reshape(X.shape)
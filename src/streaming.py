@@ -0,0 +1,371 @@
+"""Online detection of the perturbations of a session while it is logged.
+
+Usage::
+
+    python src/streaming.py session.parquet --block-size 100
+
+replays a session file in blocks of samples, as they would arrive from the
+Teensy, and prints each perturbation window when it is complete.
+"""
+import argparse
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from generate_time_series_imgs import (DESIRED_FORCES, DURATION_AFTER,
+                                       DURATION_BEFORE, PULSE_DURATION,
+                                       TRACKING_FORCE, PerturbationSet)
+
+# blocks of this many samples or less are logging errors, see
+# get_perturbation_indices()
+MIN_BLOCK_SAMPLES = 30
+
+
+def block_edges(values, in_block):
+    """Returns the positions at which perturbation blocks start and stop in
+    a block of samples of one desired force channel.
+
+    Parameters
+    ----------
+    values : numpy.ndarray, shape(n,)
+        Desired force samples.
+    in_block : bool
+        True if the channel was in a block at the end of the previous
+        samples.
+
+    Returns
+    -------
+    starts : numpy.ndarray of int
+        Positions of the first samples above the tracking force.
+    stops : numpy.ndarray of int
+        Positions of the first samples equal to the tracking force after a
+        start.
+    in_block : bool
+        The state after the last sample.
+    """
+    # 1 switches the block on, 0 switches it off and -1 keeps the last state,
+    # as in get_perturbation_indices()
+    switches = np.where(
+        values > TRACKING_FORCE, 1, np.where(values == TRACKING_FORCE, 0, -1)
+    )
+    last_switch = np.maximum.accumulate(
+        np.where(switches >= 0, np.arange(len(switches)), -1)
+    )
+    state = np.where(
+        last_switch >= 0, switches[np.maximum(last_switch, 0)] == 1, in_block
+    )
+    edges = np.diff(state.astype(np.int8), prepend=np.int8(in_block))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1), bool(state[-1])
+
+
+def closest_before(times, query_time, after):
+    """Returns ``after`` or ``after - 1``, whichever time is closest to
+    `query_time`, where ``times[after]`` is the first time at or after it. Ties
+    go to the earlier time, as in find_closest_indices()."""
+    before = max(after - 1, 0)
+    if abs(times[after] - query_time) < abs(query_time - times[before]):
+        return after
+    return before
+
+
+class _Window:
+
+    __slots__ = ("context_start", "start", "start_time", "sign", "stop",
+                 "stop_time", "values", "length")
+
+    def __init__(self, context_start, start, start_time, sign, values):
+        self.context_start = context_start
+        self.start = start
+        self.start_time = start_time
+        self.sign = sign
+        self.stop = None
+        self.stop_time = None
+        self.values = values
+        self.length = 0
+
+
+class StreamingDetector:
+    """Finds the perturbations in blocks of samples that arrive one after the
+    other and emits the window of each perturbation as soon as it is complete.
+
+    The windows are the same as those of ``get_perturbations()`` of the whole
+    session: from the sample closest to `duration_before` seconds before the
+    first sample above the tracking force until the sample closest to
+    `duration_after` seconds after the next sample at the tracking force
+    (exclusive), with blocks of 30 samples or less dropped. Only a buffer of
+    the last `duration_before` seconds of samples and a buffer per open
+    window are kept, so the memory does not grow with the length of the
+    session.
+
+    Parameters
+    ----------
+    columns : List[str]
+        Names of the numeric channels of each block, including
+        ``seconds_since_start`` and the desired forces.
+    duration_before : float, optional
+        Duration in seconds before the perturbation is applied that should be
+        included.
+    duration_after : float, optional
+        Duration in seconds after the perurbation has ended that should be
+        included.
+    sample_rate : float, optional
+        Highest sample rate in Hz, which sizes the buffers.
+    max_pulse_duration : float, optional
+        Blocks above the tracking force that last longer are dropped, so the
+        window buffers have a fixed size.
+    """
+
+    def __init__(
+        self,
+        columns,
+        duration_before=DURATION_BEFORE,
+        duration_after=DURATION_AFTER,
+        sample_rate=1000.0,
+        max_pulse_duration=10 * PULSE_DURATION,
+    ):
+        self.columns = list(columns)
+        self.duration_before = duration_before
+        self.duration_after = duration_after
+        self._time_row = self.columns.index("seconds_since_start")
+        self._force_rows = [self.columns.index(name) for name in DESIRED_FORCES]
+        # one extra sample for the closest sample before the window and a
+        # margin for timestamp jitter
+        self._history = np.empty(
+            (len(self.columns), int(np.ceil(1.25 * duration_before * sample_rate)) + 2)
+        )
+        self._history_length = 0
+        self._window_size = (
+            int(
+                np.ceil(
+                    1.25
+                    * (duration_before + max_pulse_duration + duration_after)
+                    * sample_rate
+                )
+            )
+            + 2
+        )
+        self._in_block = {row: False for row in self._force_rows}
+        self._open = {}  # window of the open block of each channel
+        self._windows = []  # windows that are not complete yet
+        self.num_samples = 0
+        self.num_dropped = 0  # windows that did not fit their buffer
+
+    def _open_window(self, combined, offset, position):
+        # position is the start of a block in the combined samples
+        times = combined[self._time_row]
+        start_time = times[position]
+        query_time = start_time - self.duration_before
+        after = int(np.searchsorted(times[: position + 1], query_time))
+        context_start = offset + closest_before(times, query_time, after)
+        sign = -1.0 if combined[self._force_rows[1], position] > TRACKING_FORCE else 1.0
+        window = _Window(
+            context_start,
+            offset + position,
+            start_time,
+            sign,
+            np.empty((len(self.columns), self._window_size)),
+        )
+        self._windows.append(window)
+        return window
+
+    def _shift_history(self, values):
+        # keeps the last samples of the history followed by the new samples
+        size = self._history.shape[1]
+        n = min(values.shape[1], size)
+        kept = min(self._history_length, size - n)
+        self._history[:, :kept] = self._history[
+            :, self._history_length - kept : self._history_length
+        ]
+        self._history[:, kept : kept + n] = values[:, values.shape[1] - n :]
+        self._history_length = kept + n
+
+    def _discard(self, window):
+        self._windows.remove(window)
+
+    def _emit(self, window):
+        return PerturbationSet(
+            self.columns,
+            window.values[:, : window.length].copy(),
+            [0],
+            [window.length],
+            [window.start_time],
+            [window.stop_time],
+            [window.sign],
+        )
+
+    def push(self, block):
+        """Adds the next samples and returns the windows that are complete.
+
+        Parameters
+        ----------
+        block : pandas.DataFrame, dict or numpy.ndarray
+            The next samples of the ``columns``, a mapping of the names to
+            arrays of shape(n,) or an array of shape(len(columns), n).
+
+        Returns
+        -------
+        List[PerturbationSet]
+            One set per complete window, sorted by the start time. Indexing
+            the set with 0 gives the direction normalized dataframe of the
+            window whose index counts from zero. The sets can be joined with
+            ``+``.
+        """
+        if isinstance(block, np.ndarray):
+            values = np.asarray(block, dtype=float)
+        else:
+            values = np.vstack(
+                [np.asarray(block[name], dtype=float) for name in self.columns]
+            )
+        n = values.shape[1]
+        if n == 0:
+            return []
+        if (
+            not self._windows
+            and not any(self._in_block.values())
+            and values[self._force_rows].max() <= TRACKING_FORCE
+        ):
+            # between perturbations only the history is updated
+            self._shift_history(values)
+            self.num_samples += n
+            return []
+
+        # the history and the new samples, where position p is sample
+        # offset + p of the session
+        combined = np.concatenate(
+            (self._history[:, : self._history_length], values), axis=1
+        )
+        offset = self.num_samples - self._history_length
+        times = combined[self._time_row]
+
+        events = []
+        for row in self._force_rows:
+            starts, stops, self._in_block[row] = block_edges(
+                values[row], self._in_block[row]
+            )
+            events += [(p, 1, row) for p in starts] + [(p, 0, row) for p in stops]
+        for p, is_start, row in sorted(events):
+            position = self._history_length + p
+            if is_start:
+                self._open[row] = self._open_window(combined, offset, position)
+                continue
+            window = self._open.pop(row, None)
+            if window is None:  # dropped for being too long
+                continue
+            if offset + position - window.start > MIN_BLOCK_SAMPLES:
+                window.stop = offset + position
+                window.stop_time = times[position]
+            else:
+                self._discard(window)
+
+        complete = []
+        for window in list(self._windows):
+            first = window.context_start + window.length - offset
+            last = combined.shape[1]
+            done = False
+            if window.stop is not None:
+                query_time = window.stop_time + self.duration_after
+                lo = max(first, window.stop - offset)
+                after = lo + int(np.searchsorted(times[lo:], query_time))
+                if after < last:
+                    last = closest_before(times, query_time, after)
+                    done = True
+            length = last + offset - window.context_start
+            if length > self._window_size:
+                self.num_dropped += 1
+                self._discard(window)
+                for row, open_window in list(self._open.items()):
+                    if open_window is window:
+                        self._open[row] = None
+                continue
+            if last > first:
+                window.values[:, window.length : length] = combined[:, first:last]
+            window.length = length
+            if done:
+                complete.append(window)
+                self._discard(window)
+
+        self._shift_history(values)
+        self.num_samples += n
+
+        complete.sort(key=lambda window: window.start)
+        return [self._emit(window) for window in complete]
+
+    def flush(self):
+        """Returns the windows whose block has stopped but whose time after the
+        perturbation is cut short by the end of the session, as
+        ``get_perturbations()`` does at the end of the data. Blocks that have
+        not stopped are dropped."""
+        complete = []
+        for window in self._windows:
+            if window.stop is not None:
+                # the closest sample to a time after the last is the last but
+                # one, see find_closest_indices()
+                window.length = min(
+                    window.length, self.num_samples - 1 - window.context_start
+                )
+                complete.append(window)
+        self._windows = []
+        self._open = {}
+        complete.sort(key=lambda window: window.start)
+        return [self._emit(window) for window in complete]
+
+
+def replay(path, block_size=100, columns=None):
+    """Yields the windows of a session file found by a StreamingDetector that
+    is fed `block_size` rows at a time.
+
+    Parameters
+    ----------
+    path : str
+        Path to the parquet file.
+    block_size : int, optional
+        Number of rows per block.
+    columns : List[str], optional
+        Numeric columns to read, all if None.
+
+    Yields
+    ------
+    PerturbationSet
+        One set per window, see ``StreamingDetector.push()``.
+    """
+    parquet = pq.ParquetFile(path)
+    if columns is None:
+        columns = [
+            field.name
+            for field in parquet.schema_arrow
+            if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+        ]
+    detector = StreamingDetector(columns)
+    for batch in parquet.iter_batches(batch_size=block_size, columns=columns):
+        values = np.vstack(
+            [batch.column(name).to_numpy(zero_copy_only=False) for name in columns]
+        )
+        yield from detector.push(values)
+    yield from detector.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="Session parquet file.")
+    parser.add_argument(
+        "--block-size", type=int, default=100, help="Rows per block, defaults to 100."
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    num_windows = 0
+    for window in replay(args.path, block_size=args.block_size):
+        num_windows += 1
+        direction = "counterclockwise" if window.signs[0] < 0 else "clockwise"
+        print(
+            "Perturbation at {:.3f} s, {}, {} samples".format(
+                window.start_times[0], direction, len(window.window(0)[0])
+            )
+        )
+    print("{} perturbations in {:.1f} s.".format(num_windows, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
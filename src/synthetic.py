@@ -0,0 +1,368 @@
+"""Synthetic sessions of the Teensy log simulated with the closed loop
+SteerControlModel, to test the perturbation pipeline at the scale of many
+hours of riding.
+
+Usage::
+
+    python src/synthetic.py session.parquet --hours 2
+    python src/synthetic.py session.parquet --hours 10 --speed 10 --assist off
+
+A rider, modeled as an optimal (LQR) full state feedback on the steer torque,
+keeps the bicycle upright at a constant speed while a low pass filtered
+random torque disturbs it. With the balance assist on, the motor adds the
+roll rate feedback of the gain schedule of ``control.py``, saturated at 7 Nm,
+and Bump'em pulses are commanded on ``desforce13`` or ``desforce24`` from
+the tracking force. The columns are those of the example data that
+``generate_time_series_imgs.py`` reads, with sensor noise and jitter of the
+timestamps. The session is simulated and written one Parquet row group at a
+time, so the memory does not grow with its length.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.linalg import expm, solve_continuous_are
+from scipy.signal import fftconvolve, lfilter
+
+from generate_time_series_imgs import (BALANCE_ASSIST_MOTOR_CONSTANT,
+                                       HANLDEBAR_LENGTH, KPH2MPS,
+                                       PULSE_DURATION, TRACKING_FORCE)
+
+SAMPLE_RATE = 1000.0  # Hz of the Teensy log
+CHUNK_SIZE = 10**6  # rows per Parquet row group
+MAX_TORQUE = 7.0  # Nm at which the balance assist saturates
+# commanded pulse forces [N] and seconds between the starts of pulses, like
+# the recorded perturbations
+PULSE_FORCES = np.arange(20.0, 200.0, 10.0)
+PULSE_INTERVAL = (5.0, 12.0)
+ACTUATOR_TIME_CONSTANT = 0.02  # s, lag of the cable forces
+# standard deviation and cut off frequency of the rider's random steer torque
+DISTURBANCE = (0.5, 1.0)  # Nm, Hz
+# standard deviation of the sensor noise in the units of each column
+NOISE = {
+    'speed': 0.05,
+    'roll_angle': 0.1,
+    'roll_rate': 0.5,
+    'roll_acc': 5.0,
+    'steer_angle': 0.1,
+    'steer_rate': 0.5,
+    'force': 0.5,
+    'motor_current': 0.05,
+}
+# standard deviation of the delay of the timestamps [s], which is clipped to
+# less than a sample so the timestamps keep increasing
+TIMESTAMP_JITTER = 1e-4
+# weights of the roll angle, steer angle, roll rate, steer rate [rad, rad/s]
+# and the steer torque [Nm] of the rider's LQR
+RIDER_WEIGHTS = ([10.0, 30.0, 1.0, 0.3], 3e-3)
+COLUMNS = ['seconds_since_start', 'speed', 'roll_angle', 'roll_rate',
+           'roll_acc', 'steer_angle', 'steer_rate', 'desforce13',
+           'desforce24', 'force1', 'force2', 'force3', 'force4',
+           'motor_current']
+
+
+def rider_gains(A, b, weights=RIDER_WEIGHTS):
+    """Returns the LQR steer torque gains of the rider, shape(4,), such that
+    the steer torque is ``-gains@x``."""
+    Q, R = np.diag(weights[0]), np.atleast_2d(weights[1])
+    P = solve_continuous_are(A, b[:, np.newaxis], Q, R)
+    return (b@P)/R[0, 0]
+
+
+class SampledClosedLoop:
+    """Bicycle and rider with the saturated roll rate feedback of the balance
+    assist evaluated and held at each sample.
+
+    Parameters
+    ==========
+    A : ndarray, shape(4, 4)
+        State matrix of the bicycle and the rider.
+    b : ndarray, shape(4,)
+        Steer torque column of the input matrix.
+    kphidot : float
+        Roll rate gain of the balance assist, zero for off.
+    max_torque : float, optional
+        Saturation of the balance assist torque [Nm].
+    time_step : float, optional
+    block_size : integer, optional
+        Number of samples that are computed at once while the assist is not
+        saturated.
+
+    Notes
+    =====
+    Between samples the torques are constant, so the state is propagated
+    exactly with the discretization ``x[n + 1] = Ad@x[n] + bd*T[n]``. While
+    the assist is not saturated, the loop is linear and a block of states is
+    the free response ``Phi**k@x[n]`` plus the convolution of the input
+    torque with the impulse response ``Phi**k@bd``, where ``Phi`` is ``Ad``
+    closed with the assist. Samples at which the assist saturates are
+    stepped one at a time.
+
+    """
+
+    def __init__(self, A, b, kphidot, max_torque=MAX_TORQUE,
+                 time_step=1.0/SAMPLE_RATE, block_size=1000):
+        self.kphidot = kphidot
+        self.max_torque = max_torque
+        self.block_size = block_size
+        augmented = np.zeros((5, 5))
+        augmented[:4, :4] = A
+        augmented[:4, 4] = b
+        discrete = expm(augmented*time_step)
+        self.Ad, self.bd = discrete[:4, :4], discrete[:4, 4]
+        self.phi = self.Ad.copy()
+        self.phi[:, 2] -= self.bd*kphidot
+        self.powers = np.empty((block_size, 4, 4))
+        self.powers[0] = np.eye(4)
+        for k in range(1, block_size):
+            self.powers[k] = self.phi@self.powers[k - 1]
+        self.impulse = self.powers@self.bd
+
+    def assist_torque(self, roll_rate):
+        return np.clip(-self.kphidot*roll_rate, -self.max_torque,
+                       self.max_torque)
+
+    def _saturated(self, roll_rate):
+        return np.abs(self.kphidot*roll_rate) >= self.max_torque
+
+    def simulate(self, x0, torque):
+        """Returns the states and assist torques at each sample and the
+        state after the last sample.
+
+        Parameters
+        ==========
+        x0 : ndarray, shape(4,)
+            State at the first sample.
+        torque : ndarray, shape(n,)
+            Steer torque of the disturbances and the pulses at each sample.
+
+        Returns
+        =======
+        states : ndarray, shape(n, 4)
+        assist : ndarray, shape(n,)
+        x : ndarray, shape(4,)
+            State at the sample after the last, the ``x0`` of the next call.
+
+        """
+        n = len(torque)
+        states = np.empty((n, 4))
+        x = np.array(x0, dtype=float)
+        i = 0
+        while i < n:
+            if self._saturated(x[2]):
+                states[i] = x
+                x = self.Ad@x + self.bd*(self.assist_torque(x[2]) + torque[i])
+                i += 1
+                continue
+            m = min(self.block_size, n - i)
+            block = self.powers[:m]@x
+            if m > 1:
+                block[1:] += fftconvolve(torque[i:i + m - 1, np.newaxis],
+                                         self.impulse[:m - 1],
+                                         axes=0)[:m - 1]
+            # the first saturated sample is valid, it is the result of an
+            # unsaturated step
+            over = np.flatnonzero(self._saturated(block[:, 2]))
+            k = over[0] if len(over) else m
+            states[i:i + k] = block[:k]
+            if k < m:
+                x = block[k]
+            else:
+                x = self.phi@block[-1] + self.bd*torque[i + m - 1]
+            i += k
+        return states, self.assist_torque(states[:, 2]), x
+
+
+def pulse_schedule(duration, rng, rate=SAMPLE_RATE):
+    """Returns the first sample, the channel (0 for ``desforce13``, 1 for
+    ``desforce24``) and the commanded force of each Bump'em pulse of a
+    session of ``duration`` seconds."""
+    width = int(round(PULSE_DURATION*rate))
+    starts = []
+    time = PULSE_INTERVAL[0]
+    while time*rate + 2*width < duration*rate:
+        starts.append(int(round(time*rate)))
+        time += rng.uniform(*PULSE_INTERVAL)
+    starts = np.array(starts, dtype=int)
+    return (starts, rng.integers(2, size=len(starts)),
+            rng.choice(PULSE_FORCES, size=len(starts)))
+
+
+def _desired_forces(start, stop, schedule, rate=SAMPLE_RATE):
+    # the commanded forces of the samples [start, stop), exactly the tracking
+    # force outside the pulses
+    width = int(round(PULSE_DURATION*rate))
+    forces = np.full((2, stop - start), float(TRACKING_FORCE))
+    starts, channels, magnitudes = schedule
+    first, last = np.searchsorted(starts, [start - width, stop])
+    for s, c, f in zip(starts[first:last], channels[first:last],
+                       magnitudes[first:last]):
+        forces[c, max(s, start) - start:min(s + width, stop) - start] = f
+    return forces
+
+
+def session_chunks(duration, speed=6.0, balance_assist=True, rider=True,
+                   seed=None, chunk_size=CHUNK_SIZE):
+    """Yields the samples of a simulated session as dataframes of at most
+    ``chunk_size`` rows.
+
+    Parameters
+    ==========
+    duration : float
+        Length of the session [s].
+    speed : float, optional
+        Constant speed [km/h].
+    balance_assist : boolean, optional
+        If True, the balance assist uses the ``GAIN_MAP[10]`` schedule of
+        ``control.py`` and ``motor_current`` is logged.
+    rider : boolean, optional
+        If True, the bicycle model with the rigid rider is used.
+    seed : integer, optional
+    chunk_size : integer, optional
+
+    Yields
+    ======
+    pandas.DataFrame
+        With the ``COLUMNS``, without ``motor_current`` if the assist is
+        off. The samples do not depend on ``chunk_size``.
+
+    """
+    from control import GAIN_MAP, generate_gains, load_models, speeds
+    from model import SteerControlModel
+
+    v = speed*KPH2MPS
+    kphidot = 0.0
+    if balance_assist:
+        kphidot = float(np.interp(v, speeds, generate_gains(GAIN_MAP[10])))
+    model = SteerControlModel(load_models()[rider][0])
+    A, B = model.form_state_space_matrices(v=v, kphi=0.0, kdelta=0.0,
+                                           kphidot=0.0, kdeltadot=0.0)
+    b = B[:, 1]
+    A = A - np.outer(b, rider_gains(A, b))
+    loop = SampledClosedLoop(A, b, kphidot)
+
+    # one generator per random quantity, so the samples do not depend on how
+    # the session is split into chunks
+    names = ['schedule', 'disturbance', 'drift', 'jitter'] + COLUMNS[1:]
+    rngs = {name: np.random.default_rng(s) for name, s in zip(
+        names, np.random.SeedSequence(seed).spawn(len(names)))}
+
+    def noise(name, n):
+        scale = NOISE['force' if name.startswith('force') else name]
+        return rngs[name].normal(scale=scale, size=n)
+
+    num_samples = int(round(duration*SAMPLE_RATE))
+    schedule = pulse_schedule(duration, rngs['schedule'])
+
+    dt = 1.0/SAMPLE_RATE
+    lowpass = np.exp(-2.0*np.pi*DISTURBANCE[1]*dt)
+    # scales the white noise so the filtered torque has the standard
+    # deviation of DISTURBANCE
+    gain = DISTURBANCE[0]*np.sqrt(1.0 - lowpass**2)
+    lag = np.exp(-dt/ACTUATOR_TIME_CONSTANT)
+    disturbance_state = np.zeros(1)
+    drift_state = np.zeros(1)
+    force_state = np.full((2, 1), lag*TRACKING_FORCE)
+    x = np.zeros(4)
+
+    for start in range(0, num_samples, chunk_size):
+        stop = min(start + chunk_size, num_samples)
+        n = stop - start
+        desired = _desired_forces(start, stop, schedule)
+        actual, force_state = lfilter([1.0 - lag], [1.0, -lag], desired,
+                                      zi=force_state)
+        disturbance, disturbance_state = lfilter(
+            [gain], [1.0, -lowpass], rngs['disturbance'].normal(size=n),
+            zi=disturbance_state)
+        pulse = (actual[1] - actual[0])*HANLDEBAR_LENGTH
+        torque = disturbance + pulse
+        states, assist, x = loop.simulate(x, torque)
+        roll_acc = states@A[2] + b[2]*(assist + torque)
+
+        # slow variation of the speed around the set speed
+        drift, drift_state = lfilter([0.01], [1.0, -0.99],
+                                     rngs['drift'].normal(size=n),
+                                     zi=drift_state)
+        jitter = np.minimum(np.abs(rngs['jitter'].normal(
+            scale=TIMESTAMP_JITTER, size=n)), 0.9*dt)
+        chunk = {
+            'seconds_since_start': np.arange(start, stop)*dt + jitter,
+            'speed': v + 0.1*drift + noise('speed', n),
+            'roll_acc': np.rad2deg(roll_acc) + noise('roll_acc', n),
+        }
+        for k, name in enumerate(['roll_angle', 'steer_angle', 'roll_rate',
+                                  'steer_rate']):
+            chunk[name] = np.rad2deg(states[:, k]) + noise(name, n)
+        chunk['desforce13'], chunk['desforce24'] = desired
+        # cables 1 and 3 pull with desforce13, 2 and 4 with desforce24, see
+        # calculate_torque_on_handlebars()
+        for name, channel in [('force1', 0), ('force2', 1), ('force3', 0),
+                              ('force4', 1)]:
+            chunk[name] = actual[channel] + noise(name, n)
+        if balance_assist:
+            chunk['motor_current'] = (assist*BALANCE_ASSIST_MOTOR_CONSTANT +
+                                      noise('motor_current', n))
+        yield pd.DataFrame({name: chunk[name] for name in COLUMNS
+                            if name in chunk})
+
+
+def write_session(path, duration, **kwargs):
+    """Writes a simulated session to a Parquet file, one row group per chunk.
+
+    Parameters
+    ==========
+    path : string
+    duration : float
+        Length of the session [s].
+    **kwargs
+        Passed to ``session_chunks()``.
+
+    Returns
+    =======
+    integer
+        Number of rows written.
+
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    num_rows = 0
+    writer = None
+    try:
+        for chunk in session_chunks(duration, **kwargs):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema)
+            writer.write_table(table, row_group_size=len(chunk))
+            num_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='Parquet file to write.')
+    parser.add_argument('--hours', type=float, default=1.0,
+                        help='Length of the session, defaults to 1 hour.')
+    parser.add_argument('--speed', type=float, default=6.0,
+                        help='Speed in km/h, defaults to 6.')
+    parser.add_argument('--assist', choices=['on', 'off'], default='on',
+                        help='Balance assist state, defaults to on.')
+    parser.add_argument('--without-rider', action='store_true',
+                        help='Use the bicycle model without the rigid rider.')
+    parser.add_argument('--seed', type=int, help='Seed of the noise.')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='Rows per row group, defaults to {}.'.format(
+                            CHUNK_SIZE))
+    args = parser.parse_args()
+    num_rows = write_session(args.path, args.hours*3600.0, speed=args.speed,
+                             balance_assist=args.assist == 'on',
+                             rider=not args.without_rider, seed=args.seed,
+                             chunk_size=args.chunk_size)
+    print('Wrote {} rows to {}.'.format(num_rows, args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules of src/ import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
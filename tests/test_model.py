@@ -0,0 +1,150 @@
+import numpy as np
+import pytest
+from bicycleparameters.models import Meijaard2007Model
+from bicycleparameters.parameter_sets import Meijaard2007ParameterSet
+from scipy.integrate import solve_ivp
+
+from control import bike_without_rider
+from model import (PERMUTATIONS, SteerControlModel, _COMPOSE,
+                   accumulate_permutations)
+
+GAINS = {'kphi': -3.0, 'kdelta': 0.5, 'kphidot': -10.8, 'kdeltadot': 0.2}
+
+
+@pytest.fixture(scope='module')
+def model():
+    return SteerControlModel(Meijaard2007ParameterSet(bike_without_rider,
+                                                      False))
+
+
+def closed_loop_reference(model, speeds, gains):
+    """Closed loop state matrices formed one speed at a time by the
+    bicycleparameters model."""
+    k = np.array([gains.get(name, 0.0) for name in model.gain_names])
+    A = []
+    for v in speeds:
+        Ai, Bi = Meijaard2007Model.form_state_space_matrices(model, v=v)
+        A.append(Ai - np.outer(Bi[:, 1], k))
+    return np.array(A), Bi
+
+
+def test_batched_state_space_matches_per_speed_loop(model):
+    speeds = np.linspace(0.0, 10.0, 51)
+    A, B = model.form_state_space_matrices(v=speeds, **GAINS)
+    A_ref, B_ref = closed_loop_reference(model, speeds, GAINS)
+    assert A.shape == (51, 4, 4) and B.shape == (51, 4, 2)
+    np.testing.assert_allclose(A, A_ref, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(B, np.broadcast_to(B_ref, B.shape),
+                               rtol=1e-12, atol=1e-12)
+
+    # a scalar speed gives one unbatched matrix
+    A5, _ = model.form_state_space_matrices(v=speeds[5], **GAINS)
+    np.testing.assert_allclose(A5, A[5], rtol=1e-12, atol=1e-12)
+
+
+def test_batched_gains_match_per_gain_loop(model):
+    kphidots = np.linspace(-40.0, 0.0, 9)
+    A, _ = model.form_state_space_matrices(v=3.0, kphidot=kphidots)
+    for Ai, kphidot in zip(A, kphidots):
+        A_ref, _ = closed_loop_reference(model, [3.0], {'kphidot': kphidot})
+        np.testing.assert_allclose(Ai, A_ref[0], rtol=1e-12, atol=1e-12)
+
+
+def test_batched_eigenvalues_match_per_speed_loop(model):
+    speeds = np.linspace(0.0, 10.0, 51)
+    evals, evecs = model.calc_eigen(v=speeds, **GAINS)
+    A, _ = model.form_state_space_matrices(v=speeds, **GAINS)
+    for i, v in enumerate(speeds):
+        evals_i, _ = model.calc_eigen(v=v, **GAINS)
+        np.testing.assert_allclose(np.sort_complex(evals[i]),
+                                   np.sort_complex(evals_i), atol=1e-10)
+        # each column is an eigenvector of its eigenvalue
+        np.testing.assert_allclose(A[i]@evecs[i], evecs[i]*evals[i],
+                                   atol=1e-9)
+
+
+def test_accumulate_permutations_matches_sequential_composition():
+    rng = np.random.default_rng(0)
+    perm_idxs = rng.integers(len(PERMUTATIONS), size=1000)
+    expected = np.empty_like(perm_idxs)
+    current = perm_idxs[0]
+    expected[0] = current
+    for i, idx in enumerate(perm_idxs[1:], start=1):
+        current = _COMPOSE[current, idx]
+        expected[i] = current
+    np.testing.assert_array_equal(accumulate_permutations(perm_idxs),
+                                  expected)
+
+
+def test_eigen_sweep_tracks_modes(model):
+    # the sweep passes the weave and capsize speeds, where complex pairs
+    # split into real eigenvalues
+    speeds = np.linspace(0.0, 10.0, 2001)
+    evals, evecs = model.calc_eigen_sweep(v=speeds, kphidot=-10.8)
+    raw, _ = model.calc_eigen(v=speeds, kphidot=-10.8)
+
+    # the same eigenpairs, only reordered
+    np.testing.assert_allclose(np.sort_complex(evals),
+                               np.sort_complex(raw), atol=1e-10)
+    A, _ = model.form_state_space_matrices(v=speeds, kphidot=-10.8)
+    np.testing.assert_allclose(A@evecs, evecs*evals[:, np.newaxis, :],
+                               atol=1e-8)
+
+    # each column moves no further between neighboring speeds than the
+    # closest assignment of the eigenvalues does
+    steps = np.abs(np.diff(evals, axis=0))
+    dists = np.abs(raw[:-1, :, np.newaxis] - raw[1:, np.newaxis, :])
+    closest = dists[:, np.arange(4), PERMUTATIONS].sum(axis=-1).min(axis=-1)
+    assert np.all(steps.sum(axis=1) <= closest + 1e-9)
+
+    # the ordering does not depend on the chunks
+    chunked, _ = model._calc_eigen_sweep(7, v=speeds, kphidot=-10.8)
+    np.testing.assert_array_equal(chunked, evals)
+
+
+def simulate_reference(model, times, x0, max_torque, gains):
+    A, B = model.form_state_space_matrices(**gains)
+    k = np.array([gains.get(name, 0.0) for name in model.gain_names])
+    b = B[:, 1]
+    # open loop state matrix, the steer torque is added clipped
+    A_open = A + np.outer(b, k)
+
+    def rhs(t, x):
+        return A_open@x + b*np.clip(-k@x, -max_torque, max_torque)
+
+    return solve_ivp(rhs, (times[0], times[-1]), x0, t_eval=times,
+                     method='DOP853', rtol=1e-10, atol=1e-12,
+                     max_step=0.002).y.T
+
+
+def saturated_cases():
+    # the first case switched back and forth at a touching torque limit
+    cases = [(0.973, {'kphidot': -10.79}, 7.0, [-0.335, 0.232, 0.0, 0.0])]
+    # bounded responses that mostly saturate and unsaturate several times
+    rng = np.random.default_rng(2)
+    for _ in range(8):
+        gains = {'kphi': rng.uniform(-20.0, 0.0),
+                 'kphidot': rng.uniform(-40.0, -5.0)}
+        x0 = np.concatenate((rng.uniform(-0.5, 0.5, 2),
+                             rng.uniform(-1.0, 1.0, 2)))
+        cases.append((rng.uniform(2.5, 6.0), gains, rng.uniform(0.5, 7.0),
+                      x0))
+    return cases
+
+
+@pytest.mark.parametrize('v, gains, max_torque, x0', saturated_cases())
+def test_simulate_saturated_matches_fine_step_integration(model, v, gains,
+                                                          max_torque, x0):
+    times = np.linspace(0.0, 5.0, 501)
+    gains = dict(gains, v=v)
+    states, inputs = model.simulate_saturated(times, x0,
+                                              max_torque=max_torque, **gains)
+    expected = simulate_reference(model, times, x0, max_torque, gains)
+
+    scale = max(1.0, np.max(np.abs(expected)))
+    np.testing.assert_allclose(states, expected, rtol=0.0, atol=1e-6*scale)
+
+    k = np.array([gains.get(name, 0.0) for name in model.gain_names])
+    np.testing.assert_allclose(
+        inputs[:, 1], np.clip(-states@k, -max_torque, max_torque),
+        atol=1e-9*max(1.0, max_torque))
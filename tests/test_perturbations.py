@@ -0,0 +1,169 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import synthetic
+from features import segment_indices, segment_stats
+from generate_time_series_imgs import (DESIRED_FORCES, DURATION_AFTER,
+                                       DURATION_BEFORE, TRACKING_FORCE,
+                                       get_context_around_perturbation,
+                                       get_perturbation_indices,
+                                       get_perturbations)
+from streaming import StreamingDetector
+
+
+def loop_perturbation_indices(data, column_names):
+    """The row by row detector that get_perturbation_indices() replaced, with
+    each start kept next to its own stop."""
+    pairs = []
+    for column_name in column_names:
+        start_index = 0
+        while True:
+            df_shortened = data[start_index:]
+            above = df_shortened[df_shortened[column_name] > TRACKING_FORCE]
+            if above.empty:
+                break
+            tmp_start_index = above.iloc[0].name
+            df_shortened = data[tmp_start_index:]
+            at = df_shortened[df_shortened[column_name] == TRACKING_FORCE]
+            if at.empty:
+                break
+            tmp_stop_index = at.iloc[0].name
+            start_index = tmp_stop_index
+            if tmp_stop_index - tmp_start_index > 30:  # filter logging errors
+                pairs.append((tmp_start_index, tmp_stop_index))
+    pairs.sort()
+    return [start for start, _ in pairs], [stop for _, stop in pairs]
+
+
+def closest_indices(query_times, times):
+    """Position of the closest time, ties go to the earlier time."""
+    return [int(np.argmin(np.abs(times - query_time)))
+            for query_time in query_times]
+
+
+def jittered_session(seed):
+    """Returns a session with jittered timestamps whose desired forces have
+    blocks of 1 to 300 samples, including blocks of 30 and 31, samples below
+    the tracking force that keep the state and a block that does not stop."""
+    rng = np.random.default_rng(seed)
+    n = 20000
+    times = np.cumsum(1e-3 + rng.uniform(-2e-4, 2e-4, n))
+    forces = {name: np.full(n, TRACKING_FORCE) for name in DESIRED_FORCES}
+    lengths = [1, 5, 29, 30, 31, 32, 300] + list(rng.integers(1, 300, 30))
+    position = 100
+    for length in rng.permutation(lengths):
+        name = DESIRED_FORCES[rng.integers(2)]
+        block = rng.uniform(20.0, 200.0, length)
+        # dips below the tracking force do not end a block
+        block[rng.random(length) < 0.05] = 1.0
+        block[0] = max(block[0], 20.0)
+        forces[name][position:position + length] = block
+        position += length + rng.integers(50, 400)
+        # dips below the tracking force between blocks do not start one
+        forces[name][position - 20:position - 10] = 1.0
+    forces[DESIRED_FORCES[0]][n - 200:] = 50.0
+    data = pd.DataFrame({'seconds_since_start': times, **forces})
+    data['roll_angle'] = np.sin(times)
+    return data
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_vectorized_indices_match_loop_detector(seed):
+    data = jittered_session(seed)
+    starts, stops = get_perturbation_indices(data, DESIRED_FORCES)
+    expected_starts, expected_stops = loop_perturbation_indices(
+        data, DESIRED_FORCES)
+    assert starts == expected_starts
+    assert stops == expected_stops
+    assert all(stop - start > 30 for start, stop in zip(starts, stops))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_context_windows_are_the_closest_samples(seed):
+    data = jittered_session(seed)
+    times = data['seconds_since_start'].to_numpy()
+    starts, stops = get_perturbation_indices(data, DESIRED_FORCES)
+    context_starts, context_stops = get_context_around_perturbation(
+        data, starts, stops, DURATION_BEFORE, DURATION_AFTER)
+    assert context_starts == closest_indices(
+        times[starts] - DURATION_BEFORE, times)
+    assert context_stops == closest_indices(
+        times[stops] + DURATION_AFTER, times)
+
+    perturbations = get_perturbations(data, DESIRED_FORCES, DURATION_BEFORE,
+                                      DURATION_AFTER)
+    assert len(perturbations) == len(starts)
+    roll_angles = data['roll_angle'].to_numpy()
+    for i, (start, stop) in enumerate(zip(context_starts, context_stops)):
+        window = perturbations.to_dataframe(i)
+        assert list(window.index) == list(range(start, stop))
+        np.testing.assert_array_equal(
+            window['seconds_since_start'].to_numpy(),
+            times[start:stop] - times[starts[i]])
+        np.testing.assert_array_equal(
+            window['roll_angle'].to_numpy(),
+            perturbations.signs[i]*roll_angles[start:stop])
+    np.testing.assert_array_equal(perturbations.stop_times, times[stops])
+
+
+def session_values(data):
+    numeric = data.select_dtypes('number')
+    return (list(numeric.columns),
+            np.ascontiguousarray(numeric.to_numpy(dtype=float).T))
+
+
+def stream(columns, values, block_size):
+    detector = StreamingDetector(columns)
+    windows = []
+    for start in range(0, values.shape[1], block_size):
+        windows += detector.push(values[:, start:start + block_size])
+    return windows + detector.flush()
+
+
+@pytest.fixture(scope='module')
+def session():
+    return pd.concat(list(synthetic.session_chunks(40.0, seed=3)),
+                     ignore_index=True)
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 100, 4096, 10**6])
+def test_streaming_matches_batch_detection(session, block_size):
+    batch = get_perturbations(session, DESIRED_FORCES, DURATION_BEFORE,
+                              DURATION_AFTER)
+    assert len(batch) > 0
+    windows = stream(*session_values(session), block_size)
+    assert len(windows) == len(batch)
+    for i, window in enumerate(windows):
+        np.testing.assert_array_equal(window.window(0), batch.window(i))
+        assert window.start_times[0] == batch.start_times[i]
+        assert window.stop_times[0] == batch.stop_times[i]
+        assert window.signs[0] == batch.signs[i]
+
+
+@pytest.mark.parametrize('after_stop', [0, 1, 2, 500])
+def test_streaming_flush_matches_batch_at_end_of_data(session, after_stop):
+    _, stops = get_perturbation_indices(session, DESIRED_FORCES)
+    data = session.iloc[:stops[0] + after_stop]
+    batch = get_perturbations(data, DESIRED_FORCES, DURATION_BEFORE,
+                              DURATION_AFTER)
+    windows = stream(*session_values(data), 64)
+    assert len(windows) == len(batch)
+    for i, window in enumerate(windows):
+        np.testing.assert_array_equal(window.window(0), batch.window(i))
+
+
+def test_segment_stats_of_empty_segments_are_nan():
+    values = np.arange(10.0)[np.newaxis]
+    starts = np.array([0, 3, 3, 5, 9])
+    stops = np.array([3, 3, 5, 9, 9])
+    positions, segment_ids, offsets = segment_indices(starts, stops)
+    stats = segment_stats(values[:, positions], segment_ids, offsets)
+    np.testing.assert_array_equal(stats['mean'][0],
+                                  [1.0, np.nan, 3.5, 6.5, np.nan])
+    np.testing.assert_array_equal(stats['max'][0],
+                                  [2.0, np.nan, 4.0, 8.0, np.nan])
+    np.testing.assert_array_equal(stats['min'][0],
+                                  [0.0, np.nan, 3.0, 5.0, np.nan])
+    np.testing.assert_array_equal(stats['median'][0],
+                                  [1.0, np.nan, 3.5, 6.5, np.nan])
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import resampling
+from regression import COEFFICIENTS, DATA_PATHS, design_matrix, irls
+
+# glm(fall ~ ..., family = binomial) estimates and standard errors of
+# src/statistics.R, as printed to two decimals in the tables of main.tex
+GLM_ESTIMATES = {
+    6: {
+        '(Intercept)': (-0.29, 0.17),
+        'X': (-0.77, 0.22),
+        'angular_impulse': (1.69, 0.27),
+        'balance_assist1': (-0.64, 0.27),
+        'roll_angle': (-0.25, 0.21),
+        'steer_angle': (-0.14, 0.21),
+        'balance_assist1:roll_angle': (0.52, 0.34),
+        'balance_assist1:steer_angle': (-0.41, 0.34),
+        'X:balance_assist1': (-0.53, 0.34),
+        'angular_impulse:balance_assist1': (0.41, 0.41),
+    },
+    10: {
+        '(Intercept)': (-0.24, 0.16),
+        'X': (-1.16, 0.21),
+        'angular_impulse': (2.39, 0.29),
+        'balance_assist1': (-0.44, 0.24),
+        'roll_angle': (0.27, 0.22),
+        'steer_angle': (-0.37, 0.24),
+        'balance_assist1:roll_angle': (-0.61, 0.34),
+        'balance_assist1:steer_angle': (0.56, 0.35),
+        'X:balance_assist1': (-0.37, 0.32),
+        'angular_impulse:balance_assist1': (0.46, 0.44),
+    },
+}
+
+
+def load(speed):
+    table = pd.read_csv(DATA_PATHS[speed], index_col=0)
+    return design_matrix(table), table['fall'].to_numpy(dtype=float)
+
+
+@pytest.mark.parametrize('speed', sorted(GLM_ESTIMATES))
+def test_irls_matches_glm(speed):
+    X, y = load(speed)
+    beta, cov, _, converged, _ = irls(X, y)
+    assert converged
+    expected = np.array([GLM_ESTIMATES[speed][name] for name in COEFFICIENTS])
+    # the tables round some values and truncate others to two decimals
+    np.testing.assert_allclose(beta, expected[:, 0], atol=0.01)
+    np.testing.assert_allclose(np.sqrt(np.diag(cov)), expected[:, 1],
+                               atol=0.01)
+
+
+def test_batched_irls_matches_single_fits():
+    X, y = load(6)
+    rng = np.random.default_rng(0)
+    weights = rng.integers(0, 3, size=(4, len(y))).astype(float)
+    beta, cov, deviance, converged, _ = irls(
+        np.broadcast_to(X, (4,) + X.shape), np.broadcast_to(y, (4, len(y))),
+        weights=weights)
+    for i in range(4):
+        beta_i, cov_i, deviance_i, converged_i, _ = irls(X, y,
+                                                         weights=weights[i])
+        assert converged[i] == converged_i
+        np.testing.assert_allclose(beta[i], beta_i, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(cov[i], cov_i, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(deviance[i], deviance_i, rtol=1e-12)
+
+
+def test_singular_refit_is_nan():
+    table = pd.read_csv(DATA_PATHS[6], index_col=0)
+    data = resampling.prepare(table)
+    X = np.broadcast_to(data['X'], (3,) + data['X'].shape)
+    y = np.broadcast_to(data['y'], (3, len(data['y'])))
+    weights = np.ones((3, len(data['y'])))
+    # no rows left in the second fit
+    weights[1] = 0.0
+    beta, _, converged = resampling._fit_chunk(X, y, weights, data['beta'])
+    np.testing.assert_array_equal(converged, [True, False, True])
+    assert np.isnan(beta[1]).all()
+    np.testing.assert_allclose(beta[0], data['beta'], rtol=1e-8)